@@ -0,0 +1,127 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+# requests and websocket commands slower than this are logged with their sql, 0 disables it
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 500))
+# statements kept per request for the slow log
+MAX_LOGGED_QUERIES = 50
+
+_current: ContextVar[Optional['QueryStats']] = ContextVar('query_stats', default=None)
+
+
+class QueryStats:
+    """
+    Database activity of one request or websocket command.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.db_time = 0.0
+        self.wall_time = 0.0
+        self.slowest: Optional[Tuple[str, float]] = None
+        self.queries: List[Tuple[str, float]] = []
+
+    def record(self, sql: str, duration: float):
+        self.count += 1
+        self.db_time += duration
+        if self.slowest is None or duration > self.slowest[1]:
+            self.slowest = (sql, duration)
+        if len(self.queries) < MAX_LOGGED_QUERIES:
+            self.queries.append((sql, duration))
+
+    def server_timing(self) -> str:
+        return f'db;dur={self.db_time * 1000:.2f};desc="{self.count} queries", total;dur={self.wall_time * 1000:.2f}'
+
+
+def _execute_wrapper(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.record(sql, time.perf_counter() - start)
+
+
+@receiver(connection_created)
+def install_execute_wrapper(sender, connection, **kwargs):
+    # every connection of every thread, including the database_sync_to_async ones
+    if _execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute_wrapper)
+
+
+def _install_current_thread():
+    # connections opened before this module was imported never sent connection_created
+    for connection in connections.all():
+        install_execute_wrapper(sender=None, connection=connection)
+
+
+@contextmanager
+def collect(name: str):
+    """
+    Record the queries run in this context, threads started through sync_to_async included,
+    since they copy the context.
+    """
+    _install_current_thread()
+    stats = QueryStats(name)
+    token = _current.set(stats)
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats.wall_time = time.perf_counter() - start
+        _current.reset(token)
+        if SLOW_REQUEST_MS and stats.wall_time * 1000 > SLOW_REQUEST_MS:
+            logger.warning(
+                'Slow %s: %.1fms, %d queries in %.1fms\n%s', name, stats.wall_time * 1000, stats.count,
+                stats.db_time * 1000,
+                '\n'.join(f'{duration * 1000:.2f}ms {sql}' for sql, duration in stats.queries)
+            )
+
+
+class CommandStats:
+    """
+    In process aggregate of ``QueryStats`` per websocket command type.
+    """
+
+    def __init__(self):
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stats: QueryStats):
+        with self._lock:
+            aggregate = self._stats.setdefault(stats.name, {
+                'calls': 0, 'queries': 0, 'db_time': 0.0, 'wall_time': 0.0, 'max_wall_time': 0.0,
+                'slowest_query': 0.0,
+            })
+            aggregate['calls'] += 1
+            aggregate['queries'] += stats.count
+            aggregate['db_time'] += stats.db_time
+            aggregate['wall_time'] += stats.wall_time
+            aggregate['max_wall_time'] = max(aggregate['max_wall_time'], stats.wall_time)
+            if stats.slowest:
+                aggregate['slowest_query'] = max(aggregate['slowest_query'], stats.slowest[1])
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {name: dict(aggregate) for name, aggregate in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+command_stats = CommandStats()
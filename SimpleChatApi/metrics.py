@@ -0,0 +1,204 @@
+"""
+Prometheus metrics of this worker, served as text by ``metrics_view``.
+
+Every thread writes to its own shard of a metric, the shards are only summed when scraped,
+so recording a value never takes a lock.
+"""
+import functools
+import hmac
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from channels.db import DatabaseSyncToAsync
+from django.http import HttpResponse, HttpResponseForbidden
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+# scrapers allowed to read ``metrics_view``: the local ones, or any sending ``Authorization: Bearer METRICS_TOKEN``.
+# Behind a reverse proxy on the same host every request comes from it, set METRICS_ALLOWED_IPS empty and use the token
+METRICS_ALLOWED_IPS = {_ip for _ip in os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').replace(' ', '').split(',')
+                       if _ip}
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+
+class Metric(ABC):
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[dict] = []
+        # only taken the first time a thread records something
+        self._shards_lock = threading.Lock()
+        registry.append(self)
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    @abstractmethod
+    def _merged(self) -> Dict[Tuple[str, ...], object]:
+        """
+        :return: labels -> value of the shards merged
+        """
+
+    def _labels(self, labels: Tuple[str, ...], extra: str = '') -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for labels, value in sorted(self._merged().items()):
+            lines.append(f'{self.name}{self._labels(labels)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels: str, amount: float = 1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def _merged(self):
+        merged = {}
+        for shard in list(self._shards):
+            for labels, value in list(shard.items()):
+                merged[labels] = merged.get(labels, 0) + value
+        return merged
+
+
+class Gauge(Counter):
+    """
+    Gauge made of increments, so it can be changed from any thread without a lock.
+    """
+    type = 'gauge'
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels: str):
+        shard = self._shard()
+        # bucket counts, then sum and count
+        data = shard.get(labels)
+        if data is None:
+            data = shard[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[i] += 1
+                break
+        data[-2] += value
+        data[-1] += 1
+
+    def _merged(self):
+        merged = {}
+        for shard in list(self._shards):
+            for labels, data in list(shard.items()):
+                total = merged.setdefault(labels, [0] * len(data))
+                for i, value in enumerate(data):
+                    total[i] += value
+        return merged
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for labels, data in sorted(self._merged().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                le = self._labels(labels, 'le="%s"' % bound)
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            le = self._labels(labels, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{le} {data[-1]}')
+            lines.append(f'{self.name}_sum{self._labels(labels)} {data[-2]}')
+            lines.append(f'{self.name}_count{self._labels(labels)} {data[-1]}')
+        return lines
+
+
+registry: List[Metric] = []
+
+WORKER = str(os.getpid())
+
+WEBSOCKET_CONNECTIONS = Gauge('websocket_connections', 'Open websocket connections', ('worker',))
+WEBSOCKET_RECEIVED = Counter('websocket_messages_received_total', 'Websocket frames received', ('command',))
+WEBSOCKET_SENT = Counter('websocket_messages_sent_total', 'Websocket frames sent', ('type',))
+WEBSOCKET_SEND_QUEUE_OVERFLOWS = Counter('websocket_send_queue_overflows_total', 'Full websocket send queues',
+                                         ('policy',))
+WEBSOCKET_FRAMES_COALESCED = Counter('websocket_frames_coalesced_total', 'Websocket frames sent inside a batch frame')
+RATE_LIMITED = Counter('rate_limited_total', 'Commands rejected by the rate limiter', ('command', 'transport'))
+GROUP_SEND_SECONDS = Histogram('channel_layer_group_send_seconds', 'Channel layer group_send latency')
+DB_THREAD_QUEUE = Gauge('database_sync_to_async_queue_depth', 'Calls waiting for a database thread')
+DB_THREAD_WAIT_SECONDS = Histogram('database_sync_to_async_wait_seconds', 'Time waited for a database thread')
+DB_POOL_WAIT_SECONDS = Histogram('db_pool_wait_seconds', 'Time waited for a pooled database connection', ('database',))
+DB_POOL_CONNECTIONS = Gauge('db_pool_connections', 'Pooled database connections', ('database', 'state'))
+DB_POOL_TIMEOUTS = Counter('db_pool_timeouts_total', 'Pooled connections not available in time', ('database',))
+DB_POOL_CLOSED = Counter('db_pool_connections_closed_total', 'Pooled database connections closed',
+                         ('database', 'reason'))
+IPB_OAUTH_SECONDS = Histogram('ipb_oauth_request_seconds', 'IPB OAuth token request latency', ('outcome',))
+IPB_OAUTH_CIRCUIT_OPEN = Counter('ipb_oauth_circuit_open_total', 'Logins refused while the IPB OAuth circuit is open')
+HTTP_REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'HTTP request latency', ('method', 'route'))
+
+
+class InstrumentedDatabaseSyncToAsync(DatabaseSyncToAsync):
+    """
+    ``database_sync_to_async`` that reports how many calls wait for the thread pool and for how long.
+    """
+
+    def __init__(self, func: Callable, *args, **kwargs):
+        @functools.wraps(func)
+        def run(state: list, *func_args, **func_kwargs):
+            # state is [submitted, started]
+            state[1] = True
+            DB_THREAD_QUEUE.dec()
+            DB_THREAD_WAIT_SECONDS.observe(time.perf_counter() - state[0])
+            return func(*func_args, **func_kwargs)
+
+        super().__init__(run, *args, **kwargs)
+
+    async def __call__(self, *args, **kwargs):
+        state = [time.perf_counter(), False]
+        DB_THREAD_QUEUE.inc()
+        try:
+            return await super().__call__(state, *args, **kwargs)
+        finally:
+            if not state[1]:
+                DB_THREAD_QUEUE.dec()
+
+
+database_sync_to_async = InstrumentedDatabaseSyncToAsync
+
+
+def render() -> str:
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+
+def scrape_allowed(request) -> bool:
+    if request.META.get('REMOTE_ADDR') in METRICS_ALLOWED_IPS:
+        return True
+    scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    return bool(METRICS_TOKEN) and scheme.lower() == 'bearer' and hmac.compare_digest(token, METRICS_TOKEN)
+
+
+def metrics_view(request):
+    if not scrape_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,3 +1,8 @@
+import time
+
+from SimpleChatApi.instrumentation import collect
+from SimpleChatApi.metrics import HTTP_REQUEST_SECONDS
+
 
 # https://stackoverflow.com/a/47888695/14312439
 class CsrfExemptSessionAuthenticationMiddleware:
@@ -9,3 +14,35 @@ class CsrfExemptSessionAuthenticationMiddleware:
         setattr(request, '_dont_enforce_csrf_checks', True)
         response = self.get_response(request)
         return response
+
+
+class QueryInstrumentationMiddleware:
+    """
+    Adds the query count, database time and total time of the request as a ``Server-Timing`` header.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with collect(f'{request.method} {request.path}') as stats:
+            response = self.get_response(request)
+        response['Server-Timing'] = stats.server_timing()
+        return response
+
+
+class MetricsMiddleware:
+    """
+    Latency histogram per url pattern, see ``SimpleChatApi.metrics``.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, request.method,
+                                     match.route if match else 'unmatched')
+        return response
@@ -0,0 +1,198 @@
+"""
+Connection pool of a worker for the chat database, used through the ``SimpleChatApi.pool.mysql``
+and ``SimpleChatApi.pool.sqlite3`` engines.
+
+Django opens a connection per thread and closes the old ones at the end of every request and
+``database_sync_to_async`` call. With these engines ``close`` gives the connection back to the pool, whatever
+``CONN_MAX_AGE`` says, and the next ``connect`` of any thread takes it again, so at most ``max_size`` connections
+are open, whatever the number of threads of the wsgi server or of the asgi thread pools. Threads of their own
+(``user.presence``, ``core.unread``) close their connections after every flush.
+"""
+import atexit
+import threading
+import time
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple, Type
+
+from SimpleChatApi.metrics import DB_POOL_CLOSED, DB_POOL_CONNECTIONS, DB_POOL_TIMEOUTS, DB_POOL_WAIT_SECONDS
+
+
+class ConnectionPool:
+    """
+    Bounded pool of the raw (driver) connections of one database.
+
+    :param max_size: connections open at most, idle or in use
+    :param timeout: seconds to wait for a connection once ``max_size`` are in use
+    :param max_idle: idle connections are closed after this many seconds
+    :param max_lifetime: connections are closed when given back this many seconds after they were opened
+    :param validate_after: connections idle for longer are pinged before they are handed out
+    """
+
+    def __init__(self, database: str, max_size: int, timeout: float = 10, max_idle: float = 300,
+                 max_lifetime: float = 3600, validate_after: float = 1, error: Type[Exception] = TimeoutError):
+        self.database = database
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.validate_after = validate_after
+        self.error = error
+        # (connection, opened, given back), the most recent last
+        self._idle: List[Tuple[object, float, float]] = []
+        self._opened: Dict[int, float] = {}
+        self._size = 0
+        self._condition = threading.Condition()
+
+    def checkout(self, connect: Callable[[], object], validate: Callable[[object], bool]):
+        """
+        A pooled connection, or a new one from ``connect`` while the pool isn't full.
+        """
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            entry, expired = self._take(deadline, start)
+            self._close(expired, 'idle')
+            if entry is None:
+                try:
+                    connection = connect()
+                except BaseException:
+                    self._release()
+                    raise
+                return self._lend(connection, time.monotonic())
+            connection, opened, returned = entry
+            if time.monotonic() - returned < self.validate_after or validate(connection):
+                return self._lend(connection, opened)
+            self._close([connection], 'invalid')
+            self._release()
+
+    def checkin(self, connection, reusable: bool = True):
+        now = time.monotonic()
+        with self._condition:
+            opened = self._opened.pop(id(connection), now)
+        DB_POOL_CONNECTIONS.dec(self.database, 'in_use')
+        if not reusable or now - opened >= self.max_lifetime:
+            self._close([connection], 'broken' if not reusable else 'lifetime')
+            return self._release()
+        with self._condition:
+            self._idle.append((connection, opened, now))
+            self._condition.notify()
+        DB_POOL_CONNECTIONS.inc(self.database, 'idle')
+
+    def close_idle(self):
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._condition.notify_all()
+        DB_POOL_CONNECTIONS.dec(self.database, 'idle', amount=len(idle))
+        self._close([connection for connection, _, _ in idle], 'shutdown')
+
+    def _take(self, deadline: float, start: float) -> Tuple[Optional[Tuple[object, float, float]], List[object]]:
+        """
+        :return: an idle connection, or None with a slot reserved for a new one, and the expired idle connections
+        """
+        expired = []
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                # the oldest ones are first, the recently used ones stay warm
+                while self._idle and now - self._idle[0][2] >= self.max_idle:
+                    expired.append(self._idle.pop(0)[0])
+                    self._size -= 1
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    entry = None
+                    break
+                # nothing expired then, expiring frees a slot
+                if now >= deadline:
+                    DB_POOL_TIMEOUTS.inc(self.database)
+                    raise self.error(f'No connection of {self.database} available after {self.timeout}s, '
+                                     f'{self.max_size} in use')
+                self._condition.wait(deadline - now)
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start, self.database)
+        DB_POOL_CONNECTIONS.dec(self.database, 'idle', amount=len(expired) + (entry is not None))
+        return entry, expired
+
+    def _lend(self, connection, opened: float):
+        with self._condition:
+            self._opened[id(connection)] = opened
+        DB_POOL_CONNECTIONS.inc(self.database, 'in_use')
+        return connection
+
+    def _release(self):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _close(self, connections: List[object], reason: str):
+        for connection in connections:
+            DB_POOL_CLOSED.inc(self.database, reason)
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+_pools: Dict[Tuple[str, str], ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias: str, settings_dict: dict, error: Type[Exception]) -> ConnectionPool:
+    # the test databases get their own pool, they have another NAME
+    key = (alias, str(settings_dict['NAME']))
+    with _pools_lock:
+        if (pool := _pools.get(key)) is None:
+            pool = _pools[key] = ConnectionPool(alias, error=error, **settings_dict.get('POOL', {}))
+    return pool
+
+
+@atexit.register
+def close_pools():
+    for pool in list(_pools.values()):
+        pool.close_idle()
+
+
+class PooledDatabaseWrapperMixin:
+    """
+    ``DatabaseWrapper`` taking its connection from the pool of its alias, ``POOL`` of the database
+    settings holds the ``ConnectionPool`` options.
+    """
+
+    @property
+    def pool(self) -> ConnectionPool:
+        return get_pool(self.alias, self.settings_dict, self.Database.OperationalError)
+
+    def get_new_connection(self, conn_params):
+        return self.pool.checkout(partial(super().get_new_connection, conn_params), self.validate_connection)
+
+    def validate_connection(self, connection) -> bool:
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            finally:
+                cursor.close()
+            return True
+        except self.Database.Error:
+            return False
+
+    def close_if_unusable_or_obsolete(self):
+        # a connection kept by an idle thread is one the other threads wait for, the pool keeps it open anyway
+        if self.connection is not None and not self.in_atomic_block:
+            self.close()
+            return
+        super().close_if_unusable_or_obsolete()
+
+    def _close(self):
+        if self.connection is None:
+            return
+        # a connection closed inside an atomic block stays referenced by this wrapper until the next connect
+        reusable = not self.in_atomic_block and (not self.errors_occurred or self.is_usable())
+        if reusable and not self.get_autocommit():
+            try:
+                self.connection.rollback()
+            except self.Database.Error:
+                reusable = False
+        self.pool.checkin(self.connection, reusable)
@@ -0,0 +1,13 @@
+from django.db.backends.mysql import base
+
+from SimpleChatApi.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+
+    def validate_connection(self, connection) -> bool:
+        try:
+            connection.ping()
+            return True
+        except self.Database.Error:
+            return False
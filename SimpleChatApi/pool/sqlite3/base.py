@@ -0,0 +1,9 @@
+from django.db.backends.sqlite3 import base
+
+from SimpleChatApi.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    """
+    Stand-in for the pooled mysql engine in development and tests.
+    """
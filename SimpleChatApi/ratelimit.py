@@ -0,0 +1,159 @@
+import math
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from SimpleChatApi.metrics import RATE_LIMITED
+
+_rate = re.compile(r'^\s*(\d+)\s*/\s*(\d*)\s*([smh])\s*$')
+_units = {'s': 1, 'm': 60, 'h': 60 * 60}
+
+
+def parse_rate(rate: Optional[str]) -> Optional[Tuple[float, float]]:
+    """
+    ``'20/10s'``: bursts of 20 commands, refilled at 20 per 10 seconds. Units are s, m and h.
+
+    :return: capacity and tokens per second, None when ``rate`` is empty (no limit)
+    """
+    if not rate:
+        return None
+    if not (match := _rate.match(rate)):
+        raise ValueError(f'Invalid rate {rate}')
+    capacity, period, unit = match.groups()
+    return float(capacity), float(capacity) / (int(period or 1) * _units[unit])
+
+
+class BaseRateLimiter(ABC):
+    """
+    Token buckets keyed by member and command type, shared by the websocket commands and the rest views,
+    so a member can't get around a limit by switching transport.
+
+    :param rates: command type -> rate (see ``parse_rate``), ``default`` applies to the other commands
+    """
+
+    def __init__(self, rates: Dict[str, Optional[str]]):
+        self.rates = {command: parse_rate(rate) for command, rate in rates.items()}
+
+    def rate(self, command: str) -> Optional[Tuple[float, float]]:
+        return self.rates[command] if command in self.rates else self.rates.get('default')
+
+    def check(self, member_id: int, command: str, transport: str = 'http') -> float:
+        """
+        Take a token of the bucket of ``member_id`` for ``command``.
+
+        :return: seconds until the command is allowed again, 0 when it is allowed now
+        """
+        if (rate := self.rate(command)) is None:
+            return 0
+        if retry_after := self._take(f'{member_id}:{command}', *rate):
+            RATE_LIMITED.inc(command, transport)
+        return retry_after
+
+    async def acheck(self, member_id: int, command: str, transport: str = 'websocket') -> float:
+        if (rate := self.rate(command)) is None:
+            return 0
+        if retry_after := await self._atake(f'{member_id}:{command}', *rate):
+            RATE_LIMITED.inc(command, transport)
+        return retry_after
+
+    @abstractmethod
+    def _take(self, key: str, capacity: float, refill: float) -> float:
+        """
+        :return: seconds until ``key`` is allowed again, 0 when it was allowed now
+        """
+
+    async def _atake(self, key: str, capacity: float, refill: float) -> float:
+        return self._take(key, capacity, refill)
+
+    @staticmethod
+    def _bucket(state: Optional[Tuple[float, float]], now: float, capacity: float, refill: float) \
+            -> Tuple[Tuple[float, float], float]:
+        """
+        :param state: tokens and time of the last take, None for a full bucket
+        :return: the new state and the seconds to wait, 0 when a token was taken
+        """
+        tokens, stamp = state or (capacity, now)
+        tokens = min(capacity, tokens + (now - stamp) * refill)
+        if tokens >= 1:
+            return (tokens - 1, now), 0
+        return (tokens, now), (1 - tokens) / refill
+
+
+class InMemoryRateLimiter(BaseRateLimiter):
+    """
+    Buckets of this worker only, every worker allows the full rate. The least recently used
+    bucket is dropped (reset to full) once ``max_size`` members are tracked.
+    """
+
+    def __init__(self, rates: Dict[str, Optional[str]], max_size: int = 100000):
+        super().__init__(rates)
+        self.max_size = max_size
+        self._buckets: 'OrderedDict[str, Tuple[float, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _take(self, key: str, capacity: float, refill: float) -> float:
+        with self._lock:
+            self._buckets[key], retry_after = self._bucket(self._buckets.get(key), time.monotonic(), capacity, refill)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+
+class CacheRateLimiter(BaseRateLimiter):
+    """
+    Fixed windows shared through a django cache (redis, memcached, ...) so the limits hold across workers.
+
+    A window lasts the time the rate refills ``capacity`` tokens, ``capacity`` commands are allowed in each.
+    The count is taken with ``cache.add`` and ``cache.incr``, atomic on the shared caches, so concurrent commands
+    of one member on two workers never both get the last one. Unlike a bucket a member may send up to twice
+    ``capacity`` commands around the end of a window.
+    """
+
+    def __init__(self, rates: Dict[str, Optional[str]], cache: str = 'default', prefix: str = 'ratelimit:'):
+        super().__init__(rates)
+        self.cache = caches[cache]
+        self.prefix = prefix
+
+    def _take(self, key: str, capacity: float, refill: float) -> float:
+        period = capacity / refill
+        now = time.time()
+        window = int(now // period)
+        key = f'{self.prefix}{key}:{window}'
+        # the next window has a key of its own, this one only has to outlive its period
+        timeout = math.ceil(period) + 1
+        self.cache.add(key, 0, timeout=timeout)
+        try:
+            count = self.cache.incr(key)
+        except ValueError:
+            # evicted between the add and the incr
+            self.cache.add(key, 1, timeout=timeout)
+            count = 1
+        if count <= capacity:
+            return 0
+        return (window + 1) * period - now
+
+    async def _atake(self, key: str, capacity: float, refill: float) -> float:
+        # the django cache has no native async api, its aget and aset are one thread hop each:
+        # the add and the incr take a single hop here
+        return await sync_to_async(self._take)(key, capacity, refill)
+
+
+_limiter: Optional[BaseRateLimiter] = None
+
+
+def get_rate_limiter() -> BaseRateLimiter:
+    global _limiter
+    if _limiter is None:
+        config = getattr(settings, 'RATE_LIMIT', {})
+        backend = import_string(config.get('BACKEND', 'SimpleChatApi.ratelimit.InMemoryRateLimiter'))
+        _limiter = backend(config.get('RATES', {}), **config.get('OPTIONS', {}))
+    return _limiter
@@ -0,0 +1,122 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_CACHE_PREFIX = 'replicas.pin.'
+
+
+class ReplicaSession:
+    """
+    Member of the current request or websocket command, and whether their reads must see the primary.
+    """
+
+    def __init__(self, member_id: Optional[int] = None):
+        self.member_id = None
+        self.recorded = False
+        self._pinned: Optional[bool] = None
+        if member_id is not None:
+            self.use_member(member_id)
+
+    def use_member(self, member_id: int):
+        self.member_id = member_id
+        self._pinned = None
+
+    @property
+    def pinned(self) -> bool:
+        """
+        Read from the cache by the first read that could go to a replica, in its database thread:
+        a websocket command doesn't take another thread hop for it, nor reads the cache without replicas.
+        """
+        if self._pinned is None:
+            self._pinned = self.member_id is not None and is_pinned(self.member_id)
+        return self._pinned
+
+    def wrote(self):
+        self._pinned = True
+        # one pin per request is enough, it lasts REPLICA_PIN_SECONDS from the first write
+        if self.member_id is not None and not self.recorded:
+            pin(self.member_id)
+            self.recorded = True
+
+
+_session: ContextVar[Optional[ReplicaSession]] = ContextVar('replica_session', default=None)
+
+
+@contextmanager
+def replica_session(member_id: Optional[int] = None):
+    token = _session.set(ReplicaSession(member_id))
+    try:
+        yield _session.get()
+    finally:
+        _session.reset(token)
+
+
+def use_member(member_id: int):
+    """
+    Tell the current session who is reading, for requests authenticated after the session started.
+    """
+    if (session := _session.get()) is not None:
+        session.use_member(member_id)
+
+
+def pin(member_id: int):
+    """
+    Send the reads of ``member_id`` to the primary for ``REPLICA_PIN_SECONDS``, on every worker
+    sharing the default cache: with the process local default (LocMem) only this worker knows about it.
+    """
+    if settings.DATABASE_REPLICAS:
+        cache.set(f'{PIN_CACHE_PREFIX}{member_id}', True, settings.REPLICA_PIN_SECONDS)
+
+
+async def apin(member_id: int):
+    """
+    ``pin`` from the event loop, a thread sensitive hop of the cache, only taken with replicas
+    """
+    if settings.DATABASE_REPLICAS:
+        await cache.aset(f'{PIN_CACHE_PREFIX}{member_id}', True, settings.REPLICA_PIN_SECONDS)
+
+
+def is_pinned(member_id: int) -> bool:
+    return bool(settings.DATABASE_REPLICAS) and cache.get(f'{PIN_CACHE_PREFIX}{member_id}', False)
+
+
+def read_db(primary: Optional[str]) -> Optional[str]:
+    """
+    Alias to read from: a replica of ``primary``, unless there is none, the current member wrote recently
+    or ``primary`` is in a transaction.
+    """
+    replicas = settings.DATABASE_REPLICAS.get(primary or DEFAULT_DB_ALIAS)
+    if not replicas:
+        return primary
+    if (session := _session.get()) is not None and session.pinned:
+        return primary
+    if connections[primary or DEFAULT_DB_ALIAS].in_atomic_block:
+        return primary
+    return random.choice(replicas)
+
+
+def write_db(primary: Optional[str]) -> Optional[str]:
+    """
+    Alias to write to, pins the current member to the primary.
+    """
+    if (session := _session.get()) is not None:
+        session.wrote()
+    return primary
+
+
+class ReplicaSessionMiddleware:
+    """
+    One replica session per request, the member is set by ``user.authentication.TokenAuthentication``.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with replica_session():
+            return self.get_response(request)
@@ -22,6 +22,19 @@ if not DEBUG:
 
 USE_IPB = (True if _x.lower() == 'true' else False) if (_x := os.environ.get('USE_IPB')) else False
 
+# websocket messages are written in batches by core.ingest.PostWriter
+BATCHED_SEND = (True if _x.lower() == 'true' else False) if (_x := os.environ.get('BATCHED_SEND')) else False
+BATCHED_SEND_MAX_SIZE = int(os.environ.get('BATCHED_SEND_MAX_SIZE', 100))
+BATCHED_SEND_MAX_DELAY_MS = float(os.environ.get('BATCHED_SEND_MAX_DELAY_MS', 5))
+
+# posts older than this many days are moved to the archive by `manage.py archive_posts`, 0 disables the archive
+POST_ARCHIVE_DAYS = int(os.environ.get('POST_ARCHIVE_DAYS', 0))
+USE_ARCHIVE_DATABASE = (True if _x.lower() == 'true' else False) if (_x := os.environ.get('USE_ARCHIVE_DATABASE')) \
+    else False
+# cache holding the newest archived chat_id, shared by the workers and `manage.py archive_posts` (redis, memcached).
+# Unset, every read that may reach the archive looks the boundary up in the archive table
+POST_ARCHIVE_BOUNDARY_CACHE = os.environ.get('POST_ARCHIVE_BOUNDARY_CACHE') or None
+
 print(f'DEBUG: {DEBUG}')
 print(f'USE_IPB: {USE_IPB}')
 
@@ -61,6 +74,9 @@ SPECTACULAR_SETTINGS = {
 }
 
 MIDDLEWARE = [
+    'SimpleChatApi.middleware.MetricsMiddleware',
+    'SimpleChatApi.middleware.QueryInstrumentationMiddleware',
+    'SimpleChatApi.replicas.ReplicaSessionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -105,6 +121,39 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Who is connected, shared between workers through the cache (see websocket.registry)
+# the default cache is process local, point it to redis or memcached when running several workers
+WEBSOCKET_REGISTRY = {
+    'BACKEND': 'websocket.registry.CacheConnectionRegistry',
+    'OPTIONS': {
+        'ttl': int(os.environ.get('WEBSOCKET_REGISTRY_TTL', 60)),
+        'cache': 'default',
+    },
+}
+
+# Outbound frames of every websocket go through a bounded queue (see websocket.outbox):
+# frames queued within WEBSOCKET_COALESCE_MS are sent as one batch frame (0 sends them one by one),
+# a full queue either drops its frames for a resync marker ('resync') or closes the socket ('disconnect').
+# The queue only fills while sends wait for the client: daphne takes every frame at once and buffers it in the
+# transport, so under daphne the size bounds the frames of a busy consumer, not the memory held for a slow client
+WEBSOCKET_SEND_QUEUE_SIZE = int(os.environ.get('WEBSOCKET_SEND_QUEUE_SIZE', 256))
+WEBSOCKET_COALESCE_MS = float(os.environ.get('WEBSOCKET_COALESCE_MS', 0))
+WEBSOCKET_OVERFLOW_POLICY = os.environ.get('WEBSOCKET_OVERFLOW_POLICY', 'resync')
+
+# Token buckets per member and command type (see SimpleChatApi.ratelimit), rates like '20/10s',
+# an empty rate disables the limit of that command, 'default' applies to the commands not listed.
+# SimpleChatApi.ratelimit.CacheRateLimiter shares the limits between workers through the cache, in fixed windows
+RATE_LIMIT = {
+    'BACKEND': os.environ.get('RATE_LIMIT_BACKEND', 'SimpleChatApi.ratelimit.InMemoryRateLimiter'),
+    'OPTIONS': {},
+    'RATES': {
+        'send-message': os.environ.get('RATE_LIMIT_SEND_MESSAGE', '20/10s'),
+        'get-conv': os.environ.get('RATE_LIMIT_GET_CONV', '50/10s'),
+        'search': os.environ.get('RATE_LIMIT_SEARCH', '10/10s'),
+        'default': os.environ.get('RATE_LIMIT_DEFAULT', '100/10s'),
+    },
+}
+
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
@@ -130,6 +179,56 @@ if USE_IPB:
         }
     })
 
+# connections of the chat database come from a pool of the worker (see SimpleChatApi.pool), at most as many as
+# the threads running database calls unless DB_POOL_SIZE says otherwise: the asgi thread pool (ASGI_THREADS,
+# min(32, cpus + 4) by default) and the presence and unread flush threads
+DB_POOL = (True if _x.lower() == 'true' else False) if (_x := os.environ.get('DB_POOL')) else True
+if DB_POOL:
+    _chat_db = DATABASES['chats' if USE_IPB else 'default']
+    _chat_db['ENGINE'] = {
+        'django.db.backends.mysql': 'SimpleChatApi.pool.mysql',
+        'django.db.backends.sqlite3': 'SimpleChatApi.pool.sqlite3',
+    }[_chat_db['ENGINE']]
+    _chat_db['POOL'] = {
+        'max_size': int(os.environ.get('DB_POOL_SIZE', int(os.environ.get(
+            'ASGI_THREADS', min(32, (os.cpu_count() or 1) + 4))) + 2)),
+        'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        'max_idle': float(os.environ.get('DB_POOL_MAX_IDLE', 300)),
+        'max_lifetime': float(os.environ.get('DB_POOL_MAX_LIFETIME', 3600)),
+        'validate_after': float(os.environ.get('DB_POOL_VALIDATE_AFTER', 1)),
+    }
+
+# read replicas of the chat database, see SimpleChatApi.replicas: hosts of the IPB database,
+# or sqlite files standing in for replicas of db.sqlite3
+DATABASE_REPLICAS = {}
+if _replicas := [_r for _r in os.environ.get('DATABASE_REPLICAS', '').split(',') if _r]:
+    _primary = 'chats' if USE_IPB else 'default'
+    DATABASE_REPLICAS[_primary] = []
+    for _i, _replica in enumerate(_replicas):
+        _alias = f'{_primary}_replica_{_i}'
+        DATABASES[_alias] = {
+            **DATABASES[_primary],
+            **({'HOST': _replica} if USE_IPB else {'NAME': _replica}),
+            'TEST': {'MIRROR': _primary},
+        }
+        DATABASE_REPLICAS[_primary].append(_alias)
+# reads of a member go to the primary for this long after they write, pins are kept in the default cache:
+# point it to redis or memcached when running several workers, the default LocMem cache only pins on one worker
+REPLICA_PIN_SECONDS = float(os.environ.get('REPLICA_PIN_SECONDS', 5))
+
+# archived posts, next to the posts when not used, see core.archive
+if USE_ARCHIVE_DATABASE:
+    DATABASES.update({
+        'archive': {
+            'ENGINE': os.environ.get('ARCHIVE_DATABASE_ENGINE', 'django.db.backends.mysql'),
+            'NAME': os.environ.get('ARCHIVE_DATABASE_NAME'),
+            'USER': os.environ.get('ARCHIVE_DATABASE_USER'),
+            'PASSWORD': os.environ.get('ARCHIVE_DATABASE_PASSWORD'),
+            'HOST': os.environ.get('ARCHIVE_DATABASE_HOST'),
+            'PORT': '',
+        }
+    })
+
 AUTH_USER_MODEL = 'user.User'
 
 AUTH_PASSWORD_VALIDATORS = [
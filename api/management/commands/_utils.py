@@ -0,0 +1,89 @@
+import statistics
+import time
+from contextlib import contextmanager, ExitStack
+from typing import Callable, Dict, List
+
+from django.apps import apps
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+
+from core.models import ConversationPost
+from core.search import SearchUnavailable, get_search_backend
+from core.unread import unread
+from user.presence import presence
+
+
+def ensure_tables(using: str = 'default'):
+    """
+    Create the tables of models that have no migrations (the IPB ones), if they are missing,
+    with the full-text index of the posts.
+    """
+    connection = connections[using]
+    existing = set(connection.introspection.table_names())
+    created = set()
+    with connection.schema_editor() as schema_editor:
+        for model in apps.get_models():
+            if model._meta.db_table not in existing and not model._meta.proxy:
+                schema_editor.create_model(model)
+                existing.add(model._meta.db_table)
+                created.add(model)
+    if ConversationPost in created:
+        # the index of an empty table is cheap, post_migrate ran before the table existed
+        try:
+            get_search_backend(using).install_if_missing()
+        except SearchUnavailable:
+            pass
+
+
+@contextmanager
+def test_database(using: str = 'default'):
+    """
+    Throwaway test database, so benchmarks never touch real data.
+    """
+    connection = connections[using]
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        ensure_tables(using)
+        yield
+    finally:
+        # buffered activity and unread counters belong to the test database
+        presence.flush()
+        unread.flush()
+        unread.clear()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def measure(func: Callable, rounds: int) -> Dict[str, float]:
+    """
+    Call ``func`` ``rounds`` times and summarize its latency (ms) and queries per call, on every database.
+    """
+    timings = []
+    queries = 0
+    for _ in range(rounds):
+        with ExitStack() as stack:
+            captured = [stack.enter_context(CaptureQueriesContext(connection)) for connection in connections.all()]
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+        queries += sum(len(context) for context in captured)
+    total = sum(timings) / 1000
+    return {
+        'rounds': rounds,
+        'mean_ms': round(statistics.mean(timings), 4),
+        'p50_ms': round(percentile(timings, 50), 4),
+        'p95_ms': round(percentile(timings, 95), 4),
+        'p99_ms': round(percentile(timings, 99), 4),
+        'rps': round(rounds / total, 2) if total else 0.0,
+        'queries': round(queries / rounds, 2),
+    }
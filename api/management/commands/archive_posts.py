@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.archive import archive_enabled, archive_posts, ensure_archive_table
+
+
+class Command(BaseCommand):
+    help = 'Move old posts from chatbox_conversations_posts to the archive, in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.POST_ARCHIVE_DAYS,
+                            help='archive posts older than this, POST_ARCHIVE_DAYS by default')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0.1, help='seconds between batches')
+        parser.add_argument('--max-batches', type=int)
+
+    def handle(self, *args, **options):
+        if not archive_enabled():
+            raise CommandError('Set POST_ARCHIVE_DAYS first, reads skip the archive without it')
+        if options['days'] < settings.POST_ARCHIVE_DAYS:
+            raise CommandError('--days can\'t be less than POST_ARCHIVE_DAYS, reads of newer posts skip the archive')
+        ensure_archive_table()
+        moved = archive_posts(options['days'], batch_size=options['batch_size'], pause=options['pause'],
+                              max_batches=options['max_batches'])
+        self.stdout.write(f'Archived {moved} posts')
@@ -0,0 +1,62 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import setup_test_environment
+
+from core.models import ConversationUserMap
+from user.models import User, MemberToken
+from ._utils import measure
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the rest endpoints against the current database, fill it with seed_chat first. ' \
+           'Sending messages writes to the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rounds', type=int, default=100)
+        parser.add_argument('--password', default='password', help='password given to seed_chat')
+        parser.add_argument('--output', help='also write the json report to this file')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        rounds = options['rounds']
+
+        # the member with the most conversations is the worst case for the brief list
+        busiest = ConversationUserMap.objects.values('map_user_id').annotate(n=Count('map_id')).order_by('-n').first()
+        if busiest is None:
+            raise CommandError('No conversations, run seed_chat first')
+        user = User.objects.get(member_id=busiest['map_user_id'])
+        conv_id = ConversationUserMap.objects.filter(map_user_id=user.member_id).values_list('map_con_id',
+                                                                                               flat=True).first()
+        token = MemberToken.objects.create(user=user).token
+        client = Client(HTTP_X_API_KEY=token)
+        anonymous = Client()
+
+        def check(response, expected=200):
+            if response.status_code != expected:
+                raise CommandError(f'{response.request["PATH_INFO"]} returned {response.status_code}')
+
+        endpoints = {
+            'ConversionBriefView.get': lambda: check(client.get('/api/conversation/')),
+            'ConversationView.get': lambda: check(client.get(f'/api/conversation/{conv_id}/')),
+            'ConversationView.post': lambda: check(client.post(
+                f'/api/conversation/{conv_id}/', {'content': 'benchmark'}, content_type='application/json')),
+            'login': lambda: check(anonymous.post(
+                '/api/login/', {'username': user.name, 'password': options['password']},
+                content_type='application/json')),
+            'MemberView.get': lambda: check(client.get(f'/api/user/{user.member_id}/')),
+        }
+        report = {
+            'member_id': user.member_id,
+            'conversations': busiest['n'],
+            'endpoints': {name: measure(func, rounds) for name, func in endpoints.items()},
+        }
+        MemberToken.objects.filter(user=user).delete()
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
@@ -0,0 +1,47 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from api.utils import conversationPage
+from core.models import Conversation, ConversationUserMap
+from user.models import Member
+from websocket.framing import framings
+from websocket.serializers import Response
+from ._utils import measure, test_database
+
+
+class Command(BaseCommand):
+    help = 'Compare the websocket framings on bytes per frame and encode time, for a get-conv page and a single message'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=50, help='posts on the get-conv page')
+        parser.add_argument('--senders', type=int, default=10)
+        parser.add_argument('--rounds', type=int, default=500)
+
+    def handle(self, *args, **options):
+        with test_database():
+            members = [Member.objects.create(name=f'bench{i}', pp_main_photo=f'{i}.png')
+                       for i in range(options['senders'])]
+            conversation = Conversation.objects.create(con_name='bench', con_isGroup=1)
+            ConversationUserMap.objects.bulk_create(
+                ConversationUserMap(map_user_id=member.member_id, map_con_id=conversation.con_id) for member in members)
+            Conversation.post_many([(conversation, f'benchmark message number {i}, with a bit of text',
+                                     members[i % len(members)].member_id) for i in range(options['posts'])])
+            page = conversationPage(conversation, {}, max_size=options['posts'])
+        frames = {
+            'get-conv': Response.response('get-conv', page),
+            'message': Response.response('message', {'chatID': conversation.con_id, 'message': page['messages'][-1]}),
+        }
+
+        report = {}
+        for name, framing in framings.items():
+            report[name] = {}
+            for frame_name, frame in frames.items():
+                text_data, bytes_data = framing.encode(frame)
+                timing = measure(lambda: framing.encode(frame), options['rounds'])
+                report[name][frame_name] = {
+                    'bytes': len(text_data.encode()) if text_data is not None else len(bytes_data),
+                    'encode_mean_us': round(timing['mean_ms'] * 1000, 2),
+                    'encode_p99_us': round(timing['p99_ms'] * 1000, 2),
+                }
+        self.stdout.write(json.dumps(report, indent=2))
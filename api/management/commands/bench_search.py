@@ -0,0 +1,71 @@
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from api.utils import search_posts
+from core.models import ConversationPost, ConversationUserMap
+from core.search import get_search_backend
+from user.models import Member
+from ._utils import measure, test_database
+
+WORDS = ['hello', 'world', 'chat', 'message', 'python', 'django', 'socket', 'search', 'index', 'table',
+         'query', 'server', 'client', 'token', 'random', 'forum', 'member', 'group', 'today', 'tomorrow']
+
+
+class Command(BaseCommand):
+    help = 'Compare the full-text search with a LIKE scan of the messages on a throwaway test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=10_000_000)
+        parser.add_argument('--conversations', type=int, default=1000)
+        parser.add_argument('--memberships', type=int, default=50, help='conversations of the searching member')
+        parser.add_argument('--rounds', type=int, default=20)
+        parser.add_argument('--batch-size', type=int, default=50_000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        # a rare word, so the LIKE scan can't stop early on the first page
+        needle = 'needleword'
+        with test_database():
+            backend = get_search_backend()
+            backend.install()
+            member = Member.objects.create(name='bench')
+            ConversationUserMap.objects.bulk_create(
+                ConversationUserMap(map_user_id=member.member_id, map_con_id=con_id)
+                for con_id in range(1, options['memberships'] + 1))
+
+            start = time.perf_counter()
+            table = ConversationPost._meta.db_table
+            with connection.cursor() as cursor:
+                for offset in range(0, options['posts'], options['batch_size']):
+                    rows = []
+                    for i in range(offset, min(offset + options['batch_size'], options['posts'])):
+                        words = rng.choices(WORDS, k=8)
+                        if i % 10_000 == 0:
+                            words.append(needle)
+                        rows.append((rng.randint(1, options['conversations']), ' '.join(words), member.member_id))
+                    cursor.executemany(
+                        f'INSERT INTO {table} (chat_time, chat_con, chat_content, chat_member_id, chat_ip_address, '
+                        f'chat_fileID) VALUES (0, %s, %s, %s, \'0\', 0)', rows)
+            insert_seconds = time.perf_counter() - start
+
+            def like():
+                list(ConversationPost.objects.filter(
+                    chat_content__contains=needle,
+                    chat_con__in=ConversationUserMap.objects.filter(map_user_id=member.member_id).values('map_con_id'),
+                ).order_by('-chat_id')[:50])
+
+            results = {
+                'posts': options['posts'],
+                'insert_seconds': round(insert_seconds, 2),
+                'fulltext': measure(lambda: search_posts(member.member_id, needle, 1, 50), options['rounds']),
+                'fulltext_common_word': measure(lambda: search_posts(member.member_id, 'hello world', 1, 50),
+                                                options['rounds']),
+                'like': measure(like, options['rounds']),
+            }
+        results['speedup'] = round(results['like']['mean_ms'] / results['fulltext']['mean_ms'], 2)
+        self.stdout.write(json.dumps(results, indent=2))
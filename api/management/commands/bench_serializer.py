@@ -0,0 +1,38 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.serializers import ConversationPostModelSerializer, ConversationPostFastSerializer
+from core.models import ConversationPost
+from user.models import Member
+from ._utils import test_database, measure
+
+
+class Command(BaseCommand):
+    help = 'Compare ConversationPostModelSerializer with ConversationPostFastSerializer on one page of posts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=50, help='posts per page')
+        parser.add_argument('--senders', type=int, default=10, help='distinct senders on the page')
+        parser.add_argument('--rounds', type=int, default=200)
+
+    def handle(self, *args, **options):
+        with test_database():
+            members = [Member.objects.create(name=f'bench{i}', pp_main_photo=f'{i}.png')
+                       for i in range(options['senders'])]
+            ConversationPost.objects.bulk_create([
+                ConversationPost(chat_con=1, chat_content=f'message {i}',
+                                 chat_member_id=members[i % len(members)].member_id)
+                for i in range(options['posts'])
+            ])
+            posts = list(ConversationPost.objects.filter(chat_con=1).order_by('chat_id'))
+
+            results = {
+                'model': measure(lambda: ConversationPostModelSerializer(posts, many=True).data, options['rounds']),
+                'fast': measure(lambda: ConversationPostFastSerializer(posts, many=True).data, options['rounds']),
+            }
+            if json.dumps(ConversationPostModelSerializer(posts, many=True).data) != \
+                    json.dumps(ConversationPostFastSerializer(posts, many=True).data):
+                raise CommandError('Serializers do not give the same output')
+        results['speedup'] = round(results['model']['mean_ms'] / results['fast']['mean_ms'], 2)
+        self.stdout.write(json.dumps(results, indent=2))
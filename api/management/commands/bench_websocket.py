@@ -0,0 +1,94 @@
+import asyncio
+import json
+import statistics
+import time
+
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+
+from SimpleChatApi.asgi import application
+from core.models import Conversation, ConversationUserMap
+from user.models import Member, User, MemberToken
+from ._utils import percentile, test_database
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the get-conv websocket command at several numbers of concurrent sockets, ' \
+           'on a throwaway test database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50, 100])
+        parser.add_argument('--rounds', type=int, default=20, help='get-conv commands per socket')
+        parser.add_argument('--posts', type=int, default=200)
+        parser.add_argument('--timeout', type=float, default=10)
+        parser.add_argument('--output', help='also write the json report to this file')
+
+    def handle(self, *args, **options):
+        with test_database():
+            tokens, conversation = self._seed(max(options['concurrency']), options['posts'])
+            levels = {
+                str(concurrency): asyncio.run(self._level(tokens[:concurrency], conversation.con_id, options))
+                for concurrency in options['concurrency']
+            }
+        report = {'posts': options['posts'], 'rounds': options['rounds'], 'levels': levels}
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+    @staticmethod
+    def _seed(members: int, posts: int):
+        users = []
+        for i in range(members):
+            member = Member.objects.create(name=f'bench{i}')
+            users.append(User.objects.create(member_id=member.member_id, name=member.name,
+                                             email=f'{member.name}@example.com'))
+        conversation = Conversation.objects.create(con_name='bench', con_isGroup=1,
+                                                   con_users=','.join(str(user.member_id) for user in users))
+        ConversationUserMap.objects.bulk_create(
+            ConversationUserMap(map_user_id=user.member_id, map_con_id=conversation.con_id) for user in users)
+        Conversation.post_many([(conversation, f'message {i}', users[i % members].member_id) for i in range(posts)])
+        tokens = [MemberToken.objects.create(user=user).token for user in users]
+        return tokens, conversation
+
+    async def _level(self, tokens, con_id: int, options):
+        sockets = []
+        for token in tokens:
+            communicator = WebsocketCommunicator(application, '/ws/chat/', headers=[(b'x-api-key', token.encode())])
+            connected, _ = await communicator.connect(timeout=options['timeout'])
+            if not connected:
+                raise CommandError('Websocket connection refused')
+            sockets.append(communicator)
+
+        async def run(communicator: WebsocketCommunicator):
+            timings = []
+            for _ in range(options['rounds']):
+                start = time.perf_counter()
+                await communicator.send_json_to({'type': 'get-conv', 'data': {'chatID': con_id}})
+                while (response := await communicator.receive_json_from(timeout=options['timeout']))['type'] \
+                        != 'get-conv':
+                    if response['type'] == 'error':
+                        raise CommandError(f'get-conv failed: {response["data"]}')
+                timings.append((time.perf_counter() - start) * 1000)
+            return timings
+
+        try:
+            start = time.perf_counter()
+            results = await asyncio.gather(*(run(communicator) for communicator in sockets))
+            total = time.perf_counter() - start
+        finally:
+            for communicator in sockets:
+                await communicator.disconnect()
+
+        timings = [timing for result in results for timing in result]
+        return {
+            'sockets': len(sockets),
+            'commands': len(timings),
+            'mean_ms': round(statistics.mean(timings), 4),
+            'p50_ms': round(percentile(timings, 50), 4),
+            'p95_ms': round(percentile(timings, 95), 4),
+            'p99_ms': round(percentile(timings, 99), 4),
+            'rps': round(len(timings) / total, 2) if total else 0.0,
+        }
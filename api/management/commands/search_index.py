@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router
+
+from core.models import ConversationPost
+from core.search import SearchUnavailable, get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Create the full-text index of the messages (FTS5 on SQLite, FULLTEXT on MySQL) and index existing posts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', help='defaults to the database the posts are written to')
+        parser.add_argument('--rebuild', action='store_true', help='index every post again')
+
+    def handle(self, *args, **options):
+        try:
+            backend = get_search_backend(options['database'] or router.db_for_write(ConversationPost))
+        except SearchUnavailable as e:
+            raise CommandError(e)
+        if ConversationPost._meta.db_table not in backend.connection.introspection.table_names():
+            raise CommandError(f'No {ConversationPost._meta.db_table} table on {backend.using}')
+        installed = backend.is_installed()
+        backend.install()
+        if not installed or options['rebuild']:
+            backend.rebuild()
+        self.stdout.write(f'Full-text index ready on {backend.using}')
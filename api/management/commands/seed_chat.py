@@ -0,0 +1,95 @@
+import json
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+
+from core.models import Conversation, ConversationPost, ConversationUserMap
+from user.models import Member, User
+from ._utils import ensure_tables
+
+
+class Command(BaseCommand):
+    help = 'Fill the database with a reproducible synthetic chat dataset, run migrate first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=200)
+        parser.add_argument('--conversations', type=int, default=500)
+        parser.add_argument('--group-ratio', type=float, default=0.2, help='share of group conversations')
+        parser.add_argument('--group-size', type=int, default=20, help='members of a group conversation')
+        parser.add_argument('--posts', type=int, default=100, help='posts per conversation')
+        parser.add_argument('--password', default='password', help='password of every generated user')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--flush', action='store_true', help='delete existing members, users and chats first')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        ensure_tables()
+        if options['flush']:
+            for model in (ConversationPost, ConversationUserMap, Conversation, User, Member):
+                model.objects.all().delete()
+        elif Member.objects.filter(name__startswith='member').exists():
+            # the generated names and emails are the same on every run
+            raise CommandError('The database was already seeded, run again with --flush to replace it')
+
+        now = int(time.time())
+        password = make_password(options['password'])
+        with transaction.atomic():
+            Member.objects.bulk_create([
+                Member(name=f'member{i}', email=f'member{i}@example.com', joined=now, last_visit=now,
+                       last_activity=now, pp_main_photo=f'photos/{i}.png')
+                for i in range(options['members'])
+            ])
+            members = list(Member.objects.filter(name__startswith='member').values_list('member_id', 'name'))
+            User.objects.bulk_create([
+                User(member_id=member_id, name=name, email=f'{name}@example.com', password=password)
+                for member_id, name in members
+            ])
+            member_ids = [member_id for member_id, _ in members]
+
+            group_size = min(options['group_size'], len(member_ids))
+            conversations = []
+            for i in range(options['conversations']):
+                is_group = rng.random() < options['group_ratio']
+                users = rng.sample(member_ids, group_size if is_group else 2)
+                conversations.append(Conversation(
+                    con_starter_id=users[0], con_started_date=now, con_name=f'conversation{i}',
+                    con_isGroup=int(is_group), con_users=','.join(map(str, users)),
+                    con_lastChat=json.dumps({str(user): now for user in users}),
+                ))
+            Conversation.objects.bulk_create(conversations)
+            conversations = list(Conversation.objects.filter(con_name__startswith='conversation'))
+
+            ConversationUserMap.objects.bulk_create([
+                ConversationUserMap(map_user_id=user, map_con_id=conv.con_id,
+                                    map_unread=rng.randint(0, 20), map_update=now - rng.randint(0, 7 * 24 * 3600))
+                for conv in conversations for user in conv.users
+            ], batch_size=1000)
+
+            # bulk_create skips convPostPreSave, so titles and times are set here
+            posts = []
+            for conv in conversations:
+                users = conv.users
+                for j in range(options['posts']):
+                    content = f'message {j} of {conv.con_name}'
+                    posts.append(ConversationPost(
+                        chat_con=conv.con_id, chat_member_id=rng.choice(users), chat_content=content,
+                        chat_time=now - (options['posts'] - j) * 60, chat_title=content,
+                        chat_title_furl=content.replace(' ', '-'),
+                    ))
+            ConversationPost.objects.bulk_create(posts, batch_size=1000)
+
+            last_ids = ConversationPost.objects.filter(chat_con__in=[conv.con_id for conv in conversations]) \
+                .values('chat_con').annotate(last=Max('chat_id'))
+            for row in last_ids:
+                Conversation.objects.filter(con_id=row['chat_con']).update(con_lastID=row['last'])
+
+        self.stdout.write(json.dumps({
+            'members': len(member_ids),
+            'conversations': len(conversations),
+            'maps': ConversationUserMap.objects.count(),
+            'posts': len(posts),
+        }))
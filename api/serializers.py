@@ -1,6 +1,9 @@
+from typing import List, Optional, Union
+
 from rest_framework import serializers
 
 from core.models import ConversationPost
+from core.pagination import decode_cursor, decode_sync_token
 from user.models import Member
 
 
@@ -9,9 +12,16 @@ class UserGetSerializer(serializers.Serializer):
 
 
 class ConversationGetSerializer(serializers.Serializer):
+    cursor = serializers.CharField(required=False, max_length=64)
     loadFrom = serializers.IntegerField(required=False, min_value=1)
     loadTo = serializers.IntegerField(required=False, min_value=1)
-    lastUpdate = serializers.IntegerField(required=True)
+    lastUpdate = serializers.IntegerField(required=False)
+
+    def validate_cursor(self, value):
+        try:
+            return decode_cursor(value)
+        except ValueError:
+            raise serializers.ValidationError('Invalid cursor')
 
 
 class ConversationSendSerializer(serializers.Serializer):
@@ -32,7 +42,7 @@ class MemberModelSerializer(serializers.ModelSerializer):
 class ConversationPostModelSerializer(serializers.ModelSerializer):
     id = serializers.IntegerField(source='chat_id', read_only=True)
     content = serializers.CharField(source='chat_content', read_only=True)
-    sender = MemberModelSerializer(source='chat_member_id', read_only=True)
+    sender = MemberModelSerializer(source='member', read_only=True)
 
     class Meta:
         model = ConversationPost
@@ -40,6 +50,85 @@ class ConversationPostModelSerializer(serializers.ModelSerializer):
         read_only_fields = ('chat_time', 'chat_sys')
 
 
+class ConversationPostFastSerializer:
+    """
+    Read only drop-in for ``ConversationPostModelSerializer`` giving the same output.
+
+    Senders of all the posts are fetched in one query and the dicts are built directly,
+    without going through the per field machinery of DRF.
+    """
+
+    def __init__(self, instance, many: bool = False):
+        self.instance = instance
+        self.many = many
+
+    @staticmethod
+    def member_to_dict(member: Optional[Member]) -> Optional[dict]:
+        if member is None:
+            return None
+        return {
+            'id': member.member_id,
+            'username': member.name,
+            'avatar': member.pp_main_photo,
+            'last_visit': member.last_visit,
+            'last_activity': member.last_activity,
+        }
+
+    @staticmethod
+    def post_to_dict(post: ConversationPost, sender: Optional[dict]) -> dict:
+        return {
+            'id': post.chat_id,
+            'chat_time': post.chat_time,
+            'content': post.chat_content,
+            'sender': sender,
+            'chat_sys': post.chat_sys,
+        }
+
+    @property
+    def data(self) -> Union[dict, List[dict]]:
+        posts: List[ConversationPost] = list(self.instance) if self.many else [self.instance]
+        senders = {
+            member_id: self.member_to_dict(member)
+            for member_id, member in Member.objects.in_bulk({post.chat_member_id for post in posts}).items()
+        } if posts else {}
+        ret = [self.post_to_dict(post, senders.get(post.chat_member_id)) for post in posts]
+        return ret if self.many else ret[0]
+
+
+class ConversationPageSerializer(serializers.Serializer):
+    messages = ConversationPostModelSerializer(many=True, read_only=True)
+    next = serializers.CharField(read_only=True, allow_null=True)
+    prev = serializers.CharField(read_only=True, allow_null=True)
+
+
+class SearchSerializer(serializers.Serializer):
+    q = serializers.CharField(required=True, max_length=255)
+    page = serializers.IntegerField(required=False, min_value=1, default=1)
+    chatID = serializers.IntegerField(required=False, min_value=1)
+
+
+class SearchResultSerializer(serializers.Serializer):
+    chatID = serializers.IntegerField(read_only=True)
+    score = serializers.FloatField(read_only=True)
+    message = ConversationPostModelSerializer(read_only=True)
+
+
+class SearchPageSerializer(serializers.Serializer):
+    results = SearchResultSerializer(many=True, read_only=True)
+    next = serializers.IntegerField(read_only=True, allow_null=True)
+
+
+class SyncSerializer(serializers.Serializer):
+    # one cursor per conversation with posts
+    token = serializers.CharField(required=False, max_length=16384)
+
+    def validate_token(self, value):
+        try:
+            return decode_sync_token(value)
+        except ValueError:
+            raise serializers.ValidationError('Invalid token')
+
+
 class LoginSerializer(serializers.Serializer):
     username = serializers.CharField(required=True, max_length=255)
     password = serializers.CharField(required=True, max_length=255)
@@ -65,7 +154,18 @@ class ConversationInfoSerializer(serializers.Serializer):
     isGroup = serializers.BooleanField(required=True)
     isOnline = serializers.BooleanField(required=True)
     lastMsg = serializers.CharField(required=True, max_length=255, allow_null=True)
+    lastMsgID = serializers.IntegerField(required=True, min_value=1, allow_null=True)
     lastMsgTime = serializers.IntegerField(required=True, min_value=1, allow_null=True)
     title = serializers.CharField(required=True, max_length=255)
     unread = serializers.IntegerField(required=True, min_value=0)
     update = serializers.IntegerField(required=True, min_value=1)
+
+
+class SyncConversationSerializer(ConversationInfoSerializer):
+    messages = ConversationPostModelSerializer(many=True, read_only=True)
+    prev = serializers.CharField(read_only=True, allow_null=True)
+
+
+class SyncResponseSerializer(serializers.Serializer):
+    conversations = SyncConversationSerializer(many=True, read_only=True)
+    token = serializers.CharField(read_only=True)
@@ -1,3 +1,455 @@
-from django.test import TestCase
+import re
+import threading
+import time
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import http_date
+
+from SimpleChatApi.metrics import Counter, Gauge, Histogram, registry
+from SimpleChatApi.ratelimit import CacheRateLimiter, InMemoryRateLimiter, parse_rate
+from api.management.commands._utils import ensure_tables
+from api.serializers import ConversationPostFastSerializer, ConversationPostModelSerializer
+from api.utils import SyncMaxPosts, search_posts
+from core.archive import archive_cutoff, archive_posts, ensure_archive_table
+from core.models import Conversation, ConversationPost, ConversationUserMap, PageSize
+from core.pagination import AFTER, BEFORE, decode_cursor, encode_cursor
+from core.unread import unread
+from user.cache import token_cache
+from user.models import Member, MemberToken, User
+
+
+class ApiTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # the IPB tables have no migrations
+        ensure_tables()
+        super().setUpClass()
+
+    def setUp(self):
+        token_cache.clear()
+        # every test starts with full buckets
+        patcher = mock.patch('SimpleChatApi.ratelimit._limiter', InMemoryRateLimiter(settings.RATE_LIMIT['RATES']))
+        self.limiter = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.members = [Member.objects.create(name=f'member{i}') for i in range(2)]
+        self.users = [User.objects.create(member_id=member.pk, name=member.name, email=f'{member.name}@example.com')
+                      for member in self.members]
+        self.tokens = [MemberToken.objects.create(user=user).token for user in self.users]
+        self.conversation = Conversation.objects.create(con_name='group', con_users='', con_isGroup=1)
+        for member in self.members:
+            ConversationUserMap.objects.create(map_user_id=member.pk, map_con_id=self.conversation.pk)
+
+    def get(self, path: str, data: dict = None, member: int = 0, **kwargs):
+        return self.client.get(path, data, HTTP_X_API_KEY=self.tokens[member], **kwargs)
+
+    def post(self, path: str, data: dict, member: int = 0):
+        return self.client.post(path, data, content_type='application/json', HTTP_X_API_KEY=self.tokens[member])
+
+
+class TokenCacheTest(ApiTestCase):
+    def test_cached(self):
+        self.assertEqual(self.get('/api/conversation/').status_code, 200)
+        hits = token_cache.stats()['hits']
+        self.assertEqual(self.get('/api/conversation/').status_code, 200)
+        self.assertEqual(token_cache.stats()['hits'], hits + 1)
+
+    def test_logout(self):
+        self.assertEqual(self.get('/api/conversation/').status_code, 200)
+        self.assertEqual(self.post('/api/logout/', {}).status_code, 200)
+        self.assertIsNone(token_cache.get(self.tokens[0]))
+        self.assertEqual(self.get('/api/conversation/').status_code, 403)
+
+    def test_logout_all_devices(self):
+        other = MemberToken.objects.create(user=self.users[0]).token
+        self.assertEqual(self.client.get('/api/conversation/', HTTP_X_API_KEY=other).status_code, 200)
+        self.assertEqual(self.post('/api/logout/', {'allDevices': True}).status_code, 200)
+        self.assertEqual(self.client.get('/api/conversation/', HTTP_X_API_KEY=other).status_code, 403)
+
+    def test_banned(self):
+        self.assertEqual(self.get('/api/conversation/').status_code, 200)
+        self.users[0].banned = True
+        self.users[0].save()
+        self.assertEqual(self.get('/api/conversation/').status_code, 403)
+
+    def test_load_racing_an_invalidation(self):
+        real_get = MemberToken.objects.select_related('user').get
+
+        def get(**kwargs):
+            # read before the ban, the ban is saved before the load caches the user
+            user = real_get(**kwargs)
+            self.users[0].banned = True
+            self.users[0].save()
+            return user
+
+        with mock.patch('django.db.models.query.QuerySet.get', side_effect=get):
+            self.assertFalse(token_cache.load(self.tokens[0]).banned)
+        self.assertIsNone(token_cache.get(self.tokens[0]))
+        self.assertEqual(self.get('/api/conversation/').status_code, 403)
+
+
+class BriefTest(ApiTestCase):
+    def add_conversations(self, count: int):
+        for i in range(count):
+            group = Conversation.objects.create(con_name=f'group {i}', con_users='', con_isGroup=1)
+            direct = Conversation.objects.create(con_name=f'direct {i}', con_users='', con_isGroup=0)
+            for conversation in (group, direct):
+                for member in self.members:
+                    ConversationUserMap.objects.create(map_user_id=member.pk, map_con_id=conversation.pk)
+                conversation.post(f'hello {i}', self.members[1].pk)
+
+    def queries(self) -> int:
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get('/api/conversation/').status_code, 200)
+        return len(queries)
+
+    def test_constant_queries(self):
+        self.add_conversations(1)
+        # the first request caches the token
+        self.queries()
+        few = self.queries()
+        self.add_conversations(10)
+        self.assertEqual(self.queries(), few)
+
+    def test_briefs(self):
+        self.add_conversations(1)
+        self.members[1].pp_main_photo = 'photo.png'
+        self.members[1].save()
+        briefs = {brief['title']: brief for brief in self.get('/api/conversation/').json()}
+        self.assertEqual(set(briefs), {'group 0', 'direct 0'})
+        self.assertTrue(briefs['group 0']['isGroup'])
+        self.assertIsNone(briefs['group 0']['icon'])
+        self.assertEqual(briefs['direct 0']['icon'], self.members[1].profile_photo)
+        self.assertEqual(briefs['direct 0']['lastMsg'], 'hello 0')
+
+
+class PostSerializerTest(ApiTestCase):
+    def test_senders_in_one_query(self):
+        for i in range(10):
+            self.conversation.post(f'message {i}', self.members[i % 2].pk)
+        # a sender that is gone
+        self.conversation.post('orphan', 10 ** 6)
+        posts = list(ConversationPost.objects.filter(chat_con=self.conversation.pk).order_by('chat_id'))
+        with self.assertNumQueries(1):
+            data = ConversationPostFastSerializer(posts, many=True).data
+        self.assertEqual([dict(item) for item in ConversationPostModelSerializer(posts, many=True).data], data)
+        self.assertEqual(data[0]['sender']['id'], self.members[0].pk)
+        self.assertIsNone(data[-1]['sender'])
+        self.assertEqual(ConversationPostFastSerializer(posts[0]).data, data[0])
+
+
+class InstrumentationTest(ApiTestCase):
+    def test_server_timing(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get('/api/conversation/')
+        match = re.fullmatch(r'db;dur=[\d.]+;desc="(\d+) queries", total;dur=[\d.]+', response['Server-Timing'])
+        self.assertIsNotNone(match)
+        self.assertEqual(int(match.group(1)), len(queries))
+
+    def test_slow_log(self):
+        with mock.patch('SimpleChatApi.instrumentation.SLOW_REQUEST_MS', 0.001), \
+                self.assertLogs('SimpleChatApi.instrumentation', 'WARNING') as logs:
+            self.get('/api/conversation/')
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('Slow GET /api/conversation/', logs.output[0])
+        self.assertIn('FROM "chatbox_conversations_user_map"', logs.output[0])
+
+        with mock.patch('SimpleChatApi.instrumentation.SLOW_REQUEST_MS', 0), \
+                self.assertNoLogs('SimpleChatApi.instrumentation', 'WARNING'):
+            self.get('/api/conversation/')
+
+
+class ConditionalGetTest(ApiTestCase):
+    def test_conversations(self):
+        self.conversation.post('hello', self.members[1].pk)
+        response = self.get('/api/conversation/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.get('/api/conversation/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        self.conversation.post('again', self.members[1].pk)
+        response = self.get('/api/conversation/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_conversations_body_changes(self):
+        self.conversation.post('hello', self.members[1].pk)
+        etag = self.get('/api/conversation/')['ETag']
+
+        Conversation.objects.filter(pk=self.conversation.pk).update(con_name='renamed')
+        response = self.get('/api/conversation/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        # counted in memory, not flushed yet
+        with mock.patch.object(unread, 'get', lambda member_id, con_id, stored: stored + 1):
+            response = self.get('/api/conversation/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]['unread'], 1)
+
+    def test_conversation(self):
+        self.conversation.post('hello', self.members[1].pk)
+        path = f'/api/conversation/{self.conversation.pk}/'
+        etag = self.get(path)['ETag']
+        self.assertEqual(self.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # the validators depend on the page
+        self.assertEqual(self.get(path, {'cursor': encode_cursor(1, AFTER)}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        self.conversation.post('again', self.members[0].pk)
+        self.assertEqual(self.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_conversation_with_invalid_last_chat(self):
+        Conversation.objects.filter(pk=self.conversation.pk).update(con_lastChat='{"1": "x", "2": null, "3": 1000000}')
+        response = self.get(f'/api/conversation/{self.conversation.pk}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Last-Modified'], http_date(1000000))
+
+    def test_if_modified_since(self):
+        ConversationUserMap.objects.filter(map_user_id=self.members[0].pk).update(map_update=1000000)
+        response = self.get('/api/conversation/')
+        self.assertEqual(response['Last-Modified'], http_date(1000000))
+        self.assertEqual(self.get('/api/conversation/', HTTP_IF_MODIFIED_SINCE=http_date(1000000)).status_code, 304)
+
+        # a change later in the current second would keep the same date
+        now = int(time.time())
+        ConversationUserMap.objects.filter(map_user_id=self.members[0].pk).update(map_update=now)
+        self.assertEqual(self.get('/api/conversation/', HTTP_IF_MODIFIED_SINCE=http_date(now)).status_code, 200)
+
+
+class CursorTest(ApiTestCase):
+    def test_pages(self):
+        ids = [self.conversation.post(f'message {i}', self.members[0].pk).chat_id for i in range(PageSize + 10)]
+        path = f'/api/conversation/{self.conversation.pk}/'
+        page = self.get(path).json()
+        self.assertEqual([message['id'] for message in page['messages']], ids[-PageSize:])
+
+        older = self.get(path, {'cursor': page['prev']}).json()
+        self.assertEqual([message['id'] for message in older['messages']], ids[:10])
+        self.assertIsNone(older['prev'])
+        self.assertEqual(decode_cursor(page['next']), (AFTER, ids[-1]))
+
+        newer = self.get(path, {'cursor': encode_cursor(ids[-3], AFTER)}).json()
+        self.assertEqual([message['id'] for message in newer['messages']], ids[-2:])
+
+    def test_invalid_cursor(self):
+        response = self.get(f'/api/conversation/{self.conversation.pk}/', {'cursor': 'not a cursor'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.get(f'/api/conversation/{self.conversation.pk}/',
+                                  {'cursor': encode_cursor(1, BEFORE)}).json()['prev'], None)
+
+
+class SyncTest(ApiTestCase):
+    def test_sync(self):
+        other = Conversation.objects.create(con_name='other', con_users='', con_isGroup=1)
+        ConversationUserMap.objects.create(map_user_id=self.members[0].pk, map_con_id=other.pk)
+        ids = [self.conversation.post(f'message {i}', self.members[1].pk).chat_id for i in range(SyncMaxPosts + 5)]
+        other_id = other.post('other', self.members[0].pk).chat_id
+
+        first = self.get('/api/sync/').json()
+        conversations = {conversation['id']: conversation for conversation in first['conversations']}
+        # the newest posts of every conversation, with a cursor to the older ones
+        self.assertEqual([message['id'] for message in conversations[self.conversation.pk]['messages']], ids[-SyncMaxPosts:])
+        self.assertEqual(decode_cursor(conversations[self.conversation.pk]['prev']), (BEFORE, ids[-SyncMaxPosts]))
+        self.assertEqual([message['id'] for message in conversations[other.pk]['messages']], [other_id])
+        self.assertIsNone(conversations[other.pk]['prev'])
+
+        second = self.get('/api/sync/', {'token': first['token']}).json()
+        self.assertEqual([message for conversation in second['conversations']
+                          for message in conversation['messages']], [])
+
+        new_id = other.post('new', self.members[1].pk).chat_id
+        third = self.get('/api/sync/', {'token': second['token']}).json()
+        self.assertEqual({conversation['id']: [message['id'] for message in conversation['messages']]
+                          for conversation in third['conversations'] if conversation['messages']},
+                         {other.pk: [new_id]})
+
+    def test_post_committed_late(self):
+        late = self.conversation.post('late', self.members[1].pk)
+        other = Conversation.objects.create(con_name='other', con_users='', con_isGroup=1)
+        ConversationUserMap.objects.create(map_user_id=self.members[0].pk, map_con_id=other.pk)
+        newer = other.post('newer', self.members[1].pk)
+        # the late post is not committed yet when the client syncs
+        ConversationPost.objects.filter(chat_id=late.chat_id).delete()
+        Conversation.objects.filter(pk=self.conversation.pk).update(con_lastID=0)
+        first = self.get('/api/sync/').json()
+        self.assertEqual([message['id'] for conversation in first['conversations']
+                          for message in conversation['messages']], [newer.chat_id])
+
+        late.save(force_insert=True)
+        Conversation.objects.filter(pk=self.conversation.pk).update(con_lastID=late.chat_id)
+        second = self.get('/api/sync/', {'token': first['token']}).json()
+        self.assertEqual([message['id'] for conversation in second['conversations']
+                          for message in conversation['messages']], [late.chat_id])
+
+    def test_invalid_token(self):
+        self.assertEqual(self.get('/api/sync/', {'token': 'not a token'}).status_code, 400)
+
+
+@override_settings(POST_ARCHIVE_DAYS=30, POST_ARCHIVE_BOUNDARY_CACHE=None)
+class ArchiveSearchTest(ApiTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        ensure_archive_table()
+
+    def test_archived_hits_follow_the_ranked_ones(self):
+        archived = [self.conversation.post(f'needle {i}', self.members[1].pk).chat_id for i in range(4)]
+        ConversationPost.objects.update(chat_time=archive_cutoff() - 60)
+        archive_posts(30, pause=0)
+        hot = [archived.pop()] + [self.conversation.post(f'needle hot {i}', self.members[1].pk).chat_id
+                                  for i in range(2)]
+
+        pages = [search_posts(self.members[0].pk, 'needle', page, 2) for page in (1, 2, 3)]
+        self.assertEqual([page['next'] for page in pages], [2, 3, None])
+        results = [result for page in pages for result in page['results']]
+        self.assertEqual(sorted(result['message']['id'] for result in results[:3]), hot)
+        self.assertEqual([result['message']['id'] for result in results[3:]], archived[::-1])
+        self.assertEqual({result['score'] for result in results[3:]}, {0})
+        self.assertEqual(search_posts(self.members[0].pk, 'needle', 1, 2, con_id=self.conversation.pk + 1),
+                         {'results': [], 'next': None})
+
+
+class RateLimitTest(ApiTestCase):
+    def test_rest(self):
+        self.limiter.rates = {'get-conv': parse_rate('2/1h')}
+        path = f'/api/conversation/{self.conversation.pk}/'
+        self.assertEqual(self.get(path).status_code, 200)
+        self.assertEqual(self.get(path).status_code, 200)
+        response = self.get(path)
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 0)
+        # per member and per command
+        self.assertEqual(self.get(path, member=1).status_code, 200)
+        self.assertEqual(self.get('/api/conversation/').status_code, 200)
+
+
+class RateLimiterTest(SimpleTestCase):
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('20/10s'), (20, 2))
+        self.assertEqual(parse_rate('60/m'), (60, 1))
+        self.assertIsNone(parse_rate(''))
+        with self.assertRaises(ValueError):
+            parse_rate('20 per second')
+
+    def test_bucket(self):
+        limiter = InMemoryRateLimiter({'send-message': '2/1s', 'default': None})
+        self.assertEqual(limiter.check(1, 'send-message'), 0)
+        self.assertEqual(limiter.check(1, 'send-message'), 0)
+        self.assertAlmostEqual(limiter.check(1, 'send-message'), 0.5, delta=0.05)
+        self.assertEqual(limiter.check(2, 'send-message'), 0)
+        # no rate, no limit
+        self.assertEqual(limiter.check(1, 'get-conv'), 0)
+
+        time.sleep(0.55)
+        self.assertEqual(limiter.check(1, 'send-message'), 0)
+
+    def test_lru(self):
+        limiter = InMemoryRateLimiter({'default': '1/1h'}, max_size=2)
+        for member_id in (1, 2, 3):
+            limiter.check(member_id, 'search')
+        # the bucket of member 1 was dropped, it is full again
+        self.assertEqual(limiter.check(1, 'search'), 0)
+        self.assertGreater(limiter.check(3, 'search'), 0)
+
+    def test_cache_window(self):
+        caches['default'].clear()
+        limiter = CacheRateLimiter({'default': '2/1s'})
+        with mock.patch('SimpleChatApi.ratelimit.time.time', return_value=1000.25):
+            self.assertEqual(limiter.check(1, 'search'), 0)
+            self.assertEqual(limiter.check(1, 'search'), 0)
+            self.assertAlmostEqual(limiter.check(1, 'search'), 0.75)
+        with mock.patch('SimpleChatApi.ratelimit.time.time', return_value=1001.0):
+            self.assertEqual(async_to_sync(limiter.acheck)(1, 'search'), 0)
+
+    def test_cache_shared_by_workers(self):
+        caches['default'].clear()
+        workers = [CacheRateLimiter({'default': '1/1h'}) for _ in range(2)]
+        self.assertEqual(workers[0].check(1, 'search'), 0)
+        self.assertGreater(workers[1].check(1, 'search'), 0)
+
+
+class SeedChatTest(TransactionTestCase):
+    """
+    The command opens the schema editor, which sqlite refuses inside the transaction of a TestCase
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        # the IPB tables have no migrations
+        ensure_tables()
+        super().setUpClass()
+
+    def test_rerun(self):
+        options = {'members': 3, 'conversations': 2, 'group_size': 3, 'posts': 2, 'stdout': StringIO()}
+        call_command('seed_chat', **options)
+        with self.assertRaisesMessage(CommandError, '--flush'):
+            call_command('seed_chat', **options)
+        call_command('seed_chat', flush=True, **options)
+        self.assertEqual(Member.objects.count(), 3)
+        self.assertEqual(ConversationPost.objects.count(), 4)
+
+
+class MetricsTest(SimpleTestCase):
+    def metric(self, metric):
+        self.addCleanup(registry.remove, metric)
+        return metric
+
+    def test_counter(self):
+        counter = self.metric(Counter('test_total', 'Test counter', ('command',)))
+        counter.inc('sync')
+        # every thread counts in its own shard
+        thread = threading.Thread(target=counter.inc, args=('sync',), kwargs={'amount': 2})
+        thread.start()
+        thread.join()
+        counter.inc('search')
+        self.assertEqual(counter.render(), [
+            '# HELP test_total Test counter',
+            '# TYPE test_total counter',
+            'test_total{command="search"} 1',
+            'test_total{command="sync"} 3',
+        ])
+
+    def test_histogram(self):
+        histogram = self.metric(Histogram('test_seconds', 'Test histogram', buckets=(0.1, 1)))
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.observe(value)
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Test histogram',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 6.05',
+            'test_seconds_count 4',
+        ])
+
+    def test_view(self):
+        self.metric(Gauge('test_gauge', 'Test gauge')).dec()
+        response = self.client.get('/metrics', REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        lines = response.content.decode().splitlines()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', lines)
+        self.assertIn('test_gauge -1', lines)
+
+    def test_view_is_gated(self):
+        with mock.patch('SimpleChatApi.metrics.METRICS_TOKEN', 'secret'):
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.1').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.1',
+                                             HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.1',
+                                             HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+        # without a token only the allowed addresses are
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.1',
+                                         HTTP_AUTHORIZATION='Bearer ').status_code, 403)
@@ -1,10 +1,13 @@
 from django.urls import path
 
-from api.views import MemberView, ConversationView, login, ConversionBriefView
+from api.views import MemberView, ConversationView, login, logout, ConversionBriefView, SearchView, SyncView
 
 urlpatterns = [
     path('user/<int:member_id>/', MemberView.as_view()),
     path('conversation/', ConversionBriefView.as_view()),
     path('conversation/<int:pk>/', ConversationView.as_view()),
+    path('search/', SearchView.as_view()),
+    path('sync/', SyncView.as_view()),
     path('login/', login),
+    path('logout/', logout),
 ]
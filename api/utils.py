@@ -1,14 +1,33 @@
+import hashlib
+import json
+import math
+import os
 import time
-from typing import List, Union, Optional, Coroutine, Any, Awaitable
+from collections import defaultdict
+from typing import Dict, List, Union, Optional, Coroutine, Any, Awaitable, Tuple
 
-from channels.db import database_sync_to_async
-from django.db.models import QuerySet
+from django.db.models import QuerySet, Exists, OuterRef, Subquery
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework import status
 from rest_framework.request import Request
+from rest_framework.response import Response
 
-from api.serializers import ConversationPostModelSerializer, ConversationInfoSerializer
-from core.models import ConversationUserMap, Conversation
+from SimpleChatApi.metrics import database_sync_to_async
+from SimpleChatApi.ratelimit import get_rate_limiter
+from api.serializers import ConversationInfoSerializer, ConversationPostFastSerializer, ErrorSerializer
+from core.archive import archive_enabled, search_archive
+from core.models import ConversationUserMap, Conversation, ConversationPost
+from core.pagination import BEFORE, encode_cursor, encode_sync_token
+from core.search import get_search_backend
+from core.unread import unread
 from user.models import Member, User
 
+SyncMaxPosts = int(os.environ.get('SYNC_MAX_POSTS', 20))
+# conversations per query of the sync posts
+SyncChunkSize = int(os.environ.get('SYNC_CHUNK_SIZE', 100))
+
 
 # from https://stackoverflow.com/questions/19773869/django-rest-framework-separate-permissions-per-methods
 def method_permission_classes(classes):
@@ -24,56 +43,183 @@ def method_permission_classes(classes):
     return decorator
 
 
+def method_rate_limit(command: str):
+    """
+    Token bucket of the member for ``command``, shared with the websocket command of the same type.
+    Put it under ``method_permission_classes``, it needs the authenticated member.
+    """
+    def decorator(func):
+        def decorated_func(self, request, *args, **kwargs):
+            if retry_after := get_rate_limiter().check(request.user.member_id, command):
+                response = Response(ErrorSerializer({'error': 'Too many requests'}).data,
+                                    status=status.HTTP_429_TOO_MANY_REQUESTS)
+                response['Retry-After'] = str(math.ceil(retry_after))
+                return response
+            return func(self, request, *args, **kwargs)
+
+        return decorated_func
+
+    return decorator
+
+
 def getConvIcon(user_id: int, conv_id: int) -> Optional[str]:
     conv = Conversation.objects.get(con_id=conv_id)
     if conv.isGroup():
         # TODO: get icon for group
         return None
     else:
-        users_id = conv.users
+        other_id = ConversationUserMap.objects.filter(map_con_id=conv_id).exclude(map_user_id=user_id) \
+            .values_list('map_user_id', flat=True).first()
         try:
-            users_id.remove(user_id)
-            return Member.objects.get(member_id=users_id[0]).profile_photo
-        except ValueError or IndexError:
+            return Member.objects.get(member_id=other_id).profile_photo if other_id else None
+        except Member.DoesNotExist:
             return None
 
 
-def conversationMapToBriefByID(
+def conversationMapToBriefBulk(
         user_id: int,
         data: Union[QuerySet[ConversationUserMap], List[ConversationUserMap]]
-):
+) -> List:
+    """
+    Build conversation briefs for ``user_id`` with a fixed number of queries,
+    independent of how many conversations are in ``data``:
+    maps, conversations, last posts and the other members of 1 to 1 conversations.
+    """
+    maps: List[ConversationUserMap] = list(data)
+    if not maps:
+        return []
+
+    conversations = Conversation.objects.in_bulk({_map.map_con_id for _map in maps})
+    last_posts = ConversationPost.objects.in_bulk(
+        {conv.con_lastID for conv in conversations.values() if conv.con_lastID})
+
+    other_member_ids = {}
+    one_to_one = [conv.con_id for conv in conversations.values() if not conv.isGroup()]
+    if one_to_one:
+        for con_id, member_id in ConversationUserMap.objects.filter(map_con_id__in=one_to_one) \
+                .exclude(map_user_id=user_id).values_list('map_con_id', 'map_user_id'):
+            other_member_ids.setdefault(con_id, member_id)
+    members = Member.objects.in_bulk(set(other_member_ids.values())) if other_member_ids else {}
+
+    now = time.time()
     ret = []
-    for _conv in data:
-        conv: Conversation = _conv.conversation
-        if last_post := conv.last_post:
-            ret.append(
-                ConversationInfoSerializer(
-                    icon=getConvIcon(user_id, _conv.map_con_id),
-                    id=_conv.map_con_id,
-                    inDay=24 * 60 * 60 > (time.time() - _conv.map_update),
-                    isGroup=conv.isGroup(),
-                    isOnline=1 == _conv.map_online,
-                    lastMsg=last_post.chat_content,
-                    lastMsgID=last_post.chat_id,
-                    lastMsgTime=last_post.chat_time,
-                    title=conv.con_name,
-                    unread=_conv.map_unread,
-                    update=_conv.map_update,
-                ).data
-            )
-    return ret
+    for _map in maps:
+        update = unread.updated(user_id, _map.map_con_id, _map.map_update)
+        conv = conversations.get(_map.map_con_id)
+        if conv is None or (last_post := last_posts.get(conv.con_lastID)) is None:
+            continue
+        member = members.get(other_member_ids.get(conv.con_id))
+        ret.append({
+            'icon': member.profile_photo if member and member.pp_main_photo else None,
+            'id': _map.map_con_id,
+            'inDay': 24 * 60 * 60 > (now - update),
+            'isGroup': conv.isGroup(),
+            'isOnline': 1 == _map.map_online,
+            'lastMsg': last_post.chat_content,
+            'lastMsgID': last_post.chat_id,
+            'lastMsgTime': last_post.chat_time,
+            'title': conv.con_name,
+            'unread': unread.get(user_id, _map.map_con_id, _map.map_unread),
+            'update': update,
+        })
+    return ConversationInfoSerializer(ret, many=True).data
+
+
+def briefValidators(member_id: int, maps: List[ConversationUserMap], briefs: List) -> Tuple[str, int]:
+    """
+    ETag and last modification time of the conversation briefs of ``member_id``: the ETag hashes the briefs
+    themselves, so titles, icons and the unread counters not flushed yet change it as they change the body.
+    The modification time is the newest ``map_update`` of ``maps``, with the updates not flushed yet.
+    """
+    update = max((unread.updated(member_id, _map.map_con_id, _map.map_update) for _map in maps), default=0)
+    digest = hashlib.md5(json.dumps(briefs, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    return quote_etag(f"b{update}-{digest}"), update
+
+
+def lastChatTime(conversation: Conversation) -> int:
+    """
+    :return: newest time of ``con_lastChat``, the entries that are not timestamps are skipped
+    """
+    try:
+        values = conversation.lastChat.values()
+    except (ValueError, AttributeError):
+        return 0
+    times = []
+    for value in values:
+        try:
+            times.append(int(value))
+        except (TypeError, ValueError):
+            pass
+    return max(times, default=0)
+
+
+def conversationValidators(conversation: Conversation, data: dict) -> Tuple[str, int]:
+    """
+    ETag and last modification time of a page of ``conversation``, from the already loaded conversation:
+    its newest post and the validated page parameters.
+    """
+    params = hashlib.md5(repr(sorted(data.items())).encode()).hexdigest()[:16]
+    return quote_etag(f"c{conversation.con_id}-{conversation.con_lastID}-{params}"), lastChatTime(conversation)
+
+
+def notModified(request: Request, etag: str, last_modified: int) -> Optional[HttpResponse]:
+    """
+    304 (or 412) response if the conditional headers of the request match the validators, None otherwise
+    """
+    # Last-Modified has a one second resolution, a change later in the current second would keep the same date
+    checked_modified = last_modified if last_modified and last_modified < int(time.time()) else None
+    if (response := get_conditional_response(request, etag=etag, last_modified=checked_modified)) is None:
+        return None
+    return withValidators(response, etag, last_modified)
+
+
+def withValidators(response: HttpResponse, etag: str, last_modified: int) -> HttpResponse:
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    # validators depend on the authenticated user
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def conversationMapToBriefByID(
+        user_id: int,
+        data: Union[QuerySet[ConversationUserMap], List[ConversationUserMap]]
+) -> List:
+    return conversationMapToBriefBulk(user_id, data)
 
 
 def conversationMapToBrief(
         user: User,
         data: Union[QuerySet[ConversationUserMap], List[ConversationUserMap]]
 ) -> List:
-    return conversationMapToBriefByID(user.member_id, data)
+    return conversationMapToBriefBulk(user.member_id, data)
+
+
+def conversationPage(conversation: Conversation, data: dict, max_size: int) -> dict:
+    """
+    Serialized page of ``conversation`` for the validated data of a ``ConversationGetSerializer``.
+
+    ``loadFrom``, ``loadTo`` and ``lastUpdate`` are still honoured when no cursor is given,
+    they just don't return cursors.
+    """
+    cursor = data.get('cursor')
+    load_from = data.get('loadFrom')
+    load_to = data.get('loadTo')
+    last_update = data.get('lastUpdate')
+    if cursor is None and (load_from or load_to or last_update is not None):
+        posts = conversation.get_posts(load_from=load_from, load_to=load_to, last_update=last_update,
+                                       order_by='chat_id', max_size=max_size)
+        page = {'messages': posts, 'next': None, 'prev': None}
+    else:
+        page = conversation.get_page(cursor=cursor, max_size=max_size)
+    page['messages'] = ConversationPostFastSerializer(page['messages'], many=True).data
+    return page
 
 
 @database_sync_to_async
 def postSerializerAsync(posts, *args, **kwargs):
-    return ConversationPostModelSerializer(posts, *args, **kwargs).data
+    return ConversationPostFastSerializer(posts, *args, **kwargs).data
 
 
 def get_conv(
@@ -87,11 +233,133 @@ def get_conv(
         else:
             user = user_or_request
 
-        conversation = Conversation.objects.get(con_id=pk)
-        conversation.users.index(user.member_id)
+        # one indexed query for both the conversation and the membership
+        conversation = Conversation.objects.annotate(
+            is_member=Exists(ConversationUserMap.membership(OuterRef('con_id'), user.member_id))
+        ).get(con_id=pk)
+        if not conversation.is_member:
+            raise ValueError('Not a member of the conversation')
         return conversation
 
     if _async:
         return database_sync_to_async(_get_conv)(user_or_request, pk)
     else:
         return _get_conv(user_or_request, pk)
+
+
+def search_posts(member_id: int, query: str, page: int, page_size: int,
+                 con_id: Optional[int] = None) -> dict:
+    """
+    Ranked posts of the conversations of ``member_id`` matching ``query``, pages start at 1.
+    The full-text index only covers the hot table, the archived posts containing every word
+    follow the ranked ones, newest first with a score of 0, see ``core.archive.search_archive``.
+
+    :return: ``{'results': [{'chatID', 'score', 'message'}], 'next': next page or None}``
+    """
+    backend = get_search_backend()
+    offset = (page - 1) * page_size
+    # one more row tells if there is a next page
+    hits = backend.search(member_id, query, limit=page_size + 1, offset=offset, con_id=con_id)
+    posts = ConversationPost.objects.in_bulk([chat_id for chat_id, _ in hits])
+    found = [(posts[chat_id], score) for chat_id, score in hits if chat_id in posts]
+    if archive_enabled() and len(hits) <= page_size:
+        # the page reaches past the ranked hits, the archive is counted from their end
+        ranked = offset + len(hits) if hits or not offset else \
+            len(backend.search(member_id, query, limit=offset, con_id=con_id))
+        found += [(post, 0.0) for post in search_archive(member_id, query, limit=page_size + 1 - len(hits),
+                                                         offset=max(0, offset - ranked), con_id=con_id)]
+    has_next = len(found) > page_size
+    found = found[:page_size]
+    messages = ConversationPostFastSerializer([post for post, _ in found], many=True).data
+    return {
+        'results': [
+            {'chatID': post.chat_con, 'score': score, 'message': message}
+            for (post, score), message in zip(found, messages)
+        ],
+        'next': page + 1 if has_next else None,
+    }
+
+
+def syncPosts(cursors: Dict[int, int], limit: int) -> defaultdict:
+    """
+    The newest ``limit`` posts of each conversation after its cursor, a ``UNION ALL`` of one
+    ``ORDER BY chat_id DESC LIMIT`` per conversation so every part reads the newest rows of the
+    ``(chat_con, chat_id)`` index only, however long the history (a first sync has the cursors at 0).
+    One query per ``SyncChunkSize`` conversations.
+
+    :param cursors: con_id -> newest chat_id the client has
+    :return: con_id -> posts, oldest first
+    """
+    posts = defaultdict(list)
+    table = ConversationPost._meta.db_table
+    part = f'SELECT * FROM (SELECT * FROM {table} WHERE chat_con = %s AND chat_id > %s ' \
+           f'ORDER BY chat_id DESC LIMIT %s) AS sync_{{}}'
+    con_ids = list(cursors)
+    for start in range(0, len(con_ids), SyncChunkSize):
+        chunk = con_ids[start:start + SyncChunkSize]
+        params = []
+        for con_id in chunk:
+            params += [con_id, cursors[con_id], limit]
+        for post in ConversationPost.objects.raw(
+                ' UNION ALL '.join(part.format(i) for i in range(len(chunk))), params):
+            posts[post.chat_con].append(post)
+    for conversation_posts in posts.values():
+        conversation_posts.sort(key=lambda post: post.chat_id)
+    return posts
+
+
+def syncConversations(member_id: int, token: Optional[Tuple[int, int, Dict[int, int]]] = None,
+                      max_posts: int = SyncMaxPosts) -> dict:
+    """
+    Everything that changed for ``member_id`` since the decoded sync ``token``: the changed user maps,
+    their briefs, the newest ``max_posts`` new posts of every conversation (see ``syncPosts``) and their senders.
+
+    The token keeps the newest ``chat_id`` seen per conversation. The posts of a conversation are inserted
+    under its row lock (see ``Conversation.post_many``), so their ids follow their commits and a post committed
+    late in another conversation, with a lower id than the ones already seen there, is still returned.
+
+    :return: ``{'conversations': [brief + messages (oldest first) + prev cursor], 'token'}``;
+             ``prev`` is set when the conversation has more new posts than ``max_posts``
+    """
+    since_update, since_chat, cursors = token or (0, 0, {})
+    pending = unread.pending_updates(member_id)
+    all_maps = list(ConversationUserMap.objects.filter(map_user_id=member_id).annotate(
+        con_last_id=Subquery(Conversation.objects.filter(con_id=OuterRef('map_con_id')).values('con_lastID')[:1])))
+    # the cursors of the conversations the member left are dropped
+    cursors = {_map.map_con_id: cursors.get(_map.map_con_id, since_chat) for _map in all_maps}
+    # map_update is only second precise, the token points at the current second at most, see below.
+    # New posts are found by chat_id too, their maps may still be waiting in the unread counters of another worker
+    maps = [_map for _map in all_maps if _map.map_update >= since_update or _map.map_con_id in pending
+            or (_map.con_last_id or 0) > cursors[_map.map_con_id]]
+    if not maps:
+        return {'conversations': [], 'token': syncToken(since_update, since_chat, cursors)}
+
+    posts = syncPosts({_map.map_con_id: cursors[_map.map_con_id] for _map in maps}, max_posts + 1)
+    for con_id, conversation_posts in posts.items():
+        cursors[con_id] = conversation_posts[-1].chat_id
+    selected = {con_id: conversation_posts[-max_posts:] for con_id, conversation_posts in posts.items()}
+    messages = {message['id']: message for message in ConversationPostFastSerializer(
+        [post for conversation_posts in selected.values() for post in conversation_posts], many=True).data}
+    conversations = []
+    for brief in conversationMapToBriefBulk(member_id, maps):
+        conversation_posts = selected.get(brief['id'], [])
+        conversations.append({
+            **brief,
+            'messages': [messages[post.chat_id] for post in conversation_posts],
+            'prev': encode_cursor(conversation_posts[0].chat_id, BEFORE)
+            if len(posts.get(brief['id'], ())) > max_posts else None,
+        })
+    update = max([since_update] + [_map.map_update for _map in maps] + list(pending.values()))
+    # a second that is over can't get new map updates, the next sync can start after it
+    if update < int(time.time()):
+        update += 1
+    return {
+        'conversations': conversations,
+        'token': syncToken(update, since_chat, cursors),
+    }
+
+
+def syncToken(update: int, since_chat: int, cursors: Dict[int, int]) -> str:
+    # the token grows with the conversations of the member, the cursors at since_chat are implied
+    return encode_sync_token(update, since_chat, {con_id: chat_id for con_id, chat_id in cursors.items()
+                                                  if chat_id != since_chat})
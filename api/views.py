@@ -1,6 +1,7 @@
+import math
 import os
+from typing import List
 
-from django.db.models import QuerySet
 from django.http import HttpResponseRedirect
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import cache_page
@@ -12,12 +13,17 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from core.models import ConversationUserMap, Conversation
-from user.models import User, MemberToken
+from core.search import SearchUnavailable
+from user.cache import token_cache
+from user.models import User, MemberToken, Member
+from user.utils import IPBUnavailable
 from .permissions import IsAuthAndNotBanned
 from .serializers import ConversationGetSerializer, LoginSerializer, ConversationSendSerializer, \
     ConversationPostModelSerializer, LogoutSerializer, ErrorSerializer, LoginResponseSerializer, \
-    ConversationInfoSerializer
-from .utils import conversationMapToBrief, method_permission_classes, get_conv
+    ConversationInfoSerializer, ConversationPageSerializer, ConversationPostFastSerializer, MemberModelSerializer, \
+    SearchSerializer, SearchPageSerializer, SyncSerializer, SyncResponseSerializer
+from .utils import conversationMapToBrief, method_permission_classes, method_rate_limit, get_conv, conversationPage, \
+    search_posts, briefValidators, conversationValidators, notModified, withValidators, syncConversations
 
 PageSize = int(os.environ.get('PAGE_SIZE', 50))
 
@@ -28,6 +34,7 @@ PageSize = int(os.environ.get('PAGE_SIZE', 50))
         200: OpenApiResponse(LoginResponseSerializer, description='Successful login'),
         400: OpenApiResponse(ErrorSerializer, description='Invalid login data'),
         401: OpenApiResponse(ErrorSerializer, description='Invalid login data'),
+        503: OpenApiResponse(ErrorSerializer, description='The forum login is unavailable'),
     },
     tags=['auth'],
     methods=['POST'],
@@ -40,13 +47,20 @@ def login(request: Request):
     if serializer.is_valid():
         username = serializer.data['username']
         password = serializer.data['password']
-        user, member, token = User.authenticate(request=request._request, name=username, password=password)
+        try:
+            user, member, token = User.authenticate(request=request._request, name=username, password=password)
+        except IPBUnavailable as e:
+            response = Response(ErrorSerializer({'error': 'Login is unavailable, try again later'}).data,
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            if e.retry_after:
+                response['Retry-After'] = str(math.ceil(e.retry_after))
+            return response
         if member and user and token:
-            return Response(LoginResponseSerializer(token=token).data, status=status.HTTP_200_OK)
+            return Response(LoginResponseSerializer({'token': token}).data, status=status.HTTP_200_OK)
         else:
-            return Response(ErrorSerializer(error='Invalid credentials'), status=status.HTTP_401_UNAUTHORIZED)
+            return Response(ErrorSerializer({'error': 'Invalid credentials'}).data, status=status.HTTP_401_UNAUTHORIZED)
     else:
-        return Response(ErrorSerializer(error='Invalid Params', data=serializer.errors).data,
+        return Response(ErrorSerializer({'error': 'Invalid Params', 'data': serializer.errors}).data,
                         status=status.HTTP_400_BAD_REQUEST)
 
 
@@ -65,13 +79,15 @@ def logout(request: Request):
     if request.user.is_authenticated:
         serializer = LogoutSerializer(data=request.data)
         if serializer.is_valid():
-            if serializer.data['allDevices']:
+            if serializer.data.get('allDevices'):
                 MemberToken.objects.filter(user=request.user).delete()
+                token_cache.invalidate_user(request.user.pk)
             else:
                 MemberToken.objects.filter(token=request.token).delete()
+                token_cache.invalidate(request.token)
             return Response(status=status.HTTP_200_OK)
         else:
-            return Response(ErrorSerializer(error='Invalid Params', data=serializer.errors).data,
+            return Response(ErrorSerializer({'error': 'Invalid Params', 'data': serializer.errors}).data,
                             status=status.HTTP_400_BAD_REQUEST)
     else:
         return Response(status=status.HTTP_401_UNAUTHORIZED)
@@ -84,7 +100,7 @@ class MemberView(APIView):
                              description='Member ID')
         ],
         responses={
-            200: OpenApiResponse(ConversationPostModelSerializer, description='User data'),
+            200: OpenApiResponse(MemberModelSerializer, description='User data'),
             400: OpenApiResponse(ErrorSerializer, description='Credentials are invalid'),
             404: OpenApiResponse(ErrorSerializer, description='User not found'),
         },
@@ -95,11 +111,11 @@ class MemberView(APIView):
     @method_decorator(cache_page(60 * 5))
     def get(self, request: Request, member_id: int, format=None):
         try:
-            member = User.objects.get(id=member_id)
-        except User.DoesNotExist:
-            return Response(ErrorSerializer(error='Not Found').data, status=status.HTTP_404_NOT_FOUND)
+            member = Member.objects.get(member_id=member_id)
+        except Member.DoesNotExist:
+            return Response(ErrorSerializer({'error': 'Not Found'}).data, status=status.HTTP_404_NOT_FOUND)
 
-        return Response(ConversationPostModelSerializer(member).data, status=status.HTTP_200_OK)
+        return Response(MemberModelSerializer(member).data, status=status.HTTP_200_OK)
 
 
 class ConversionBriefView(APIView):
@@ -107,18 +123,24 @@ class ConversionBriefView(APIView):
         responses={
             200: OpenApiResponse(ConversationInfoSerializer(many=True), description='Conversations Info'),
             400: OpenApiResponse(ErrorSerializer, description='Credentials are invalid'),
+            429: OpenApiResponse(ErrorSerializer, description='Too many requests'),
         },
         tags=['ConversionBrief'],
         methods=['GET'],
         operation_id='get_conversations'
     )
     @method_permission_classes((IsAuthAndNotBanned,))
+    @method_rate_limit('get-conversations')
     def get(self, request: Request, format=None):
-        conversationsMap: QuerySet[ConversationUserMap] = ConversationUserMap.objects.filter(
-            map_user_id=request.user.member_id).order_by('-map_update').all()
+        conversationsMap: List[ConversationUserMap] = list(ConversationUserMap.objects.filter(
+            map_user_id=request.user.member_id).order_by('-map_update'))
         conversations_brief = conversationMapToBrief(request.user, conversationsMap)
         conversations_brief.sort(key=lambda x: x['lastMsgTime'], reverse=True)
-        return Response(conversations_brief, status=status.HTTP_200_OK)
+        # the briefs are built for the validators, a 304 saves the transfer
+        etag, last_modified = briefValidators(request.user.member_id, conversationsMap, conversations_brief)
+        if (response := notModified(request, etag, last_modified)) is not None:
+            return response
+        return withValidators(Response(conversations_brief, status=status.HTTP_200_OK), etag, last_modified)
 
 
 class ConversationView(APIView):
@@ -129,37 +151,38 @@ class ConversationView(APIView):
                              description='Conv ID')
         ],
         responses={
-            200: OpenApiResponse(response=ConversationPostModelSerializer(many=True), description='Messages data'),
+            200: OpenApiResponse(response=ConversationPageSerializer, description='Messages data'),
             400: OpenApiResponse(ErrorSerializer, description='Credentials are invalid'),
             404: OpenApiResponse(ErrorSerializer, description='Conversation not found'),
             403: OpenApiResponse(ErrorSerializer, description='Conversation forbidden'),
+            429: OpenApiResponse(ErrorSerializer, description='Too many requests'),
         },
         tags=['Conversation'],
         methods=['GET']
     )
     @method_permission_classes((IsAuthAndNotBanned,))
     # pylint: disable=unused-argument
+    @method_rate_limit('get-conv')
     def get(self, request: Request, pk: int, format=None):
         try:
             conversation = get_conv(request, pk)
         except Conversation.DoesNotExist:
             # TODO: create conversation
-            return Response(ErrorSerializer(error="Conversation does not exist").data, status=status.HTTP_404_NOT_FOUND)
+            return Response(ErrorSerializer({'error': "Conversation does not exist"}).data, status=status.HTTP_404_NOT_FOUND)
         except ValueError:
-            return Response(ErrorSerializer(error="You are not in this conversation").data,
+            return Response(ErrorSerializer({'error': "You are not in this conversation"}).data,
                             status=status.HTTP_403_FORBIDDEN)
 
-        serializer = ConversationGetSerializer(data=request.data)
+        serializer = ConversationGetSerializer(data=request.query_params or request.data)
         if serializer.is_valid():
-            load_from = serializer.validated_data.get("loadFrom")
-            load_to = serializer.validated_data.get("loadTo")
-            last_update = serializer.validated_data.get("lastUpdate")
-            posts = conversation.get_posts(load_from=load_from, load_to=load_to, last_update=last_update,
-                                           order_by='chat_id', max_size=PageSize)
-
-            return Response(ConversationPostModelSerializer(posts, many=True).data, status=status.HTTP_200_OK)
+            etag, last_modified = conversationValidators(conversation, serializer.validated_data)
+            if (response := notModified(request, etag, last_modified)) is not None:
+                return response
+            return withValidators(
+                Response(conversationPage(conversation, serializer.validated_data, max_size=PageSize),
+                         status=status.HTTP_200_OK), etag, last_modified)
         else:
-            return Response(ErrorSerializer(error='Invalid Params', data=serializer.errors).data,
+            return Response(ErrorSerializer({'error': 'Invalid Params', 'data': serializer.errors}).data,
                             status=status.HTTP_400_BAD_REQUEST)
 
     @extend_schema(
@@ -173,23 +196,25 @@ class ConversationView(APIView):
             400: OpenApiResponse(ErrorSerializer, description='Credentials are invalid'),
             404: OpenApiResponse(ErrorSerializer, description='Conversation not found'),
             403: OpenApiResponse(ErrorSerializer, description='Conversation forbidden'),
+            429: OpenApiResponse(ErrorSerializer, description='Too many requests'),
         },
         tags=['Conversation'],
         methods=['POST']
     )
     @method_permission_classes((IsAuthAndNotBanned,))
+    @method_rate_limit('send-message')
     def post(self, request: Request, pk: int, format=None):
         try:
             conversation = get_conv(request, pk)
         except Conversation.DoesNotExist:
-            return Response(ErrorSerializer(error="Conversation does not exist").data, status=status.HTTP_404_NOT_FOUND)
+            return Response(ErrorSerializer({'error': "Conversation does not exist"}).data, status=status.HTTP_404_NOT_FOUND)
         except ValueError:
-            return Response(ErrorSerializer(error="You are not in this conversation").data,
+            return Response(ErrorSerializer({'error': "You are not in this conversation"}).data,
                             status=status.HTTP_403_FORBIDDEN)
 
         serializer = ConversationSendSerializer(data=request.data)
         if not serializer.is_valid():
-            return Response(ErrorSerializer(error='Invalid Params', data=serializer.errors).data,
+            return Response(ErrorSerializer({'error': 'Invalid Params', 'data': serializer.errors}).data,
                             status=status.HTTP_400_BAD_REQUEST)
 
         content = serializer.validated_data.get("content")
@@ -197,7 +222,7 @@ class ConversationView(APIView):
             content=content,
             member_id=request.user.member_id
         )
-        return Response(ConversationPostModelSerializer(post).data, status=status.HTTP_200_OK)
+        return Response(ConversationPostFastSerializer(post).data, status=status.HTTP_200_OK)
 
     @extend_schema(
         parameters=[
@@ -212,4 +237,56 @@ class ConversationView(APIView):
     )
     @method_permission_classes((IsAuthAndNotBanned,))
     def delete(self, request: Request, pk: int, format=None):
-        return Response(ErrorSerializer(error="Not Implemented").data, status=status.HTTP_400_BAD_REQUEST)
+        return Response(ErrorSerializer({'error': "Not Implemented"}).data, status=status.HTTP_400_BAD_REQUEST)
+
+
+class SearchView(APIView):
+    @extend_schema(
+        parameters=[SearchSerializer],
+        responses={
+            200: OpenApiResponse(SearchPageSerializer, description='Matching messages, best first'),
+            400: OpenApiResponse(ErrorSerializer, description='Invalid Params'),
+            501: OpenApiResponse(ErrorSerializer, description='No full-text search on this database'),
+            429: OpenApiResponse(ErrorSerializer, description='Too many requests'),
+        },
+        tags=['Search'],
+        methods=['GET'],
+        operation_id='search_messages'
+    )
+    @method_permission_classes((IsAuthAndNotBanned,))
+    @method_rate_limit('search')
+    def get(self, request: Request, format=None):
+        serializer = SearchSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(ErrorSerializer({'error': 'Invalid Params', 'data': serializer.errors}).data,
+                            status=status.HTTP_400_BAD_REQUEST)
+        data = serializer.validated_data
+        try:
+            page = search_posts(request.user.member_id, data['q'], data['page'], PageSize, data.get('chatID'))
+        except SearchUnavailable:
+            return Response(ErrorSerializer({'error': 'Search is not available'}).data,
+                            status=status.HTTP_501_NOT_IMPLEMENTED)
+        return Response(page, status=status.HTTP_200_OK)
+
+
+class SyncView(APIView):
+    @extend_schema(
+        parameters=[SyncSerializer],
+        responses={
+            200: OpenApiResponse(SyncResponseSerializer, description='Changed conversations with their new messages'),
+            400: OpenApiResponse(ErrorSerializer, description='Invalid Params'),
+            429: OpenApiResponse(ErrorSerializer, description='Too many requests'),
+        },
+        tags=['Sync'],
+        methods=['GET'],
+        operation_id='sync'
+    )
+    @method_permission_classes((IsAuthAndNotBanned,))
+    @method_rate_limit('sync')
+    def get(self, request: Request, format=None):
+        serializer = SyncSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(ErrorSerializer({'error': 'Invalid Params', 'data': serializer.errors}).data,
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(syncConversations(request.user.member_id, serializer.validated_data.get('token')),
+                        status=status.HTTP_200_OK)
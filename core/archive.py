@@ -0,0 +1,167 @@
+import re
+import time
+from typing import List, Optional, Set, Tuple, Union
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, router, transaction
+from django.db.models import Max, QuerySet
+
+from core.models import ArchivedPost, Conversation, ConversationPost, ConversationUserMap
+
+BOUNDARY_CACHE_KEY = 'core.archive.boundary'
+BOUNDARY_CACHE_TIMEOUT = 60
+
+_word = re.compile(r'\w+', re.UNICODE)
+
+
+def archive_enabled() -> bool:
+    return settings.POST_ARCHIVE_DAYS > 0
+
+
+def ensure_archive_table():
+    """
+    Create the archive table if it is missing, it has no migrations as it may live in its own database.
+    """
+    using = router.db_for_write(ArchivedPost)
+    connection = connections[using]
+    if ArchivedPost._meta.db_table not in connection.introspection.table_names():
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(ArchivedPost)
+
+
+def archive_cutoff() -> int:
+    """
+    Posts newer than this are all in the hot table, ``archive_posts`` never moves them.
+    """
+    return int(time.time()) - settings.POST_ARCHIVE_DAYS * 24 * 60 * 60
+
+
+def archive_boundary() -> int:
+    """
+    Newest archived chat_id, every post above it is in the hot table.
+
+    Kept in ``POST_ARCHIVE_BOUNDARY_CACHE`` when set, ``archive_batch`` updates it there for every worker.
+    A process local cache would not see the batches of the command, so without it the boundary is read
+    from the primary key of the archive table.
+    """
+    cache = caches[settings.POST_ARCHIVE_BOUNDARY_CACHE] if settings.POST_ARCHIVE_BOUNDARY_CACHE else None
+    boundary = cache.get(BOUNDARY_CACHE_KEY) if cache else None
+    if boundary is None:
+        boundary = ArchivedPost.objects.aggregate(boundary=Max('chat_id'))['boundary'] or 0
+        if cache:
+            cache.set(BOUNDARY_CACHE_KEY, boundary, BOUNDARY_CACHE_TIMEOUT)
+    return boundary
+
+
+def _skips_archive(filters: dict) -> bool:
+    """
+    Whether none of the posts matching ``filters`` can be archived, checked before the boundary
+    so the polls for new posts don't read it.
+    """
+    if filters.get('chat_time__gt', 0) >= archive_cutoff():
+        return True
+    return not (boundary := archive_boundary()) or filters.get('chat_id__gt', 0) >= boundary
+
+
+def read_posts(con_id: int, filters: dict, order_by: Optional[str], limit: Optional[int]) \
+        -> Union[QuerySet[ConversationPost], List[Union[ConversationPost, ArchivedPost]]]:
+    """
+    Posts of a conversation across the hot and the archive tables, the archive is only read when
+    the range reaches below the archive boundary and the hot table doesn't fill ``limit``.
+
+    :param filters: lookups on the post fields, ``chat_id__gt`` and ``chat_time__gt`` are used to skip the archive
+    """
+    hot = ConversationPost.objects.filter(chat_con=con_id, **filters)
+    if order_by:
+        hot = hot.order_by(order_by)
+    if not archive_enabled() or _skips_archive(filters):
+        return hot[:limit] if limit else hot
+
+    cold = ArchivedPost.objects.filter(chat_con=con_id, **filters)
+    if order_by:
+        cold = cold.order_by(order_by)
+    # archived posts are older than the live ones of the conversation
+    first, second = (hot, cold) if order_by and order_by.startswith('-') else (cold, hot)
+    posts = list(first[:limit] if limit else first)
+    if not limit or len(posts) < limit:
+        seen = {post.chat_id for post in posts}
+        # a batch copied to another archive database but not deleted yet is in both
+        posts += [post for post in (second[:limit - len(posts)] if limit else second) if post.chat_id not in seen]
+    return posts
+
+
+def search_archive(member_id: int, query: str, limit: int, offset: int = 0,
+                   con_id: Optional[int] = None) -> List[ArchivedPost]:
+    """
+    Archived posts of the conversations of ``member_id`` containing every word of ``query``, newest first.
+    The full-text indexes only cover the hot table, this scans the archived posts of the conversations.
+    """
+    if not (words := _word.findall(query)):
+        return []
+    memberships = ConversationUserMap.objects.filter(map_user_id=member_id)
+    if con_id:
+        memberships = memberships.filter(map_con_id=con_id)
+    # the archive may live in its own database, the conversations are read first
+    posts = ArchivedPost.objects.filter(chat_con__in=list(memberships.values_list('map_con_id', flat=True)))
+    for word in words:
+        posts = posts.filter(chat_content__icontains=word)
+    return list(posts.order_by('-chat_id')[offset:offset + limit])
+
+
+def kept_posts() -> Set[int]:
+    """
+    The newest post of every conversation, the conversation briefs read it from the hot table.
+    """
+    return set(Conversation.objects.values_list('con_lastID', flat=True))
+
+
+def archive_batch(cutoff: int, batch_size: int, keep: Set[int], after: int = 0) -> Tuple[int, Optional[int]]:
+    """
+    Move the posts older than ``cutoff`` among the next ``batch_size`` ones after the chat_id ``after``
+    to the archive, in one short transaction per database. The posts in ``keep`` stay (see ``kept_posts``).
+
+    :return: number of posts moved and the chat_id the next batch starts after, None when done
+    """
+    candidates = list(ConversationPost.objects.filter(chat_time__lt=cutoff, chat_id__gt=after)
+                      .order_by('chat_id').values_list('chat_id', flat=True)[:batch_size])
+    if not candidates:
+        return 0, None
+    if not (ids := [chat_id for chat_id in candidates if chat_id not in keep]):
+        return 0, candidates[-1]
+    hot_db = router.db_for_write(ConversationPost)
+    archive_db = router.db_for_write(ArchivedPost)
+    # the archive commits first, a failed delete leaves duplicates that reads skip instead of lost posts
+    with transaction.atomic(using=hot_db), transaction.atomic(using=archive_db):
+        ArchivedPost.objects.bulk_create([post.to_archive() for post in ConversationPost.objects.filter(
+            chat_id__in=ids)], ignore_conflicts=True)
+        ConversationPost.objects.filter(chat_id__in=ids).delete()
+    if settings.POST_ARCHIVE_BOUNDARY_CACHE:
+        caches[settings.POST_ARCHIVE_BOUNDARY_CACHE].set(BOUNDARY_CACHE_KEY, max(archive_boundary(), max(ids)),
+                                                         BOUNDARY_CACHE_TIMEOUT)
+    return len(ids), candidates[-1]
+
+
+def archive_posts(days: int, batch_size: int = 1000, pause: float = 0.1,
+                  max_batches: Optional[int] = None) -> int:
+    """
+    Move the posts older than ``days`` to the archive in batches, sleeping ``pause`` seconds
+    between them so other writers get the table.
+
+    The newest posts of the conversations are read once: a conversation getting a new post meanwhile
+    only keeps an old post that the next run archives.
+
+    :return: number of posts moved
+    """
+    cutoff = int(time.time()) - days * 24 * 60 * 60
+    keep = kept_posts()
+    moved = batches = after = 0
+    while max_batches is None or batches < max_batches:
+        count, after = archive_batch(cutoff, batch_size, keep, after)
+        if after is None:
+            break
+        moved += count
+        batches += 1
+        if pause:
+            time.sleep(pause)
+    return moved
@@ -1,18 +1,30 @@
 from django.conf import settings
 
-from .models import ConversationPost, Conversation, ConversationUserMap
+from SimpleChatApi.replicas import read_db, write_db
+from .models import ConversationPost, Conversation, ConversationUserMap, ArchivedPost
 
 
 class MyDBRouter:
 
     def db_for_read(self, model, **hints):
-        """ reading SomeModel from otherdb """
-        if model in [ConversationPost, Conversation, ConversationUserMap] and settings.USE_IPB:
-            return 'chats'
+        """ reading SomeModel from otherdb, or one of its replicas """
+        if model == ArchivedPost:
+            return self._archive_db()
+        if model in [ConversationPost, Conversation, ConversationUserMap]:
+            return read_db('chats' if settings.USE_IPB else None)
         return None
 
     def db_for_write(self, model, **hints):
         """ writing SomeModel to otherdb """
-        if model in [ConversationPost, Conversation, ConversationUserMap] and settings.USE_IPB:
-            return 'chats'
+        if model == ArchivedPost:
+            return self._archive_db()
+        if model in [ConversationPost, Conversation, ConversationUserMap]:
+            return write_db('chats' if settings.USE_IPB else None)
         return None
+
+    @staticmethod
+    def _archive_db():
+        """ archived posts live next to the posts unless there is an archive database """
+        if settings.USE_ARCHIVE_DATABASE:
+            return 'archive'
+        return 'chats' if settings.USE_IPB else None
@@ -0,0 +1,103 @@
+import asyncio
+import contextvars
+import logging
+from typing import List, Optional, Tuple, Union
+
+from django.conf import settings
+
+from SimpleChatApi.metrics import database_sync_to_async
+from core.models import Conversation, ConversationPost
+
+logger = logging.getLogger(__name__)
+
+
+class PostWriter:
+    """
+    Per process writer for posts sent through websockets.
+
+    Consumers ``submit`` posts and wait for them; a single task writes everything queued
+    ``max_delay`` seconds after the first post, or as soon as ``max_size`` posts are queued, with one
+    ``Conversation.post_many`` call, so a burst of messages costs a few large writes
+    and a single database thread hop per batch.
+    """
+
+    def __init__(self, max_size: int = 100, max_delay: float = 0.005):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._queue: List[Tuple[Tuple[Conversation, str, int], asyncio.Future]] = []
+        # set while posts are queued, the writer sleeps on it when there is nothing to write
+        self._queued: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def submit(self, conversation: Conversation, content: str, member_id: int) -> ConversationPost:
+        """
+        :return: the created post, with its ``chat_id``
+        """
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._queued = asyncio.Event()
+            self._full = asyncio.Event()
+            # not the context of this sender's command: its query stats and replica session would count
+            # and route every later batch
+            self._task = loop.create_task(self._run(), context=contextvars.Context())
+        future = loop.create_future()
+        self._queue.append(((conversation, content, member_id), future))
+        self._queued.set()
+        if len(self._queue) >= self.max_size:
+            self._full.set()
+        return await future
+
+    async def _run(self):
+        while True:
+            await self._queued.wait()
+            # max_delay counts from the first queued post
+            if len(self._queue) < self.max_size:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+            batch, self._queue = self._queue[:self.max_size], self._queue[self.max_size:]
+            if not self._queue:
+                self._queued.clear()
+            elif len(self._queue) >= self.max_size:
+                self._full.set()
+            messages = [message for message, _ in batch]
+            try:
+                results = await database_sync_to_async(Conversation.post_many)(messages)
+            except Exception as e:
+                results = [e] * len(batch)
+                if len(batch) > 1:
+                    # one bad message must not fail the others of the batch
+                    logger.warning('Writing a batch of %d posts failed, writing them one by one', len(batch),
+                                   exc_info=True)
+                    try:
+                        results = await database_sync_to_async(self._post_each)(messages)
+                    except Exception as e:
+                        results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    @staticmethod
+    def _post_each(messages: List[Tuple[Conversation, str, int]]) -> List[Union[ConversationPost, Exception]]:
+        """
+        Every message in its own transaction
+
+        :return: the post or the error of every message
+        """
+        results = []
+        for message in messages:
+            try:
+                results.append(Conversation.post_many([message])[0])
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+post_writer = PostWriter(max_size=settings.BATCHED_SEND_MAX_SIZE, max_delay=settings.BATCHED_SEND_MAX_DELAY_MS / 1000)
@@ -1,15 +1,20 @@
 import json
 import os
 import time
-from typing import List, Optional, Union, Awaitable
+from collections import Counter
+from functools import partial
+from typing import Dict, List, Optional, Union, Awaitable, Tuple
 
-from channels.db import database_sync_to_async
 from django.conf import settings
-from django.db import models
+from django.db import connections, models, router, transaction
 from django.db.models import QuerySet
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_migrate
 from django.dispatch import receiver
 
+from SimpleChatApi.metrics import database_sync_to_async
+from core.pagination import AFTER, BEFORE, encode_cursor
+from core.unread import unread
+from core.utils import SendMessage
 from user.models import Member
 
 PageSize = int(os.environ.get('PAGE_SIZE', 50))
@@ -39,6 +44,8 @@ class Conversation(models.Model):
 
     @property
     def lastChat(self) -> dict:
+        if not self.con_lastChat:
+            return {}
         return json.loads(self.con_lastChat)
 
     def __str__(self):
@@ -64,56 +71,146 @@ class Conversation(models.Model):
             return []
         return list(map(int, self.con_users.split(',')))
 
+    @property
+    def member_ids(self) -> List[int]:
+        """
+        Members of the conversation, from the indexed user maps instead of ``con_users``
+        """
+        return list(ConversationUserMap.objects.filter(map_con_id=self.con_id).values_list('map_user_id', flat=True))
+
+    def has_member(self, member_id: int) -> bool:
+        return ConversationUserMap.is_member(self.con_id, member_id)
+
     def get_posts(self, load_from: Optional[int], load_to: Optional[int], last_update: int,
                   order_by: str = '-chat_time', _async: bool = False, max_size: Optional[int] = PageSize) -> Union[QuerySet['ConversationPost'], Awaitable[QuerySet['ConversationPost']]]:
+        """
+        Reads the archived posts too when the range reaches them, see ``core.archive.read_posts``
+        """
         def _get_posts():
+            from core.archive import read_posts
+
             filter_args = {}
             if load_from:
-                filter_args["post_id__gt"] = load_from
+                filter_args["chat_id__gt"] = load_from
             if load_to:
-                filter_args["post_id__lt"] = load_to
-            if filter_args:
-                posts = ConversationPost.objects.filter(chat_con=self.con_id, **filter_args)
-            else:
-                posts = ConversationPost.objects.filter(chat_con=self.con_id, chat_time__gt=last_update)
-            if order_by:
-                posts = posts.order_by(order_by)
-            if max_size:
-                posts = posts[:max_size]
-            return posts
+                filter_args["chat_id__lt"] = load_to
+            if not filter_args:
+                filter_args["chat_time__gt"] = last_update
+            return read_posts(self.con_id, filter_args, order_by, max_size)
 
         if _async:
             return database_sync_to_async(_get_posts)()
         return _get_posts()
 
+    def get_page(self, cursor: Optional[Tuple[str, int]] = None, max_size: int = PageSize,
+                 _async: bool = False) -> Union[dict, Awaitable[dict]]:
+        """
+        Keyset page of posts over (chat_con, chat_id), oldest first, archived posts included.
+
+        :param cursor: decoded cursor, see ``core.pagination``; newest page when None
+        :return: dict with ``messages``, ``next`` cursor (newer posts, always set so it can be polled)
+                 and ``prev`` cursor (older posts, None at the start of the conversation)
+        """
+
+        def _get_page():
+            from core.archive import read_posts
+
+            direction, chat_id = cursor or (BEFORE, None)
+            if direction == AFTER:
+                posts = list(read_posts(self.con_id, {'chat_id__gt': chat_id}, 'chat_id', max_size))
+                has_older = True
+            else:
+                filters = {'chat_id__lt': chat_id} if chat_id is not None else {}
+                posts = list(read_posts(self.con_id, filters, '-chat_id', max_size + 1))
+                has_older = len(posts) > max_size
+                posts = posts[:max_size][::-1]
+
+            if posts:
+                next_cursor = encode_cursor(posts[-1].chat_id, AFTER)
+                prev_cursor = encode_cursor(posts[0].chat_id, BEFORE) if has_older else None
+            else:
+                # nothing in this direction, keep pointing at the same spot for newer posts
+                if direction == AFTER:
+                    next_cursor = encode_cursor(chat_id, AFTER)
+                else:
+                    next_cursor = encode_cursor(chat_id - 1 if chat_id else 0, AFTER)
+                prev_cursor = None
+            return {
+                'messages': posts,
+                'next': next_cursor,
+                'prev': prev_cursor,
+            }
+
+        if _async:
+            return database_sync_to_async(_get_page)()
+        return _get_page()
+
     def get_posts_async(self, load_from: Optional[int], load_to: Optional[int], last_update: int,
                         order_by: str = '-chat_time'):
         return self.get_posts(load_from, load_to, last_update, order_by)
 
     def post(self, content: str, member_id: int):
-        post = ConversationPost.objects.create(chat_con=self.con_id, chat_content=content, chat_member_id=member_id)
-        self._update_conv_maps(member_id)
-        self.con_lastID = post.chat_id
-        lastChat = self.lastChat
-        lastChat.update({
-            str(member_id): int(time.time()),
-        })
-        self.con_lastChat = json.dumps(lastChat)
-        self.save()
-        return post
+        """
+        Create a post in a single transaction with a fixed number of statements,
+        whatever the size of the conversation, see ``post_many``.
+        """
+        return Conversation.post_many([(self, content, member_id)])[0]
+
+    @staticmethod
+    def post_many(messages: List[Tuple['Conversation', str, int]]) -> List['ConversationPost']:
+        """
+        Create the posts of ``(conversation, content, member_id)`` in one transaction:
+        per conversation (by con_id) one locked read of the conversation, the insert of every post,
+        then per conversation one read of its members and one update of the conversation.
+        The posts are inserted under the conversation locks, so the ids of a conversation follow
+        their commits (the delta sync relies on it). Unread counters are only
+        counted in memory once committed and written later by ``core.unread``.
+        """
+        using = router.db_for_write(ConversationPost)
+        now = int(time.time())
+        posts = []
+        by_conversation: Dict[int, Tuple[Conversation, List[ConversationPost]]] = {}
+        for conversation, content, member_id in messages:
+            post = ConversationPost(chat_con=conversation.con_id, chat_content=content, chat_member_id=member_id)
+            # bulk_create does not send pre_save
+            post.prepare()
+            posts.append(post)
+            by_conversation.setdefault(conversation.con_id, (conversation, []))[1].append(post)
+
+        with transaction.atomic(using=using):
+            # the conversation rows are locked in con_id order, concurrent batches can't wait on each other
+            current = {con_id: Conversation.objects.using(using).select_for_update().only(
+                'con_id', 'con_lastID', 'con_lastChat').get(con_id=con_id) for con_id in sorted(by_conversation)}
+            if connections[using].features.can_return_rows_from_bulk_insert:
+                ConversationPost.objects.bulk_create(posts)
+            else:
+                # the ids of a multi row insert are unknown without RETURNING
+                for post in posts:
+                    post.save(force_insert=True)
+
+            for con_id, (conversation, conversation_posts) in sorted(by_conversation.items()):
+                # counted in memory, see core.unread
+                transaction.on_commit(partial(
+                    unread.add, conversation.con_id, conversation.member_ids,
+                    Counter(post.chat_member_id for post in conversation_posts), len(conversation_posts), now,
+                ), using=using)
+
+                # merged into the locked row, the cached conversation may miss the entries of concurrent senders
+                lastChat = current[con_id].lastChat
+                lastChat.update({str(post.chat_member_id): now for post in conversation_posts})
+                conversation.con_lastChat = json.dumps(lastChat)
+                # only move con_lastID forward, a concurrent sender may already have a newer post
+                conversation.con_lastID = max(current[con_id].con_lastID or 0, conversation_posts[-1].chat_id)
+                Conversation.objects.using(using).filter(con_id=conversation.con_id).update(
+                    con_lastID=conversation.con_lastID, con_lastChat=conversation.con_lastChat)
+                transaction.on_commit(partial(SendMessage.send_posts, conversation, conversation_posts), using=using)
+        return posts
 
     @database_sync_to_async
     def post_async(self, content: str, member_id: int):
         post = self.post(content, member_id)
         return post
 
-    def _update_conv_maps(self, sender_id: int):
-        userMaps = ConversationUserMap.objects.filter(map_con_id=self.con_id)
-        for userMap in userMaps:
-            if userMap.map_user_id != sender_id:
-                userMap.map_unread += 1
-            userMap.save()
-
 
 class ConversationUserMap(models.Model):
     class Meta:
@@ -122,6 +219,8 @@ class ConversationUserMap(models.Model):
         indexes = [
             models.Index(fields=['map_id', 'map_update', 'map_user_id', 'map_online'], name='map_id'),
             models.Index(fields=['map_user_id'], name='map_user_id'),
+            # membership checks, see ConversationUserMap.is_member
+            models.Index(fields=['map_con_id', 'map_user_id'], name='map_con_user'),
         ]
 
     map_id = models.BigAutoField(primary_key=True)
@@ -135,16 +234,22 @@ class ConversationUserMap(models.Model):
     def conversation(self):
         return Conversation.objects.get(con_id=self.map_con_id)
 
+    @staticmethod
+    def membership(con_id, member_id: int) -> QuerySet['ConversationUserMap']:
+        return ConversationUserMap.objects.filter(map_con_id=con_id, map_user_id=member_id)
+
+    @staticmethod
+    def is_member(con_id: int, member_id: int) -> bool:
+        return ConversationUserMap.membership(con_id, member_id).exists()
 
-class ConversationPost(models.Model):
+
+class BasePost(models.Model):
+    """
+    Fields of a post, shared by the live posts and the archived ones
+    """
     class Meta:
-        managed = not settings.USE_IPB
-        db_table = 'chatbox_conversations_posts'
-        indexes = [
-            models.Index(fields=['chat_time', 'chat_member_id', 'chat_con', 'chat_id'], name='convo_index'),
-        ]
+        abstract = True
 
-    chat_id = models.BigAutoField(primary_key=True)
     chat_time = models.IntegerField(null=False, default=lambda: int(time.time()))
     chat_con = models.BigIntegerField(null=False, default=0)
     chat_content = models.TextField(null=False)
@@ -164,7 +269,7 @@ class ConversationPost(models.Model):
 
     @property
     def member(self):
-        return Member.objects.get(id=self.chat_member_id)
+        return Member.objects.get(member_id=self.chat_member_id)
 
     def isSystem(self):
         return self.chat_sys is not None
@@ -173,17 +278,73 @@ class ConversationPost(models.Model):
         return self.chat_fileID > 0
 
 
+class ConversationPost(BasePost):
+    class Meta:
+        managed = not settings.USE_IPB
+        db_table = 'chatbox_conversations_posts'
+        indexes = [
+            models.Index(fields=['chat_time', 'chat_member_id', 'chat_con', 'chat_id'], name='convo_index'),
+            # keyset pagination of Conversation.get_page
+            models.Index(fields=['chat_con', 'chat_id'], name='convo_con_chat'),
+        ]
+
+    chat_id = models.BigAutoField(primary_key=True)
+
+    def prepare(self):
+        """
+        Fill the time and title fields of a new post
+        """
+        self.chat_time = int(time.time())
+        self.chat_title = self.chat_content[:254]
+        self.chat_title_furl = self.chat_content[:254].lower() \
+            .replace(' ', '-').replace('.', '').replace('/', '').replace('\\', '').replace('\'', '')
+
+    def to_archive(self) -> 'ArchivedPost':
+        return ArchivedPost(chat_id=self.chat_id, **{
+            field.attname: getattr(self, field.attname) for field in BasePost._meta.fields
+        })
+
+
+class ArchivedPost(BasePost):
+    """
+    Posts moved out of ``chatbox_conversations_posts`` by ``core.archive``, with their ids.
+    Lives next to the posts or in the ``archive`` database, see ``core.dbrouters``.
+    """
+    class Meta:
+        db_table = 'chatbox_conversations_posts_archive'
+        indexes = [
+            models.Index(fields=['chat_con', 'chat_id'], name='archive_con_chat'),
+        ]
+
+    chat_id = models.BigIntegerField(primary_key=True)
+
+
 @receiver(pre_save, sender=ConversationPost)
 def convPostPreSave(sender, instance, **kwargs):
     if instance.pk is None:
         instance: ConversationPost
-        instance.chat_time = int(time.time())
-        instance.chat_title = instance.chat_content[:254]
-        instance.chat_title_furl = instance.chat_content[:254].lower() \
-            .replace(' ', '-').replace('.', '').replace('/', '').replace('\\', '').replace('\'', '')
+        instance.prepare()
 
 
 @receiver(pre_save, sender=ConversationUserMap)
 def convUserMapPreSave(sender, instance, **kwargs):
     instance: ConversationUserMap
     instance.map_update = int(time.time())
+
+
+@receiver(post_migrate)
+def installSearchIndex(sender, using, **kwargs):
+    """
+    SQLite keeps its full-text index with triggers, the MySQL index of IPB is created with ``manage.py search_index``
+    """
+    from core.search import SQLiteSearchBackend
+
+    connection = connections[using]
+    if sender.name != 'core' or connection.vendor != 'sqlite' or using != router.db_for_write(ConversationPost):
+        return
+    if ConversationPost._meta.db_table not in connection.introspection.table_names():
+        return
+    backend = SQLiteSearchBackend(using)
+    if not backend.is_installed():
+        backend.install()
+        backend.rebuild()
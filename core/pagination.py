@@ -0,0 +1,59 @@
+import base64
+from typing import Dict, Tuple
+
+BEFORE = 'b'
+AFTER = 'a'
+
+
+def encode_cursor(chat_id: int, direction: str) -> str:
+    """
+    Opaque cursor pointing before (older) or after (newer) ``chat_id``
+    """
+    return base64.urlsafe_b64encode(f'{direction}{chat_id}'.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    """
+    :return: direction and chat_id of the cursor
+    :raises ValueError: if the cursor is not one made by ``encode_cursor``
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+    direction, chat_id = raw[:1], raw[1:]
+    if direction not in (BEFORE, AFTER) or not chat_id.isdigit():
+        raise ValueError('Invalid cursor')
+    return direction, int(chat_id)
+
+
+def encode_sync_token(update: int, since_chat: int, cursors: Dict[int, int] = None) -> str:
+    """
+    Opaque token of a delta sync: the newest ``map_update`` the client has seen and, per conversation,
+    the newest ``chat_id`` it has (``since_chat`` for the conversations not in ``cursors``)
+    """
+    pairs = ','.join(f'{con_id}:{chat_id}' for con_id, chat_id in sorted((cursors or {}).items()))
+    raw = f's{update}.{since_chat}' + (f'.{pairs}' if pairs else '')
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_sync_token(token: str) -> Tuple[int, int, Dict[int, int]]:
+    """
+    :return: update, since_chat and the cursors of the token
+    :raises ValueError: if the token is not one made by ``encode_sync_token``
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid token')
+    update, _, rest = raw[1:].partition('.')
+    since_chat, _, pairs = rest.partition('.')
+    if raw[:1] != 's' or not update.isdigit() or not since_chat.isdigit():
+        raise ValueError('Invalid token')
+    cursors = {}
+    for pair in pairs.split(',') if pairs else ():
+        con_id, _, chat_id = pair.partition(':')
+        if not con_id.isdigit() or not chat_id.isdigit():
+            raise ValueError('Invalid token')
+        cursors[int(con_id)] = int(chat_id)
+    return int(update), int(since_chat), cursors
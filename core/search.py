@@ -0,0 +1,198 @@
+import re
+from abc import ABC, abstractmethod
+from typing import List, Optional, Tuple
+
+from django.db import connections, router
+
+from core.models import ConversationPost, ConversationUserMap
+
+SEARCH_TABLE = 'chatbox_conversations_posts_fts'
+FULLTEXT_INDEX = 'chat_content_fulltext'
+
+_word = re.compile(r'\w+', re.UNICODE)
+
+
+class SearchUnavailable(Exception):
+    """
+    No full-text search on the posts database, for its vendor or because the index is missing.
+    """
+
+
+class SearchBackend(ABC):
+    """
+    Full-text search over ``ConversationPost.chat_content``, limited to the conversations of a member.
+    """
+    vendor: str = None
+    # whether a missing index is created on the first search, else it takes ``manage.py search_index``
+    auto_install = False
+    # (using, database name) of the installed indexes, checked once per process
+    _installed = set()
+
+    def __init__(self, using: str):
+        self.using = using
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    @abstractmethod
+    def is_installed(self) -> bool:
+        pass
+
+    @abstractmethod
+    def install(self):
+        """
+        Create the index if it is missing, it is kept up to date by the database from then on.
+        """
+
+    def rebuild(self):
+        """
+        Index the posts inserted before the index existed.
+        """
+
+    def install_if_missing(self):
+        if not self.is_installed():
+            self.install()
+            self.rebuild()
+        self._installed.add(self._key())
+
+    def ensure_installed(self):
+        """
+        :raises SearchUnavailable: the index is missing and can't be created on the fly
+        """
+        if self._key() in self._installed:
+            return
+        if self.auto_install:
+            return self.install_if_missing()
+        if not self.is_installed():
+            raise SearchUnavailable(f'No full-text index on {self.using}, run manage.py search_index')
+        self._installed.add(self._key())
+
+    def _key(self):
+        # the test databases have another name
+        return self.using, str(self.connection.settings_dict['NAME'])
+
+    @abstractmethod
+    def _search_sql(self, con_id: Optional[int]) -> str:
+        """
+        :return: sql of the (chat_id, score) rows, best first
+        """
+
+    def prepare(self, query: str) -> str:
+        return query
+
+    def _match_params(self, query: str) -> list:
+        return [query]
+
+    def search(self, member_id: int, query: str, limit: int, offset: int = 0,
+               con_id: Optional[int] = None) -> List[Tuple[int, float]]:
+        """
+        :return: (chat_id, score) of the matching posts of the conversations of ``member_id``, best first
+        """
+        if not (query := self.prepare(query)):
+            return []
+        self.ensure_installed()
+        sql = self._search_sql(con_id)
+        params = self._match_params(query) + [member_id] + ([con_id] if con_id else []) + [limit, offset]
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [(chat_id, float(score)) for chat_id, score in cursor.fetchall()]
+
+    @staticmethod
+    def _membership_sql() -> str:
+        return f'p.chat_con IN (SELECT map_con_id FROM {ConversationUserMap._meta.db_table} WHERE map_user_id = %s)'
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """
+    FTS5 external content table over the posts, synced by triggers so bulk inserts are indexed too.
+    """
+    vendor = 'sqlite'
+    auto_install = True
+
+    def is_installed(self) -> bool:
+        return SEARCH_TABLE in self.connection.introspection.table_names()
+
+    def install(self):
+        posts = ConversationPost._meta.db_table
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5('
+                           f'chat_content, content={posts}, content_rowid=chat_id, tokenize="unicode61")')
+            cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_ai AFTER INSERT ON {posts} BEGIN '
+                           f'INSERT INTO {SEARCH_TABLE}(rowid, chat_content) VALUES (new.chat_id, new.chat_content); '
+                           f'END')
+            cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_ad AFTER DELETE ON {posts} BEGIN '
+                           f'INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, chat_content) '
+                           f'VALUES (\'delete\', old.chat_id, old.chat_content); '
+                           f'END')
+            cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_au AFTER UPDATE OF chat_content ON {posts} '
+                           f'BEGIN '
+                           f'INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, chat_content) '
+                           f'VALUES (\'delete\', old.chat_id, old.chat_content); '
+                           f'INSERT INTO {SEARCH_TABLE}(rowid, chat_content) VALUES (new.chat_id, new.chat_content); '
+                           f'END')
+
+    def rebuild(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES (\'rebuild\')')
+
+    def prepare(self, query: str) -> str:
+        # every word as a quoted string, so the fts5 query syntax can't be injected, all words must match
+        return ' '.join(f'"{word}"' for word in _word.findall(query))
+
+    def _search_sql(self, con_id: Optional[int]) -> str:
+        # bm25 is lower for better matches
+        return (f'SELECT p.chat_id, -bm25({SEARCH_TABLE}) AS score '
+                f'FROM {SEARCH_TABLE} JOIN {ConversationPost._meta.db_table} p ON p.chat_id = {SEARCH_TABLE}.rowid '
+                f'WHERE {SEARCH_TABLE} MATCH %s AND {self._membership_sql()} '
+                + ('AND p.chat_con = %s ' if con_id else '') +
+                f'ORDER BY bm25({SEARCH_TABLE}), p.chat_id DESC LIMIT %s OFFSET %s')
+
+
+class MySQLSearchBackend(SearchBackend):
+    """
+    InnoDB ``FULLTEXT`` index on ``chat_content``, maintained by MySQL/MariaDB on every insert.
+    """
+    vendor = 'mysql'
+
+    def is_installed(self) -> bool:
+        with self.connection.cursor() as cursor:
+            constraints = self.connection.introspection.get_constraints(cursor, ConversationPost._meta.db_table)
+        return FULLTEXT_INDEX in constraints
+
+    def install(self):
+        if self.is_installed():
+            return
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'ALTER TABLE {ConversationPost._meta.db_table} '
+                           f'ADD FULLTEXT INDEX {FULLTEXT_INDEX} (chat_content)')
+
+    def prepare(self, query: str) -> str:
+        return ' '.join(_word.findall(query))
+
+    def _match_params(self, query: str) -> list:
+        # matched twice, once for the score and once for the filter
+        return [query, query]
+
+    def _search_sql(self, con_id: Optional[int]) -> str:
+        # natural language mode has no operators, the words are ranked by relevance
+        match = 'MATCH(p.chat_content) AGAINST (%s IN NATURAL LANGUAGE MODE)'
+        return (f'SELECT p.chat_id, {match} AS score FROM {ConversationPost._meta.db_table} p '
+                f'WHERE {match} AND {self._membership_sql()} '
+                + ('AND p.chat_con = %s ' if con_id else '') +
+                f'ORDER BY score DESC, p.chat_id DESC LIMIT %s OFFSET %s')
+
+
+backends = {backend.vendor: backend for backend in (SQLiteSearchBackend, MySQLSearchBackend)}
+
+
+def get_search_backend(using: Optional[str] = None) -> SearchBackend:
+    """
+    Backend of the database the posts are read from.
+    """
+    using = using or router.db_for_read(ConversationPost)
+    vendor = connections[using].vendor
+    if vendor not in backends:
+        raise SearchUnavailable(f'No full-text search for {vendor}')
+    return backends[vendor](using)
+
@@ -1,3 +1,502 @@
-from django.test import TestCase
+import asyncio
+import base64
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import DatabaseError, connection, connections, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from SimpleChatApi.instrumentation import collect
+from SimpleChatApi.pool import ConnectionPool
+from SimpleChatApi.replicas import read_db, replica_session
+from api.management.commands._utils import ensure_tables
+from api.utils import get_conv
+from core.archive import archive_cutoff, archive_posts, ensure_archive_table, kept_posts, read_posts, search_archive
+from core.ingest import PostWriter
+from core.models import ArchivedPost, Conversation, ConversationPost, ConversationUserMap
+from core.pagination import AFTER, BEFORE, decode_cursor, decode_sync_token, encode_cursor, encode_sync_token
+from core.search import get_search_backend
+from core.unread import UnreadCounters
+from user.models import Member
+
+
+class ChatTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # the IPB tables have no migrations
+        ensure_tables()
+        super().setUpClass()
+
+    def setUp(self):
+        self.members = [Member.objects.create(name=f'member{i}') for i in range(3)]
+        self.conversation = Conversation.objects.create(con_name='group', con_users='', con_isGroup=1)
+        for member in self.members:
+            ConversationUserMap.objects.create(map_user_id=member.pk, map_con_id=self.conversation.pk)
+
+
+class PostTest(ChatTestCase):
+    def test_concurrent_senders(self):
+        # both senders hold the conversation as it was before either posted
+        first = Conversation.objects.get(pk=self.conversation.pk)
+        second = Conversation.objects.get(pk=self.conversation.pk)
+        first.post('first', self.members[0].pk)
+        post = second.post('second', self.members[1].pk)
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(set(self.conversation.lastChat), {str(self.members[0].pk), str(self.members[1].pk)})
+        self.assertEqual(self.conversation.con_lastID, post.chat_id)
+
+    def test_last_id_only_moves_forward(self):
+        stale = Conversation.objects.get(pk=self.conversation.pk)
+        # a concurrent sender committed a newer post meanwhile
+        Conversation.objects.filter(pk=self.conversation.pk).update(con_lastID=10 ** 9)
+        stale.post('late', self.members[0].pk)
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.con_lastID, 10 ** 9)
+        self.assertIn(str(self.members[0].pk), self.conversation.lastChat)
+
+    def test_post_many(self):
+        other = Conversation.objects.create(con_name='other', con_users='', con_isGroup=1)
+        posts = Conversation.post_many([(self.conversation, 'a', self.members[0].pk),
+                                        (other, 'b', self.members[1].pk),
+                                        (self.conversation, 'c', self.members[2].pk)])
+
+        self.assertEqual([post.chat_content for post in posts], ['a', 'b', 'c'])
+        self.assertEqual(ConversationPost.objects.filter(chat_id__in=[post.chat_id for post in posts]).count(), 3)
+        self.conversation.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(self.conversation.con_lastID, posts[2].chat_id)
+        self.assertEqual(other.con_lastID, posts[1].chat_id)
+        self.assertEqual(set(self.conversation.lastChat), {str(self.members[0].pk), str(self.members[2].pk)})
+
+    def test_locks_in_con_id_order(self):
+        other = Conversation.objects.create(con_name='other', con_users='', con_isGroup=1)
+        with CaptureQueriesContext(connection) as queries:
+            Conversation.post_many([(other, 'a', self.members[0].pk), (self.conversation, 'b', self.members[0].pk)])
+        locked = [query['sql'] for query in queries if query['sql'].startswith('SELECT')
+                  and '"chatbox_conversations"."con_lastChat"' in query['sql']]
+        self.assertEqual(len(locked), 2)
+        self.assertTrue(locked[0].endswith(f'= {self.conversation.pk} LIMIT 21'))
+        self.assertTrue(locked[1].endswith(f'= {other.pk} LIMIT 21'))
+
+
+class UnreadCountersTest(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.counters = UnreadCounters(interval=3600, batch_size=2)
+        self.addCleanup(self.counters.stop)
+        self.member_ids = [member.pk for member in self.members]
+
+    def rows(self) -> list:
+        return list(ConversationUserMap.objects.filter(map_con_id=self.conversation.pk).order_by('map_user_id')
+                    .values_list('map_unread', 'map_update'))
+
+    def test_flush(self):
+        before = self.rows()
+        # the sender doesn't get their own post as unread
+        self.counters.add(self.conversation.pk, self.member_ids, {self.members[0].pk: 1}, 2, timestamp=10 ** 9)
+        self.assertEqual(self.rows(), before)
+        self.assertEqual(self.counters.get(self.members[0].pk, self.conversation.pk, 0), 1)
+        self.assertEqual(self.counters.get(self.members[1].pk, self.conversation.pk, 0), 2)
+        self.assertEqual(self.counters.updated(self.members[1].pk, self.conversation.pk, 0), 10 ** 9)
+        self.assertEqual(self.counters.pending_conversations(self.members[1].pk), {self.conversation.pk})
+
+        # one statement per batch of members of a conversation
+        with self.assertNumQueries(2):
+            self.assertEqual(self.counters.flush(), 3)
+        self.assertEqual(self.rows(), [(1, 10 ** 9), (2, 10 ** 9), (2, 10 ** 9)])
+        self.assertEqual(self.counters.get(self.members[1].pk, self.conversation.pk, 2), 2)
+        self.assertEqual(self.counters.flush(), 0)
+
+    def test_failed_batch_is_restored(self):
+        self.counters.add(self.conversation.pk, self.member_ids, {}, 1, timestamp=10 ** 9)
+        with mock.patch('django.db.models.query.QuerySet.update', side_effect=[1, DatabaseError('gone')]):
+            with self.assertRaises(DatabaseError):
+                self.counters.flush()
+        # counted again meanwhile, added on top of the restored delta
+        self.counters.add(self.conversation.pk, self.member_ids, {}, 1, timestamp=10 ** 9 + 1)
+        self.counters.flush()
+        # the first batch was "written" by the mock, the member of the failed one gets both posts
+        self.assertEqual(sorted(self.rows()), [(1, 10 ** 9 + 1), (1, 10 ** 9 + 1), (2, 10 ** 9 + 1)])
+
+
+class MembershipTest(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.outsider = Member.objects.create(name='outsider')
+        # con_users is not kept up to date, the user maps are
+        Conversation.objects.filter(pk=self.conversation.pk).update(con_users=str(self.outsider.pk))
+        self.conversation.refresh_from_db()
+
+    def test_member_ids(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(self.conversation.member_ids), [member.pk for member in self.members])
+
+    def test_has_member(self):
+        with self.assertNumQueries(2):
+            self.assertTrue(self.conversation.has_member(self.members[0].pk))
+            self.assertFalse(self.conversation.has_member(self.outsider.pk))
+
+    def test_get_conv(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(get_conv(self.members[0], self.conversation.pk).pk, self.conversation.pk)
+        with self.assertRaises(ValueError):
+            get_conv(self.outsider, self.conversation.pk)
+        with self.assertRaises(Conversation.DoesNotExist):
+            get_conv(self.members[0], self.conversation.pk + 1)
+
+
+class SearchTest(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = get_search_backend()
+        self.other = Conversation.objects.create(con_name='other', con_users='', con_isGroup=1)
+        ConversationUserMap.objects.create(map_user_id=self.members[1].pk, map_con_id=self.other.pk)
+        self.weak = self.conversation.post('an apple and many more words about something else', self.members[0].pk)
+        self.strong = self.conversation.post('apple apple', self.members[0].pk)
+        self.hidden = self.other.post('apple apple apple', self.members[1].pk)
+
+    def ids(self, member: int, query: str, **kwargs) -> list:
+        return [chat_id for chat_id, _ in self.backend.search(self.members[member].pk, query, limit=10, **kwargs)]
+
+    def test_ranking(self):
+        hits = self.backend.search(self.members[0].pk, 'apple', limit=10)
+        self.assertEqual([chat_id for chat_id, _ in hits], [self.strong.chat_id, self.weak.chat_id])
+        self.assertGreater(hits[0][1], hits[1][1])
+        # every word must match
+        self.assertEqual(self.ids(0, 'apple words'), [self.weak.chat_id])
+        self.assertEqual(self.ids(0, 'apple', offset=1), [self.weak.chat_id])
+
+    def test_membership(self):
+        self.assertNotIn(self.hidden.chat_id, self.ids(0, 'apple'))
+        self.assertEqual(self.ids(1, 'apple', con_id=self.other.pk), [self.hidden.chat_id])
+        self.assertEqual(self.ids(2, 'apple', con_id=self.other.pk), [])
+
+    def test_query_syntax_is_not_interpreted(self):
+        self.assertEqual(self.ids(0, 'apple OR "cherry'), [])
+        self.assertEqual(self.ids(0, '*'), [])
+
+
+class PostWriterTest(TransactionTestCase):
+    """
+    The writer posts from the database thread, the data must be committed
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        ensure_tables()
+        super().setUpClass()
+
+    def setUp(self):
+        self.member = Member.objects.create(name='member')
+        self.conversations = [Conversation.objects.create(con_name=f'group{i}', con_users='', con_isGroup=1)
+                              for i in range(2)]
+
+    def submit(self, *messages):
+        async def run():
+            writer = PostWriter(max_size=10, max_delay=0.05)
+            return await asyncio.gather(*(writer.submit(conversation, content, self.member.pk)
+                                          for conversation, content in messages), return_exceptions=True)
+
+        return asyncio.run(run())
+
+    def test_batch(self):
+        posts = self.submit((self.conversations[1], 'a'), (self.conversations[0], 'b'), (self.conversations[1], 'c'))
+        self.assertEqual([post.chat_content for post in posts], ['a', 'b', 'c'])
+        self.assertEqual(ConversationPost.objects.count(), 3)
+
+    def test_own_context(self):
+        async def run():
+            writer = PostWriter(max_size=10, max_delay=0.01)
+            with replica_session(self.member.pk) as session, collect('send-message') as stats:
+                await writer.submit(self.conversations[0], 'a', self.member.pk)
+            # the first sender started the task, the next batches are not theirs
+            with collect('send-message') as later:
+                await writer.submit(self.conversations[0], 'b', self.member.pk)
+            return session, stats, later
+
+        session, stats, later = asyncio.run(run())
+        self.assertFalse(session.recorded)
+        self.assertEqual(stats.count, 0)
+        self.assertEqual(later.count, 0)
+
+    def test_failed_message_spares_the_batch(self):
+        with self.assertLogs('core.ingest', 'WARNING'):
+            first, failed, last = self.submit((self.conversations[0], 'a'), (self.conversations[1], None),
+                                              (self.conversations[1], 'c'))
+        self.assertIsInstance(failed, Exception)
+        self.assertEqual((first.chat_content, last.chat_content), ('a', 'c'))
+        self.assertEqual(sorted(ConversationPost.objects.values_list('chat_content', flat=True)), ['a', 'c'])
+
+
+@override_settings(DATABASE_REPLICAS={'default': ['replica']})
+class ReplicaSessionTest(SimpleTestCase):
+    def test_pin_read_once_by_the_first_read(self):
+        with mock.patch('SimpleChatApi.replicas.cache.get', return_value=False) as get:
+            with replica_session(1):
+                get.assert_not_called()
+                self.assertEqual(read_db('default'), 'replica')
+                self.assertEqual(read_db('default'), 'replica')
+        get.assert_called_once()
+
+    def test_pinned(self):
+        with mock.patch('SimpleChatApi.replicas.cache.get', return_value=True):
+            with replica_session(1):
+                self.assertEqual(read_db('default'), 'default')
+
+    def test_no_replicas(self):
+        with override_settings(DATABASE_REPLICAS={}), \
+                mock.patch('SimpleChatApi.replicas.cache.get') as get, replica_session(1):
+            self.assertEqual(read_db('default'), 'default')
+        get.assert_not_called()
+
+
+class ReplicaRoutingTest(TransactionTestCase):
+    """
+    Two sqlite files standing in for replicas: unlike test mirrors each one has its own rows,
+    the name of the conversation tells which database a read went to.
+    """
+    replicas = ['default_replica_0', 'default_replica_1']
+
+    @classmethod
+    def setUpClass(cls):
+        # the IPB tables have no migrations
+        ensure_tables()
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        for alias in cls.replicas:
+            connections.settings[alias] = connections.configure_settings({
+                'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': f'{cls.directory.name}/{alias}.sqlite3'},
+            })['default']
+            with connections[alias].schema_editor() as schema_editor:
+                schema_editor.create_model(Conversation)
+
+    @classmethod
+    def tearDownClass(cls):
+        for alias in cls.replicas:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.conversation = Conversation.objects.create(con_name='default')
+        for alias in self.replicas:
+            Conversation.objects.using(alias).create(pk=self.conversation.pk, con_name=alias)
+            self.addCleanup(Conversation.objects.using(alias).all().delete)
+        replicas = override_settings(DATABASE_REPLICAS={'default': self.replicas})
+        replicas.enable()
+        self.addCleanup(replicas.disable)
+
+    def read(self) -> str:
+        return Conversation.objects.get(pk=self.conversation.pk).con_name
+
+    def test_reads_go_to_the_replicas(self):
+        with replica_session(1):
+            self.assertIn(self.read(), self.replicas)
+        self.assertEqual({self.read() for _ in range(50)}, set(self.replicas))
+        with transaction.atomic():
+            self.assertEqual(self.read(), 'default')
+
+    @override_settings(REPLICA_PIN_SECONDS=0.2)
+    def test_writer_is_pinned(self):
+        with replica_session(1):
+            Conversation.objects.filter(pk=self.conversation.pk).update(con_name='renamed')
+            self.assertEqual(self.read(), 'renamed')
+        # the next request of the writer, on any worker sharing the cache
+        with replica_session(1):
+            self.assertEqual(self.read(), 'renamed')
+        with replica_session(2):
+            self.assertIn(self.read(), self.replicas)
+
+        time.sleep(0.25)
+        with replica_session(1):
+            self.assertIn(self.read(), self.replicas)
+
+
+@override_settings(POST_ARCHIVE_DAYS=30, POST_ARCHIVE_BOUNDARY_CACHE=None)
+class ArchiveTest(ChatTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        ensure_archive_table()
+
+    def setUp(self):
+        super().setUp()
+        self.ids = [self.conversation.post(f'old {i}', self.members[0].pk).chat_id for i in range(5)]
+        ConversationPost.objects.update(chat_time=archive_cutoff() - 60)
+
+    def test_keeps_the_newest_post(self):
+        with mock.patch('core.archive.kept_posts', wraps=kept_posts) as kept:
+            self.assertEqual(archive_posts(30, batch_size=2, pause=0), 4)
+        # once per run, not per batch
+        kept.assert_called_once()
+        self.assertEqual(list(ConversationPost.objects.values_list('chat_id', flat=True)), self.ids[-1:])
+        self.assertEqual(sorted(ArchivedPost.objects.values_list('chat_id', flat=True)), self.ids[:-1])
+
+    def test_search_archive(self):
+        archive_posts(30, pause=0)
+        self.assertEqual([post.chat_id for post in search_archive(self.members[0].pk, 'OLD', limit=2)],
+                         self.ids[-2:-4:-1])
+        self.assertEqual([post.chat_id for post in search_archive(self.members[0].pk, 'old 1', limit=10)], [self.ids[1]])
+        self.assertEqual(search_archive(10 ** 6, 'old', limit=10), [])
+
+    def test_pages_across_tables(self):
+        archive_posts(30, pause=0)
+        new = [self.conversation.post(f'new {i}', self.members[0].pk).chat_id for i in range(3)]
+        page = self.conversation.get_page(max_size=4)
+        self.assertEqual([post.chat_id for post in page['messages']], self.ids[-1:] + new)
+        page = self.conversation.get_page(cursor=decode_cursor(page['prev']), max_size=4)
+        self.assertEqual([post.chat_id for post in page['messages']], self.ids[:4])
+        self.assertIsNone(page['prev'])
+
+        page = self.conversation.get_page(cursor=(AFTER, self.ids[1]), max_size=4)
+        self.assertEqual([post.chat_id for post in page['messages']], self.ids[2:] + new[:1])
+        # above the boundary, only the hot table is read
+        with self.assertNumQueries(2):
+            page = self.conversation.get_page(cursor=(AFTER, self.ids[-1]), max_size=4)
+        self.assertEqual([post.chat_id for post in page['messages']], new)
+
+    def test_read_posts(self):
+        archive_posts(30, pause=0)
+        new = self.conversation.post('new', self.members[0].pk).chat_id
+        self.assertEqual([post.chat_id for post in read_posts(self.conversation.pk, {}, 'chat_id', None)],
+                         self.ids + [new])
+        self.assertEqual([post.chat_id for post in read_posts(self.conversation.pk, {}, '-chat_id', 3)],
+                         [new] + self.ids[:-3:-1])
+
+
+class PaginationTest(SimpleTestCase):
+    def test_cursor(self):
+        for direction in (BEFORE, AFTER):
+            self.assertEqual(decode_cursor(encode_cursor(1234, direction)), (direction, 1234))
+
+    def test_invalid_cursor(self):
+        for cursor in ('', 'x', '!!!', encode_cursor(1, 'z'), encode_sync_token(1, 2)):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+    def test_sync_token(self):
+        self.assertEqual(decode_sync_token(encode_sync_token(1700000000, 42)), (1700000000, 42, {}))
+        self.assertEqual(decode_sync_token(encode_sync_token(1700000000, 0, {3: 7, 1: 9})), (1700000000, 0, {1: 9, 3: 7}))
+
+    def test_invalid_sync_token(self):
+        for token in ('', 'x', '!!!', encode_cursor(1, BEFORE),
+                      base64.urlsafe_b64encode(b's1.0.3:x').decode()):
+            with self.assertRaises(ValueError):
+                decode_sync_token(token)
+
+
+class PageTest(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ids = [self.conversation.post(f'message {i}', self.members[i % 3].pk).chat_id for i in range(25)]
+
+    def test_pages(self):
+        page = self.conversation.get_page(max_size=10)
+        self.assertEqual([post.chat_id for post in page['messages']], self.ids[-10:])
+        self.assertEqual(decode_cursor(page['next']), (AFTER, self.ids[-1]))
+
+        ids = [post.chat_id for post in page['messages']]
+        while page['prev']:
+            page = self.conversation.get_page(cursor=decode_cursor(page['prev']), max_size=10)
+            ids = [post.chat_id for post in page['messages']] + ids
+        self.assertEqual(ids, self.ids)
+
+    def test_newer_posts(self):
+        page = self.conversation.get_page(cursor=(AFTER, self.ids[19]), max_size=10)
+        self.assertEqual([post.chat_id for post in page['messages']], self.ids[20:])
+
+        page = self.conversation.get_page(cursor=decode_cursor(page['next']), max_size=10)
+        self.assertEqual(page['messages'], [])
+        # still a cursor to poll
+        self.assertEqual(decode_cursor(page['next']), (AFTER, self.ids[-1]))
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    def setUp(self):
+        self.opened = []
+
+    def connect(self):
+        self.opened.append(FakeConnection())
+        return self.opened[-1]
+
+    def checkout(self, pool: ConnectionPool, valid: bool = True):
+        return pool.checkout(self.connect, lambda connection: valid)
+
+    def test_reuse(self):
+        pool = ConnectionPool('test', max_size=2)
+        connection = self.checkout(pool)
+        pool.checkin(connection)
+        self.assertIs(self.checkout(pool), connection)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_limit_and_timeout(self):
+        pool = ConnectionPool('test', max_size=2, timeout=0.1)
+        self.checkout(pool)
+        self.checkout(pool)
+        start = time.monotonic()
+        with self.assertRaisesMessage(TimeoutError, '2 in use'):
+            self.checkout(pool)
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertEqual(len(self.opened), 2)
+
+    def test_waiter_gets_connection_given_back(self):
+        pool = ConnectionPool('test', max_size=1, timeout=5)
+        connection = self.checkout(pool)
+        threading.Timer(0.05, pool.checkin, (connection,)).start()
+        self.assertIs(self.checkout(pool), connection)
+
+    def test_broken_connection_frees_its_slot(self):
+        pool = ConnectionPool('test', max_size=1, timeout=0.1)
+        connection = self.checkout(pool)
+        pool.checkin(connection, reusable=False)
+        self.assertTrue(connection.closed)
+        self.assertIsNot(self.checkout(pool), connection)
+
+    def test_validation(self):
+        pool = ConnectionPool('test', max_size=1, validate_after=0)
+        connection = self.checkout(pool)
+        pool.checkin(connection)
+        replacement = self.checkout(pool, valid=False)
+        self.assertTrue(connection.closed)
+        self.assertIsNot(replacement, connection)
+
+    def test_idle_and_lifetime(self):
+        pool = ConnectionPool('test', max_size=2, max_idle=0.05, max_lifetime=10)
+        connection = self.checkout(pool)
+        pool.checkin(connection)
+        time.sleep(0.06)
+        self.assertIsNot(self.checkout(pool), connection)
+        self.assertTrue(connection.closed)
+
+        pool = ConnectionPool('test', max_size=1, max_lifetime=0)
+        connection = self.checkout(pool)
+        pool.checkin(connection)
+        self.assertTrue(connection.closed)
+
+    def test_close_idle(self):
+        pool = ConnectionPool('test', max_size=2)
+        connections = [self.checkout(pool), self.checkout(pool)]
+        for connection in connections:
+            pool.checkin(connection)
+        pool.close_idle()
+        self.assertTrue(all(connection.closed for connection in connections))
+        self.checkout(pool)
+        self.checkout(pool)
+        self.assertEqual(len(self.opened), 4)
@@ -0,0 +1,182 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from django.db import connections
+from django.db.models import Case, F, Value, When
+
+logger = logging.getLogger(__name__)
+
+UNREAD_FLUSH_INTERVAL = float(os.environ.get('UNREAD_FLUSH_INTERVAL', 5))
+UNREAD_BATCH_SIZE = 500
+
+Key = Tuple[int, int]
+
+
+class UnreadCounters:
+    """
+    Write-behind buffer for the unread counters of ``ConversationUserMap``, keyed by (member_id, con_id).
+
+    ``add`` only counts in memory, a background thread writes the collected deltas (and ``map_update``)
+    every ``interval`` seconds, one ``UPDATE ... CASE`` per conversation and batch of members.
+    Deltas are written as ``map_unread + delta`` so several workers never overwrite each other.
+    The table stays the source of truth: reads take the row and add the deltas of this process
+    that are not written yet, the deltas of other workers show up once they flush.
+    An interval <= 0 writes every ``add`` right away.
+    """
+
+    def __init__(self, interval: float = UNREAD_FLUSH_INTERVAL, batch_size: int = UNREAD_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending: Dict[Key, int] = {}
+        self._updated: Dict[Key, int] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, con_id: int, member_ids: Iterable[int], senders: Dict[int, int], count: int,
+            timestamp: Optional[int] = None):
+        """
+        :param member_ids: members of the conversation
+        :param senders: member_id -> number of the new posts sent by the member
+        :param count: number of new posts
+        """
+        self._ensure_started()
+        timestamp = timestamp or int(time.time())
+        with self._lock:
+            for member_id in member_ids:
+                key = (member_id, con_id)
+                if delta := count - senders.get(member_id, 0):
+                    self._pending[key] = self._pending.get(key, 0) + delta
+                self._updated[key] = timestamp
+        if self.interval <= 0:
+            self.flush()
+
+    def get(self, member_id: int, con_id: int, stored: int) -> int:
+        """
+        :param stored: ``map_unread`` of the row
+        """
+        with self._lock:
+            return stored + self._pending.get((member_id, con_id), 0)
+
+    def updated(self, member_id: int, con_id: int, stored: int) -> int:
+        """
+        :param stored: ``map_update`` of the row
+        """
+        with self._lock:
+            return max(stored, self._updated.get((member_id, con_id), 0))
+
+    def pending_updates(self, member_id: int) -> Dict[int, int]:
+        """
+        :return: con_id -> ``map_update`` of ``member_id`` not written yet
+        """
+        with self._lock:
+            return {con_id: timestamp for (_member_id, con_id), timestamp in self._updated.items()
+                    if _member_id == member_id}
+
+    def pending_conversations(self, member_id: int) -> Set[int]:
+        """
+        :return: conversations of ``member_id`` with unread messages not written yet
+        """
+        with self._lock:
+            return {con_id for (_member_id, con_id), delta in self._pending.items()
+                    if _member_id == member_id and delta > 0}
+
+    def flush(self) -> int:
+        """
+        :return: number of rows written
+        """
+        from core.models import ConversationUserMap
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            updated, self._updated = self._updated, {}
+        by_conversation = defaultdict(list)
+        for member_id, con_id in updated.keys() | pending.keys():
+            by_conversation[con_id].append(member_id)
+        batches = [(con_id, member_ids[i:i + self.batch_size]) for con_id, member_ids in by_conversation.items()
+                   for i in range(0, len(member_ids), self.batch_size)]
+
+        for done, (con_id, batch) in enumerate(batches):
+            try:
+                # update() bypasses ConversationUserMap.save, so map_update is written here
+                ConversationUserMap.objects.filter(map_con_id=con_id, map_user_id__in=batch).update(
+                    map_unread=Case(
+                        *[When(map_user_id=member_id, then=F('map_unread') + pending[(member_id, con_id)])
+                          for member_id in batch if pending.get((member_id, con_id))],
+                        default=F('map_unread'),
+                    ),
+                    map_update=Case(
+                        *[When(map_user_id=member_id, then=Value(updated[(member_id, con_id)]))
+                          for member_id in batch if (member_id, con_id) in updated],
+                        default=F('map_update'),
+                    ),
+                )
+            except Exception:
+                # every batch is one statement, the failed one and the ones after it were not written
+                self._restore({(member_id, con_id) for con_id, batch in batches[done:] for member_id in batch},
+                              pending, updated)
+                raise
+        return sum(len(member_ids) for member_ids in by_conversation.values())
+
+    def _restore(self, keys: Set[Key], pending: Dict[Key, int], updated: Dict[Key, int]):
+        """
+        Put back the deltas of ``keys`` taken by a failed flush, on top of the ones added since.
+        """
+        with self._lock:
+            for key in keys:
+                if key in pending:
+                    self._pending[key] = self._pending.get(key, 0) + pending[key]
+                if key in updated:
+                    self._updated[key] = max(self._updated.get(key, 0), updated[key])
+
+    def clear(self):
+        """
+        Forget the deltas not written yet.
+        """
+        with self._lock:
+            self._pending.clear()
+            self._updated.clear()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='unread-flush', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Stop the flush thread and write what is left.
+        """
+        thread = self._thread
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+            self._thread = None
+            atexit.unregister(self.stop)
+        self.flush()
+
+    def _ensure_started(self):
+        if self.interval > 0 and self._thread is None:
+            self.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                # kept for the next flush, the thread must outlive a database outage
+                logger.exception('Writing the unread counters failed')
+            finally:
+                # the connections of this thread would otherwise never be closed
+                connections.close_all()
+
+
+unread = UnreadCounters()
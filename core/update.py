@@ -1,8 +1,9 @@
-from channels.db import database_sync_to_async
-from django.db.models import QuerySet
+from django.db.models import Q, QuerySet
 
-from api.utils import conversationMapToBriefByID
+from SimpleChatApi.metrics import database_sync_to_async
+from api.utils import conversationMapToBriefBulk
 from core.models import ConversationUserMap
+from core.unread import unread
 from core.utils import SendMessage
 
 
@@ -13,9 +14,10 @@ class Update:
 
     @database_sync_to_async
     def update(self, user_id):
+        # written unread counters, and the ones of this worker not flushed yet
         conversationsMap: QuerySet[ConversationUserMap] = ConversationUserMap.objects.filter(
-            map_user_id=user_id, map_unread__gt=0).order_by('-map_update').all()
-        conversations_brief = conversationMapToBriefByID(user_id=user_id, data=conversationsMap)
+            Q(map_unread__gt=0) | Q(map_con_id__in=unread.pending_conversations(user_id)), map_user_id=user_id)
+        conversations_brief = conversationMapToBriefBulk(user_id=user_id, data=conversationsMap)
         conversations_brief.sort(key=lambda x: x['lastMsgTime'], reverse=True)
         SendMessage.send_update_message(group_name=f"g{user_id}", data=conversations_brief)
 
@@ -1,15 +1,29 @@
+import time
+
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 
+from SimpleChatApi.metrics import GROUP_SEND_SECONDS
+
 
 class SendMessage:
 
+    @staticmethod
+    def user_group(user_id: int) -> str:
+        return f"g{user_id}"
+
+    @staticmethod
+    def conversation_group(con_id: int) -> str:
+        return f"c{con_id}"
+
     @staticmethod
     def _send(group_name, data):
         channel_layer = get_channel_layer()
+        start = time.perf_counter()
         async_to_sync(channel_layer.group_send)(
             group_name, data
         )
+        GROUP_SEND_SECONDS.observe(time.perf_counter() - start)
 
     @staticmethod
     def send_update_message(group_name, data):
@@ -24,3 +38,31 @@ class SendMessage:
             'type': 'chat',
             'data': data
         })
+
+    @staticmethod
+    def send_post(conversation, post):
+        SendMessage.send_posts(conversation, [post])
+
+    @staticmethod
+    def send_posts(conversation, posts):
+        """
+        Publish new posts of a conversation: each serialized post goes once to the conversation group,
+        members get a small notification on their own group.
+        """
+        from api.serializers import ConversationPostFastSerializer
+
+        member_ids = conversation.member_ids
+        for post, data in zip(posts, ConversationPostFastSerializer(posts, many=True).data):
+            SendMessage.send_chat_message(SendMessage.conversation_group(conversation.con_id), {
+                'chatID': conversation.con_id,
+                'message': data,
+            })
+            for user_id in member_ids:
+                SendMessage._send(SendMessage.user_group(user_id), {
+                    'type': 'notify',
+                    'data': {
+                        'chatID': conversation.con_id,
+                        'lastMsgID': post.chat_id,
+                        'lastMsgTime': post.chat_time,
+                    }
+                })
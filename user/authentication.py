@@ -1,7 +1,8 @@
 from rest_framework import authentication
 from rest_framework import exceptions
 
-from .models import MemberToken
+from SimpleChatApi.replicas import use_member
+from .cache import token_cache
 
 
 class TokenAuthentication(authentication.BaseAuthentication):
@@ -9,10 +10,9 @@ class TokenAuthentication(authentication.BaseAuthentication):
         token = request.headers.get('X-API-Key')
         if not token:
             return None
-        request.token = None
-        try:
-            request.token = token
-            user = MemberToken.objects.get(token=token).user
-        except MemberToken.DoesNotExist:
+        request.token = token
+        user = token_cache.resolve(token)
+        if user is None:
             raise exceptions.AuthenticationFailed('Invalid Token')
+        use_member(user.member_id)
         return user, None
@@ -0,0 +1,121 @@
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Set, Tuple
+
+# seconds a logout or ban may take to reach the other workers
+TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', 30))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+
+
+class TokenCache:
+    """
+    Token -> User cache shared by the rest authentication and the websocket middleware.
+
+    Entries expire after ``ttl`` seconds and the least recently used one is evicted
+    once ``max_size`` tokens are cached.
+
+    The cache is per process: ``invalidate`` and ``invalidate_user`` only reach the worker they run in,
+    the other workers keep a logged out or banned user for up to ``ttl`` seconds. A shared cache would need
+    a network round trip per request, the short ttl keeps the lookups in memory and the window small.
+    """
+
+    def __init__(self, ttl: int = TOKEN_CACHE_TTL, max_size: int = TOKEN_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[str, Tuple[float, object]]' = OrderedDict()
+        self._user_tokens: Dict[int, Set[str]] = {}
+        self._lock = threading.Lock()
+        # bumped by every invalidation, a load that started before one doesn't cache its stale user
+        self._generation = 0
+
+    def get(self, token: str):
+        """
+        :return: a copy of the cached user or None, never hits the database
+        """
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            user = entry[1]
+        return copy.copy(user)
+
+    def set(self, token: str, user, generation: int = None):
+        """
+        :param generation: of the cache when the user was read, not cached if it was invalidated since
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._remove(token)
+            self._entries[token] = (time.monotonic() + self.ttl, user)
+            self._user_tokens.setdefault(user.pk, set()).add(token)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def load(self, token: str):
+        """
+        Load the user of ``token`` from the database and cache it.
+
+        :return: user or None if the token does not exist
+        """
+        from user.models import MemberToken
+
+        generation = self._generation
+        try:
+            user = MemberToken.objects.select_related('user').get(token=token).user
+        except MemberToken.DoesNotExist:
+            return None
+        self.set(token, user, generation)
+        return copy.copy(user)
+
+    def resolve(self, token: str):
+        user = self.get(token)
+        if user is None:
+            user = self.load(token)
+        return user
+
+    def invalidate(self, token: str):
+        with self._lock:
+            self._generation += 1
+            self._remove(token)
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            self._generation += 1
+            for token in list(self._user_tokens.get(user_id, ())):
+                self._remove(token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._user_tokens.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+        }
+
+    def _remove(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            user_id = entry[1].pk
+            tokens = self._user_tokens.get(user_id)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._user_tokens[user_id]
+
+
+token_cache = TokenCache()
@@ -1,18 +1,19 @@
 from django.conf import settings
 
+from SimpleChatApi.replicas import read_db, write_db
 from .models import Member
 
 
 class MyDBRouter(object):
 
     def db_for_read(self, model, **hints):
-        """ reading SomeModel from otherdb """
-        if model == Member and settings.USE_IPB:
-            return 'chats'
+        """ reading SomeModel from otherdb, or one of its replicas """
+        if model == Member:
+            return read_db('chats' if settings.USE_IPB else None)
         return None
 
     def db_for_write(self, model, **hints):
         """ writing SomeModel to otherdb """
-        if model == Member and settings.USE_IPB:
-            return 'chats'
+        if model == Member:
+            return write_db('chats' if settings.USE_IPB else None)
         return None
@@ -1,7 +1,7 @@
 from django.http import HttpRequest
 from django.utils.deprecation import MiddlewareMixin
 
-from user.models import MemberToken
+from user.cache import token_cache
 
 
 class TokenMiddleware(MiddlewareMixin):
@@ -12,6 +12,6 @@ class TokenMiddleware(MiddlewareMixin):
         token = request.headers.get('X-API-Key')
         if token and not request.user.is_authenticated:
             request.token = token
-            request.user = MemberToken.objects.get(token=token).user
+            request.user = token_cache.resolve(token)
         else:
             request.token = None
@@ -6,13 +6,15 @@ from uuid import uuid4
 
 from django.conf import settings
 from django.contrib.auth import authenticate as django_authenticate
-from django.contrib.auth.base_user import AbstractBaseUser
+from django.contrib.auth.base_user import AbstractBaseUser, BaseUserManager
 from django.contrib.auth.models import AbstractUser
 from django.db import models
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.http import HttpRequest
 
+from user.cache import token_cache
+from user.presence import presence
 from user.utils import ipb_oauth_authenticate
 
 assert settings.USE_IPB is not None
@@ -32,6 +34,8 @@ class User(AbstractBaseUser):
     USERNAME_FIELD = 'name'
     EMAIL_FIELD = 'email'
 
+    objects = BaseUserManager()
+
     @property
     def member(self):
         return Member.objects.get(member_id=self.member_id)
@@ -49,6 +53,7 @@ class User(AbstractBaseUser):
         :type password: str
         :return: user and its token
         :rtype: (User|None, Member|None, str|None)
+        :raises user.utils.IPBUnavailable: the forum couldn't check the credentials
         """
         if settings.USE_IPB:
             authenticated, token = ipb_oauth_authenticate(name, password)
@@ -60,14 +65,14 @@ class User(AbstractBaseUser):
                 except User.DoesNotExist:
                     user = User.objects.create(member_id=member.member_id, name=name, email=member.email)
                 tk = MemberToken.objects.create(ipb_token=token, user=user)
-                member.save()
+                presence.touch(member.member_id)
                 return user, member, tk.token
         else:
-            user: User = django_authenticate(request=request, name=name)
+            user: User = django_authenticate(request=request, name=name, password=password)
             if user is not None:
                 member = Member.objects.get(name=name)
-                member.save()
-                tk = MemberToken.objects.create(member_id=member.member_id)
+                presence.touch(member.member_id)
+                tk = MemberToken.objects.create(user=user)
                 return user, member, tk.token
 
         return None, None, None
@@ -141,8 +146,14 @@ class MemberToken(models.Model):
 @receiver(pre_save, sender=User)
 def pre_save_user(sender, instance, **kwargs):
     if instance.pk is not None:
-        member = Member.objects.get(member_id=instance.member_id)
-        member.save()
+        presence.touch(instance.member_id)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_tokens(sender, instance, **kwargs):
+    # a cached copy would keep a banned or deleted user authenticated
+    token_cache.invalidate_user(instance.pk)
 
 
 @receiver(pre_save, sender=Member)
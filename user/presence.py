@@ -0,0 +1,116 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from django.db import connections
+from django.db.models import Case, F, Value, When
+
+from SimpleChatApi.metrics import database_sync_to_async
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', 10))
+PRESENCE_BATCH_SIZE = 500
+
+
+class PresenceBuffer:
+    """
+    Write-behind buffer for ``Member.last_activity``.
+
+    ``touch`` only records the timestamp in memory, a background thread writes everything
+    collected every ``interval`` seconds with one ``UPDATE ... CASE`` per batch of members.
+    Pending timestamps are flushed on interpreter exit. With an interval <= 0 every touch
+    is written right away, use ``atouch`` from async code.
+    """
+
+    def __init__(self, interval: float = PRESENCE_FLUSH_INTERVAL, batch_size: int = PRESENCE_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    async def atouch(self, member_id: int, timestamp: Optional[int] = None):
+        """
+        ``touch`` for the event loop, an interval <= 0 writes in a database thread.
+        """
+        if self.interval <= 0:
+            return await database_sync_to_async(self.touch)(member_id, timestamp)
+        self.touch(member_id, timestamp)
+
+    def touch(self, member_id: int, timestamp: Optional[int] = None):
+        timestamp = timestamp or int(time.time())
+        with self._lock:
+            if self._pending.get(member_id, 0) < timestamp:
+                self._pending[member_id] = timestamp
+        if self.interval <= 0:
+            self.flush()
+        elif self._thread is None:
+            self.start()
+
+    def flush(self) -> int:
+        """
+        :return: number of members written
+        """
+        from user.models import Member
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        items = list(pending.items())
+        for i in range(0, len(items), self.batch_size):
+            batch = items[i:i + self.batch_size]
+            try:
+                # update() skips memberPreSave, which would overwrite last_activity with the flush time
+                Member.objects.filter(member_id__in=[member_id for member_id, _ in batch]).update(
+                    last_activity=Case(
+                        *[When(member_id=member_id, then=Value(timestamp)) for member_id, timestamp in batch],
+                        default=F('last_activity'),
+                    )
+                )
+            except Exception:
+                # this batch and the next ones were not written, keep them for the next flush
+                with self._lock:
+                    for member_id, timestamp in items[i:]:
+                        if self._pending.get(member_id, 0) < timestamp:
+                            self._pending[member_id] = timestamp
+                raise
+        return len(items)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='presence-flush', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Stop the flush thread and write what is left.
+        """
+        thread = self._thread
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+            self._thread = None
+            atexit.unregister(self.stop)
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                # kept for the next flush, the thread must outlive a database outage
+                logger.exception('Writing the member activity failed')
+            finally:
+                # the connections of this thread would otherwise never be closed
+                connections.close_all()
+
+
+presence = PresenceBuffer()
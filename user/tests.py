@@ -1,3 +1,200 @@
-from django.test import TestCase
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs
 
-# Create your tests here.
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TestCase
+
+from api.management.commands._utils import ensure_tables
+from user.models import Member
+from user.presence import PresenceBuffer
+from user.utils import CircuitBreaker, IPBOAuthClient, IPBUnavailable
+
+
+class FakeTokenHandler(BaseHTTPRequestHandler):
+    """
+    Token endpoint of the forum: ``pw`` is the only valid password, ``server.mode`` makes it slow or failing
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.server.clients.add(self.client_address)
+        body = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        if self.server.mode == 'slow':
+            time.sleep(0.5)
+        if self.server.mode == 'down':
+            code = 500
+        else:
+            code = 200 if body['password'] == ['pw'] else 401
+        if self.server.mode == 'garbled':
+            data = json.dumps(['token']).encode()
+        else:
+            data = json.dumps({'access_token': 'token'} if code == 200 else {'error': 'invalid_grant'}).encode()
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeTokenServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # the client gave up on the slow answers
+        pass
+
+
+class IPBOAuthClientTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = FakeTokenServer(('127.0.0.1', 0), FakeTokenHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.mode = 'ok'
+        self.server.clients = set()
+        self.client = IPBOAuthClient(f'http://127.0.0.1:{self.server.server_port}/token', 'id', 'secret',
+                                     timeout=(0.5, 0.2), breaker=CircuitBreaker(failures=2, reset=0.3))
+
+    def tearDown(self):
+        self.client.session.close()
+
+    def test_credentials(self):
+        self.assertEqual(self.client.authenticate('member', 'pw'), (True, 'token'))
+        self.assertEqual(self.client.authenticate('member', 'wrong'), (False, ''))
+        self.assertEqual(self.client.authenticate('member', 'pw'), (True, 'token'))
+        # one keep-alive connection for the three requests
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_unexpected_answer(self):
+        self.server.mode = 'garbled'
+        self.assertEqual(self.client.authenticate('member', 'pw'), (False, ''))
+        self.assertEqual(self.client.breaker.allow(), 0)
+
+    def test_circuit_opens_and_closes(self):
+        self.server.mode = 'slow'
+        for _ in range(2):
+            with self.assertRaisesMessage(IPBUnavailable, 'timed out'):
+                self.client.authenticate('member', 'pw')
+        self.server.mode = 'ok'
+        with self.assertRaisesMessage(IPBUnavailable, 'circuit is open') as raised:
+            self.client.authenticate('member', 'pw')
+        self.assertGreater(raised.exception.retry_after, 0)
+
+        time.sleep(0.35)
+        self.assertEqual(self.client.authenticate('member', 'pw'), (True, 'token'))
+        self.assertEqual(self.client.breaker.allow(), 0)
+
+    def test_server_errors_open_the_circuit(self):
+        self.server.mode = 'down'
+        for _ in range(2):
+            with self.assertRaisesMessage(IPBUnavailable, 'answered 500'):
+                self.client.authenticate('member', 'pw')
+        with self.assertRaisesMessage(IPBUnavailable, 'circuit is open'):
+            self.client.authenticate('member', 'pw')
+        # refused credentials are answers, they don't count as failures
+        self.server.mode = 'ok'
+        time.sleep(0.35)
+        self.assertEqual(self.client.authenticate('member', 'wrong'), (False, ''))
+        self.assertEqual(self.client.breaker.allow(), 0)
+
+    def test_unexpected_error_ends_the_trial(self):
+        self.server.mode = 'down'
+        for _ in range(2):
+            with self.assertRaises(IPBUnavailable):
+                self.client.authenticate('member', 'pw')
+        time.sleep(0.35)
+        with mock.patch.object(self.client.session, 'post', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                self.client.authenticate('member', 'pw')
+        # the failed trial opened the circuit again instead of leaving it waiting for the trial forever
+        self.server.mode = 'ok'
+        time.sleep(0.35)
+        self.assertEqual(self.client.authenticate('member', 'pw'), (True, 'token'))
+
+
+
+class CircuitBreakerTest(SimpleTestCase):
+    def test_opens_after_failures(self):
+        breaker = CircuitBreaker(failures=3, reset=10)
+        for _ in range(2):
+            breaker.failure()
+        self.assertEqual(breaker.allow(), 0)
+        breaker.failure()
+        self.assertGreater(breaker.allow(), 9)
+
+    def test_success_resets_the_count(self):
+        breaker = CircuitBreaker(failures=2, reset=10)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertEqual(breaker.allow(), 0)
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(failures=1, reset=0.05)
+        breaker.failure()
+        self.assertGreater(breaker.allow(), 0)
+        time.sleep(0.06)
+        # a single trial call
+        self.assertEqual(breaker.allow(), 0)
+        self.assertGreater(breaker.allow(), 0)
+        # a failed trial opens the circuit for another reset period
+        breaker.failure()
+        self.assertGreater(breaker.allow(), 0)
+        time.sleep(0.06)
+        self.assertEqual(breaker.allow(), 0)
+        breaker.success()
+        self.assertEqual(breaker.allow(), 0)
+        self.assertEqual(breaker.allow(), 0)
+
+
+class PresenceBufferTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # the IPB tables have no migrations
+        ensure_tables()
+        super().setUpClass()
+
+    def setUp(self):
+        self.members = [Member.objects.create(name=f'member{i}') for i in range(3)]
+        self.buffer = PresenceBuffer(interval=3600, batch_size=2)
+        self.addCleanup(self.buffer.stop)
+
+    def activity(self) -> list:
+        return [Member.objects.get(pk=member.pk).last_activity for member in self.members]
+
+    def test_flush(self):
+        for i, member in enumerate(self.members):
+            self.buffer.touch(member.pk, 1000 + i)
+        # an older touch doesn't move the activity back
+        self.buffer.touch(self.members[0].pk, 10)
+        self.assertEqual(self.activity(), [member.last_activity for member in self.members])
+
+        with self.assertNumQueries(2):
+            self.assertEqual(self.buffer.flush(), 3)
+        self.assertEqual(self.activity(), [1000, 1001, 1002])
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_failed_batch_is_restored(self):
+        for i, member in enumerate(self.members):
+            self.buffer.touch(member.pk, 1000 + i)
+        with mock.patch('django.db.models.query.QuerySet.update', side_effect=[1, DatabaseError('gone')]):
+            with self.assertRaises(DatabaseError):
+                self.buffer.flush()
+        # touched again meanwhile, the newest timestamp wins
+        self.buffer.touch(self.members[2].pk, 2000)
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(self.activity()[2], 2000)
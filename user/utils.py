@@ -1,7 +1,24 @@
+import logging
 import os
+import threading
+import time
+from typing import Optional, Tuple
 
 import requests
 from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from SimpleChatApi.metrics import IPB_OAUTH_CIRCUIT_OPEN, IPB_OAUTH_SECONDS
+
+logger = logging.getLogger(__name__)
+
+OAUTH_CONNECT_TIMEOUT = float(os.environ.get('OAUTH_CONNECT_TIMEOUT', 3))
+OAUTH_READ_TIMEOUT = float(os.environ.get('OAUTH_READ_TIMEOUT', 5))
+# keep-alive connections to the forum kept by the worker
+OAUTH_POOL_SIZE = int(os.environ.get('OAUTH_POOL_SIZE', 10))
+# failed requests in a row that open the circuit, and seconds before a request is tried again
+OAUTH_BREAKER_FAILURES = int(os.environ.get('OAUTH_BREAKER_FAILURES', 5))
+OAUTH_BREAKER_RESET = float(os.environ.get('OAUTH_BREAKER_RESET', 30))
 
 if settings.USE_IPB:
     SITE_URL = os.environ.get('SITE_URL')
@@ -20,17 +37,130 @@ if settings.USE_IPB:
     assert BENLOTUS_API_KEY
 
 
+class IPBUnavailable(Exception):
+    """
+    The forum didn't answer, or failed too often lately, the credentials were not checked.
+    """
+
+    def __init__(self, message: str, retry_after: float = 0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Opens after ``failures`` failed calls in a row, calls are refused while it is open.
+    ``reset`` seconds later a single call goes through (half open), it closes the circuit again if it succeeds.
+    """
+
+    def __init__(self, failures: int = OAUTH_BREAKER_FAILURES, reset: float = OAUTH_BREAKER_RESET):
+        self.failures = failures
+        self.reset = reset
+        self._failed = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> float:
+        """
+        :return: seconds until a call is allowed, 0 when it is allowed now
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            if (wait := self._opened_at + self.reset - time.monotonic()) > 0:
+                return wait
+            if self._trial:
+                # the trial call is still running
+                return self.reset
+            self._trial = True
+            return 0
+
+    def success(self):
+        with self._lock:
+            self._failed = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failed += 1
+            if self._trial or (self._opened_at is None and self._failed >= self.failures):
+                logger.warning('IPB OAuth circuit opened after %d failures', self._failed)
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+
+class IPBOAuthClient:
+    """
+    Password grant against the IPB OAuth token endpoint over a keep-alive session shared by the threads
+    of the worker, with connect and read timeouts and a circuit breaker.
+    """
+
+    def __init__(self, token_url: str, client_id: str, client_secret: str, scope: str = 'movie',
+                 timeout: Tuple[float, float] = (OAUTH_CONNECT_TIMEOUT, OAUTH_READ_TIMEOUT),
+                 pool_size: int = OAUTH_POOL_SIZE, breaker: Optional[CircuitBreaker] = None):
+        self.token_url = token_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.scope = scope
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.session = requests.Session()
+        # requests only retries connections refused before anything was sent, the breaker handles the rest
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def authenticate(self, username: str, password: str) -> Tuple[bool, str]:
+        """
+        :return: whether the credentials are valid and the access token
+        :raises IPBUnavailable: the forum is down, slow or failing
+        """
+        if retry_after := self.breaker.allow():
+            IPB_OAUTH_CIRCUIT_OPEN.inc()
+            raise IPBUnavailable('IPB OAuth circuit is open', retry_after)
+        payload = {'grant_type': 'password',
+                   'username': username,
+                   'password': password,
+                   'scope': self.scope,
+                   'client_id': self.client_id,
+                   'client_secret': self.client_secret}
+        start = time.perf_counter()
+        # any error fails the call, not only the request ones, a trial call must not keep the circuit waiting
+        failure = 'error'
+        try:
+            response = self.session.post(self.token_url, data=payload, timeout=self.timeout)
+            if response.status_code >= 500:
+                raise IPBUnavailable(f'IPB OAuth answered {response.status_code}')
+            failure = None
+        except requests.Timeout as e:
+            failure = 'timeout'
+            raise IPBUnavailable(f'IPB OAuth timed out: {e}') from e
+        except requests.RequestException as e:
+            raise IPBUnavailable(f'IPB OAuth request failed: {e}') from e
+        finally:
+            if failure:
+                IPB_OAUTH_SECONDS.observe(time.perf_counter() - start, failure)
+                self.breaker.failure()
+
+        # a refused login is an answer, the forum works
+        self.breaker.success()
+        try:
+            data = response.json() if response.status_code == 200 else None
+        except ValueError:
+            data = None
+        # anything but an object with a string token is a refusal
+        token = data.get('access_token') if isinstance(data, dict) else None
+        if not isinstance(token, str):
+            token = None
+        IPB_OAUTH_SECONDS.observe(time.perf_counter() - start, 'ok' if token else 'denied')
+        return (True, token) if token else (False, '')
+
+
+ipb_oauth: Optional[IPBOAuthClient] = IPBOAuthClient(OAUTH_ACCESS_TOKEN_URL, CLIENT_ID, CLIENT_SECRET) \
+    if settings.USE_IPB else None
+
+
 def ipb_oauth_authenticate(username: str, password: str) -> (bool, str):
-    payload = {'grant_type': 'password',
-               'username': username,
-               'password': password,
-               'scope': 'movie',
-               'client_id': CLIENT_ID,
-               'client_secret': CLIENT_SECRET}
-    try:
-        response = requests.request("POST", OAUTH_ACCESS_TOKEN_URL, data=payload)
-        if response.status_code == 200 and response.json().get('access_token'):
-            return True, response.json().get('access_token')
-    except Exception as e:
-        print(e)
-    return False, ''
+    return ipb_oauth.authenticate(username, password)
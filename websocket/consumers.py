@@ -1,21 +1,49 @@
+import asyncio
+import logging
 import os
+import zlib
 from typing import Dict, Optional
 
-from asgiref.sync import async_to_sync
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
 
-from api.serializers import ConversationPostModelSerializer
-from api.utils import postSerializerAsync, get_conv
+from SimpleChatApi.instrumentation import collect, command_stats
+from SimpleChatApi.metrics import database_sync_to_async, WEBSOCKET_CONNECTIONS, WEBSOCKET_RECEIVED, \
+    WEBSOCKET_SENT, WORKER
+from SimpleChatApi.ratelimit import get_rate_limiter
+from SimpleChatApi.replicas import apin, replica_session
+from api.utils import get_conv, conversationPage, search_posts, syncConversations
+from core.ingest import post_writer
 from core.models import Conversation
+from core.search import SearchUnavailable
+from core.utils import SendMessage
 from user.models import User
+from user.presence import presence
+from websocket.framing import DEFAULT_FRAMING, Framing, framings, negotiate
+from websocket.outbox import Outbox
+from websocket.registry import BaseConnectionRegistry, get_registry
 from websocket.serializers import BaseEventSerializer, GetConversationSerializerData, Response, \
-    SetConversationSerializer, SendMessageSerializer
+    SetConversationSerializer, SendMessageSerializer, GetOnlineSerializer, SearchSerializer, \
+    SyncSerializer
 
 PageSize = int(os.environ.get('PAGE_SIZE', 50))
 
 UPDATE_TIME = os.environ.get('UPDATE_TIME')
 assert UPDATE_TIME
 
+logger = logging.getLogger(__name__)
+
+
+class ConversationUnavailable(Exception):
+    """
+    Raised by the conversation lookup only, so errors of the command itself are not taken for membership errors
+    """
+
+    def __init__(self, message: str, code: int):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+
 
 def consumer_logged_in_req(func):
     async def wrapper(*args, **kwargs):
@@ -32,18 +60,68 @@ class BaseConsumer(AsyncJsonWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.user: User = None
+        self.framing: Framing = framings[DEFAULT_FRAMING]
+        self.outbox: Optional[Outbox] = None
 
     @consumer_logged_in_req
     async def connect(self):
         self.user = self.scope['user']
-        await self.accept()
+        self.framing, subprotocol = negotiate(self.scope.get('subprotocols', []))
+        await self.accept(subprotocol=subprotocol)
+        self.outbox = Outbox(self._send_frame, max_size=settings.WEBSOCKET_SEND_QUEUE_SIZE,
+                             window=settings.WEBSOCKET_COALESCE_MS / 1000, policy=settings.WEBSOCKET_OVERFLOW_POLICY,
+                             on_overflow=self._send_queue_full, on_error=self._send_failed)
+        self.outbox.start()
+
+    async def disconnect(self, close_code):
+        if self.outbox is not None:
+            await self.outbox.stop()
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        try:
+            content = self.framing.decode(text_data, bytes_data)
+        except (ValueError, zlib.error):
+            return await self.send_json(Response.error_response(message="Invalid frame", from_command=None))
+        await self.receive_json(content, **kwargs)
+
+    async def send_json(self, content, close=False):
+        """
+        Queued in the outbox once connected, encoded with the framing negotiated at connect
+        """
+        if self.outbox is None:
+            return await self._send_frame(content, close=close)
+        if close:
+            await self.outbox.flush()
+            return await self._send_frame(content, close=close)
+        self.outbox.push(content)
+
+    async def _send_frame(self, content, close=False):
+        text_data, bytes_data = self.framing.encode(content)
+        await self.send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+    async def _send_queue_full(self):
+        """
+        The client doesn't read fast enough, with the disconnect overflow policy
+        """
+        await self.close(code=4008)
+
+    async def _send_failed(self):
+        """
+        The outbox could not send a frame, the client must reconnect and sync
+        """
+        await self.close(code=1011)
 
 
 class ChatConsumer(BaseConsumer):
-    consumers = {}
-    """
-    :type consumers: Dict[str, BaseConsumer]
-    """
+    # command type -> handler method
+    commands = {
+        'get-conv': 'handle_get_conv',
+        'set-chat-id': 'handle_set_chat_id',
+        'send-message': 'handle_send_message',
+        'get-online': 'handle_get_online',
+        'search': 'handle_search',
+        'sync': 'handle_sync',
+    }
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -51,54 +129,137 @@ class ChatConsumer(BaseConsumer):
         self.con_id: Optional[int] = None
         self.conversation: Optional[Conversation] = None
         self.last_update: int = 0
+        self._heartbeat_task: Optional[asyncio.Task] = None
 
     async def connect(self):
         await super().connect()
-        if (_x := self.consumers.get(self.user.name)) and not _x.close():
-            ChatConsumer.consumers[self.user.name] = self
-        async_to_sync(self.channel_layer.group_add)(
-            'update',
+        if self.user is None:
+            return
+        registry = get_registry()
+        # only one socket per user, close the older ones wherever they are connected
+        for channel_name in await registry.add(self.user.member_id, self.channel_name):
+            await self.channel_layer.send(channel_name, {'type': 'session.replaced'})
+        self._heartbeat_task = asyncio.create_task(self._heartbeat(registry))
+        WEBSOCKET_CONNECTIONS.inc(WORKER)
+        await self.channel_layer.group_add(
+            SendMessage.user_group(self.user.member_id),
             self.channel_name
         )
 
+    async def _heartbeat(self, registry: BaseConnectionRegistry):
+        while True:
+            await asyncio.sleep(registry.ttl / 3)
+            await registry.heartbeat(self.user.member_id, self.channel_name)
+
+    async def session_replaced(self, event):
+        """
+        The user connected again, sent by ``connect`` of the new socket
+        """
+        await self.close(code=4001)
+
     async def disconnect(self, close_code):
-        ChatConsumer.consumers.pop(self.user.name, None)
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        if self.user is not None:
+            WEBSOCKET_CONNECTIONS.dec(WORKER)
+            await get_registry().remove(self.user.member_id, self.channel_name)
+            await self.channel_layer.group_discard(SendMessage.user_group(self.user.member_id), self.channel_name)
+        if self.con_id:
+            await self.channel_layer.group_discard(SendMessage.conversation_group(self.con_id), self.channel_name)
         await super(ChatConsumer, self).disconnect(close_code)
 
-    async def update(self, content):
+    async def _set_con_id(self, con_id: Optional[int]):
+        """
+        Move this socket from the group of the current conversation to the one of ``con_id``.
+        """
+        if self.con_id == con_id:
+            return
         if self.con_id:
-            conversation = self.conversation
-            if not conversation:
-                conversation = await get_conv(self.user, self.con_id, _async=True)
+            await self.channel_layer.group_discard(SendMessage.conversation_group(self.con_id), self.channel_name)
+        if con_id:
+            await self.channel_layer.group_add(SendMessage.conversation_group(con_id), self.channel_name)
+        self.con_id = con_id
 
-            posts = await conversation.get_posts(load_from=None, load_to=None, last_update=self.last_update,
-                                                 _async=True, max_size=PageSize)
+    async def chat(self, event):
+        """
+        New post in the conversation this socket is on, sent by ``SendMessage.send_post``
+        """
+        await self.send_response('message', event['data'])
 
-            if not posts.exists():
-                return False
+    async def notify(self, event):
+        """
+        New post in one of the user conversations, sent by ``SendMessage.send_post``
+        """
+        # the socket already got the full post through the conversation group
+        if event['data']['chatID'] != self.con_id:
+            await self.send_response('notify', event['data'])
 
-            return ConversationPostModelSerializer(posts, many=True).data
-            # TODO: do from here
+    async def update(self, event):
+        """
+        Conversation briefs, sent by ``core.update.Update``
+        """
+        await self.send_response('update', {
+            "conversations": event['data']
+        })
 
     async def receive_json(self, content: Dict, **kwargs):
         print(content)
+        await presence.atouch(self.user.member_id)
         if (serialized := BaseEventSerializer(data=content)) is None or serialized.is_valid():
             content = serialized.validated_data
-            if content['type'] == 'get-conv':
-                return await self.handle_get_conv(content['data'])
-            elif content['type'] == 'set-chat-id':
-                return await self.handle_set_chat_id(content['data'])
-            elif content['type'] == 'send-message':
-                return await self.handle_send_message(content['data'])
+            WEBSOCKET_RECEIVED.inc(content['type'] if content['type'] in self.commands else 'unknown')
+            if handler := self.commands.get(content['type']):
+                # before any database work of the command
+                if retry_after := await get_rate_limiter().acheck(self.user.member_id, content['type']):
+                    return await self.send_error(message="Too many requests", code=429, from_command=content['type'],
+                                                 retryAfter=round(retry_after, 3))
+                # the pin is read by the first database read of the command, in its thread
+                with collect(content['type']) as stats, replica_session(self.user.member_id):
+                    result = await getattr(self, handler)(content['data'])
+                command_stats.add(stats)
+                return result
 
         return await self.send_error(message="Invalid data", code=400, from_command=content.get('type'))
 
-    async def send_error(self, message: str, from_command: str, code: int = 400):
-        return await self.send_json(Response.error_response(message=message, code=code, from_command=from_command))
+    async def send_error(self, message: str, from_command: str, code: int = 400, **extra):
+        WEBSOCKET_SENT.inc('error')
+        return await self.send_json(Response.error_response(message=message, code=code, from_command=from_command,
+                                                            **extra))
 
     async def send_response(self, _type: str, data: Dict):
+        WEBSOCKET_SENT.inc(_type)
         return await self.send_json(Response.response(_type, data))
 
+    def _cached_conversation(self, pk: int) -> Optional[Conversation]:
+        return self.conversation if pk == self.con_id else None
+
+    def _conversation(self, pk: int, cached: bool = True) -> Conversation:
+        """
+        Sync, run it inside the database thread hop of the command
+
+        :param cached: whether the conversation of the connection can be returned without reading it
+
+        :raises ConversationUnavailable: the conversation doesn't exist or the user isn't in it
+        """
+        try:
+            return (cached and self._cached_conversation(pk)) or get_conv(self.user, pk)
+        except Conversation.DoesNotExist:
+            # TODO: create conversation
+            raise ConversationUnavailable("Conversation does not exist", 404)
+        except ValueError:
+            raise ConversationUnavailable("You are not in this conversation", 403)
+
+    async def _conversation_unavailable(self, pk: int, error: ConversationUnavailable, from_command: str):
+        if self.con_id == pk:
+            await self._set_con_id(None)
+        return await self.send_error(message=error.message, code=error.code, from_command=from_command)
+
+    def _conversation_page(self, pk: int, data: Dict) -> Dict:
+        return conversationPage(self._conversation(pk), data, max_size=PageSize)
+
+    def _post(self, pk: int, content: str):
+        return self._conversation(pk).post(content=content, member_id=self.user.member_id)
+
     async def handle_get_conv(self, data: Dict):
         if (serialized := GetConversationSerializerData(data=data)) is None or serialized.is_valid():
             data = serialized.validated_data
@@ -106,30 +267,12 @@ class ChatConsumer(BaseConsumer):
                 if not (pk := self.con_id):
                     return await self.send_error('No chatID', from_command="get-conv")
             try:
-                conversation = None
-                if pk == self.con_id:
-                    conversation = self.conversation
-                if not conversation:
-                    conversation = await get_conv(self.user, pk, _async=True)
-            except Conversation.DoesNotExist:
-                # TODO: create conversation
-                if self.con_id == pk:
-                    self.con_id = None
-                return await self.send_error(message="Conversation does not exist", code=404, from_command="get-conv")
-            except ValueError:
-                if self.con_id == pk:
-                    self.con_id = None
-                return await self.send_error(message="You are not in this conversation", code=403,
-                                             from_command="get-conv")
-
-            load_from = data.get("loadFrom")
-            load_to = data.get("loadTo")
-            last_update = data.get("lastUpdate")
-            posts = conversation.get_posts(load_from=load_from, load_to=load_to, last_update=last_update,
-                                           order_by='chat_id')
-            return await self.send_response('get-conv', {
-                "messages": (await postSerializerAsync(posts=posts[:PageSize], many=True))
-            })
+                # conversation and page in a single database thread hop
+                page = await database_sync_to_async(self._conversation_page)(pk, data)
+            except ConversationUnavailable as e:
+                return await self._conversation_unavailable(pk, e, "get-conv")
+
+            return await self.send_response('get-conv', page)
         else:
             return await self.send_error(message=serialized.errors.__str__(), from_command="get-conv")
 
@@ -138,20 +281,12 @@ class ChatConsumer(BaseConsumer):
             data = serialized.validated_data
             pk = data['chatID']
             try:
-                conversation = await get_conv(self.user, pk=pk, _async=True)
-                self.conversation = conversation
-            except Conversation.DoesNotExist:
-                # TODO: create conversation
-                if self.con_id == pk:
-                    self.con_id = None
-                return await self.send_error(message="Conversation does not exist", code=404, from_command="set-chatID")
-            except ValueError:
-                if self.con_id == pk:
-                    self.con_id = None
-                return await self.send_error(message="You are not in this conversation", code=403,
-                                             from_command="set-chatID")
-
-            self.con_id = pk
+                # membership is checked again when the same conversation is set twice
+                self.conversation = await database_sync_to_async(self._conversation)(pk, cached=False)
+            except ConversationUnavailable as e:
+                return await self._conversation_unavailable(pk, e, "set-chatID")
+
+            await self._set_con_id(pk)
             return await self.send_response('set-chatID', {
                 "success": True
             })
@@ -163,26 +298,55 @@ class ChatConsumer(BaseConsumer):
                 if not (pk := self.con_id):
                     return await self.send_error('No chatID', from_command="get-conv")
             try:
-                conversation = None
-                if pk == self.con_id:
-                    conversation = self.conversation
-                if not conversation:
-                    conversation = await get_conv(self.user, pk, _async=True)
-            except Conversation.DoesNotExist:
-                # TODO: create conversation
-                if self.con_id == pk:
-                    self.con_id = None
-                return await self.send_error(message="Conversation does not exist", code=404,
-                                             from_command="send-message")
-            except ValueError:
-                if self.con_id == pk:
-                    self.con_id = None
-                return await self.send_error(message="You are not in this conversation", code=403,
-                                             from_command="send-message")
-
-            conversation.post_async(member_id=self.user.member_id, content=data['message'])
+                if settings.BATCHED_SEND:
+                    conversation = self._cached_conversation(pk) or \
+                                   await database_sync_to_async(self._conversation)(pk)
+                    post = await post_writer.submit(conversation, content=data['message'],
+                                                    member_id=self.user.member_id)
+                    # written by the writer task, outside of the replica session of this command
+                    await apin(self.user.member_id)
+                else:
+                    # conversation and post in a single database thread hop
+                    post = await database_sync_to_async(self._post)(pk, data['message'])
+            except ConversationUnavailable as e:
+                return await self._conversation_unavailable(pk, e, "send-message")
+            except Exception:
+                # a database error must not close the socket, the client may send it again
+                logger.exception('Sending a message to conversation %s failed', pk)
+                return await self.send_error(message="Message not sent", code=500, from_command="send-message")
+
             return await self.send_response('send-message', {
-                "success": True
+                "success": True,
+                "id": post.chat_id
             })
 
         return await self.send_error(message=serialized.errors.__str__(), from_command="send-message")
+
+    async def handle_get_online(self, data: Dict):
+        if (serialized := GetOnlineSerializer(data=data)) is None or serialized.is_valid():
+            online = await get_registry().online(serialized.validated_data['ids'])
+            return await self.send_response('get-online', {
+                "online": sorted(online)
+            })
+
+        return await self.send_error(message=serialized.errors.__str__(), from_command="get-online")
+
+    async def handle_search(self, data: Dict):
+        if (serialized := SearchSerializer(data=data)) is None or serialized.is_valid():
+            data = serialized.validated_data
+            try:
+                page = await database_sync_to_async(search_posts)(self.user.member_id, data['q'], data['page'],
+                                                                  PageSize, data.get('chatID'))
+            except SearchUnavailable:
+                return await self.send_error(message="Search is not available", code=501, from_command="search")
+            return await self.send_response('search', page)
+
+        return await self.send_error(message=serialized.errors.__str__(), from_command="search")
+
+    async def handle_sync(self, data: Dict):
+        if (serialized := SyncSerializer(data=data)) is None or serialized.is_valid():
+            changes = await database_sync_to_async(syncConversations)(self.user.member_id,
+                                                                      serialized.validated_data.get('token'))
+            return await self.send_response('sync', changes)
+
+        return await self.send_error(message=serialized.errors.__str__(), from_command="sync")
@@ -0,0 +1,90 @@
+import json
+import os
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import msgpack
+except ImportError:  # optional, only the json framings are offered without it
+    msgpack = None
+
+# fallback when the client asks for no subprotocol
+DEFAULT_FRAMING = 'json'
+SUBPROTOCOL_PREFIX = 'chat.'
+# bytes a compressed client frame may inflate to
+MAX_FRAME = int(os.environ.get('WEBSOCKET_MAX_FRAME_SIZE', 1024 * 1024))
+
+
+class Framing:
+    """
+    Wire format of the websocket messages of one connection, chosen by subprotocol at connect:
+    ``chat.json`` (text frames, the default), ``chat.msgpack`` (binary frames) and
+    their ``+deflate`` variants, where every frame is compressed on its own (raw deflate, no shared window).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.format, _, compression = name.partition('+')
+        self.deflate = compression == 'deflate'
+        self.binary = self.format == 'msgpack' or self.deflate
+
+    @property
+    def subprotocol(self) -> str:
+        return SUBPROTOCOL_PREFIX + self.name
+
+    def encode(self, content: Any) -> Tuple[Optional[str], Optional[bytes]]:
+        """
+        :return: text_data and bytes_data of the frame, one of them is None
+        """
+        if self.format == 'msgpack':
+            data = msgpack.packb(content)
+        else:
+            data = json.dumps(content)
+            if not self.deflate:
+                return data, None
+            data = data.encode()
+        if self.deflate:
+            compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+            data = compressor.compress(data) + compressor.flush()
+        return None, data
+
+    def decode(self, text_data: Optional[str] = None, bytes_data: Optional[bytes] = None) -> Any:
+        """
+        Clients may always send text json, binary frames are read with the negotiated framing.
+
+        :raises ValueError: a compressed frame inflates to more than ``MAX_FRAME`` bytes
+        """
+        if text_data is not None:
+            return json.loads(text_data)
+        if self.deflate:
+            # bounded, a few KB of deflate can inflate to gigabytes
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            bytes_data = decompressor.decompress(bytes_data, MAX_FRAME)
+            if decompressor.unconsumed_tail or decompressor.unused_data:
+                raise ValueError(f'Frame larger than {MAX_FRAME} bytes')
+        if self.format == 'msgpack':
+            return msgpack.unpackb(bytes_data)
+        return json.loads(bytes_data)
+
+
+def available() -> List[str]:
+    names = ['json', 'json+deflate']
+    if msgpack is not None:
+        names += ['msgpack', 'msgpack+deflate']
+    return names
+
+
+framings: Dict[str, Framing] = {name: Framing(name) for name in available()}
+
+
+def negotiate(subprotocols: List[str]) -> Tuple[Framing, Optional[str]]:
+    """
+    First framing of the client subprotocols this server supports.
+
+    :return: the framing and the subprotocol to accept, None when the client asked for none we know
+    """
+    for subprotocol in subprotocols:
+        if subprotocol.startswith(SUBPROTOCOL_PREFIX) and \
+                (framing := framings.get(subprotocol[len(SUBPROTOCOL_PREFIX):])):
+            return framing, subprotocol
+    return framings[DEFAULT_FRAMING], None
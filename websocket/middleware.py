@@ -1,18 +1,17 @@
 from channels.auth import AuthMiddlewareStack
-from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
 from django.contrib.auth.models import AnonymousUser
 
-from user.models import MemberToken
+from SimpleChatApi.metrics import database_sync_to_async
+from user.cache import token_cache
 
 
-@database_sync_to_async
-def get_user(token):
-    try:
-        token = MemberToken.objects.get(token=token)
-        return token.user
-    except MemberToken.DoesNotExist:
-        return AnonymousUser()
+async def get_user(token):
+    # only go to the database thread pool when the token is not cached
+    user = token_cache.get(token)
+    if user is None:
+        user = await database_sync_to_async(token_cache.load)(token)
+    return user or AnonymousUser()
 
 
 class TokenAuthMiddleware(BaseMiddleware):
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+from SimpleChatApi.metrics import WEBSOCKET_FRAMES_COALESCED, WEBSOCKET_SEND_QUEUE_OVERFLOWS
+
+logger = logging.getLogger(__name__)
+
+RESYNC = 'resync'
+DISCONNECT = 'disconnect'
+
+
+class Outbox:
+    """
+    Bounded outbound queue of one websocket, drained by its own task.
+
+    With a ``window`` > 0 the frames queued within ``window`` seconds of the first one are sent as a single
+    ``{"type": "batch", "data": [frames]}`` frame. At most ``max_size`` frames wait; when a slow client lets the
+    queue fill up, the ``resync`` policy drops everything queued and sends ``{"type": "resync"}`` (the client
+    catches up with the ``sync`` command), ``disconnect`` calls ``on_overflow`` so the socket can be closed.
+    When sending fails the drain task logs the error and calls ``on_error``, the outbox takes no more frames.
+    """
+
+    def __init__(self, send: Callable[[Dict], Awaitable], max_size: int, window: float = 0,
+                 policy: str = RESYNC, on_overflow: Optional[Callable[[], Awaitable]] = None,
+                 on_error: Optional[Callable[[], Awaitable]] = None):
+        if policy not in (RESYNC, DISCONNECT):
+            raise ValueError(f'Unknown overflow policy {policy}')
+        self.send = send
+        self.max_size = max_size
+        self.window = window
+        self.policy = policy
+        self.on_overflow = on_overflow
+        self.on_error = on_error
+        self._frames: Deque[Dict] = deque()
+        self._dropped = 0
+        self._ready = asyncio.Event()
+        # flush and the drain task take turns, the frames leave in order
+        self._sending = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._overflow_task: Optional[asyncio.Task] = None
+        self._error_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            self._task.add_done_callback(self._done)
+
+    def push(self, frame: Dict):
+        if self._closed:
+            return
+        if len(self._frames) >= self.max_size:
+            return self._overflow()
+        self._frames.append(frame)
+        self._ready.set()
+
+    async def flush(self):
+        """
+        Send what is queued now, from the calling task.
+        """
+        async with self._sending:
+            while frames := self._take():
+                await self._send(frames)
+
+    async def stop(self):
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                # logged by _done
+                pass
+            self._task = None
+        self._frames.clear()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def _overflow(self):
+        WEBSOCKET_SEND_QUEUE_OVERFLOWS.inc(self.policy)
+        if self.policy == DISCONNECT:
+            self._closed = True
+            self._frames.clear()
+            if self.on_overflow is not None:
+                # the loop only keeps a weak reference to its tasks
+                self._overflow_task = asyncio.create_task(self.on_overflow())
+            return
+        # the queued frames and the new one are stale, the client resyncs instead
+        self._dropped += len(self._frames) + 1
+        self._frames.clear()
+        self._ready.set()
+
+    def _done(self, task: asyncio.Task):
+        """
+        The drain task only ends when cancelled or when sending failed
+        """
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.error('Websocket send failed, closing', exc_info=task.exception())
+        self._closed = True
+        self._frames.clear()
+        if self.on_error is not None:
+            self._error_task = asyncio.create_task(self.on_error())
+
+    def _take(self) -> list:
+        """
+        Everything queued when coalescing, else the oldest frame, so the queue keeps counting the others
+        """
+        if self.window:
+            frames = list(self._frames)
+            self._frames.clear()
+        else:
+            frames = [self._frames.popleft()] if self._frames else []
+        if self._dropped:
+            frames.insert(0, {'type': RESYNC, 'data': {'dropped': self._dropped}})
+            self._dropped = 0
+        return frames
+
+    async def _send(self, frames: list):
+        if self.window and len(frames) > 1:
+            WEBSOCKET_FRAMES_COALESCED.inc(amount=len(frames))
+            await self.send({'type': 'batch', 'data': frames})
+        else:
+            for frame in frames:
+                await self.send(frame)
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            if self.window:
+                await asyncio.sleep(self.window)
+            self._ready.clear()
+            async with self._sending:
+                while frames := self._take():
+                    await self._send(frames)
@@ -0,0 +1,124 @@
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Optional, Set
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+class BaseConnectionRegistry(ABC):
+    """
+    Keeps track of the websocket channels of every user, across workers for shared backends.
+
+    A registration expires ``ttl`` seconds after the last ``add``/``heartbeat`` of the channel,
+    so a worker that dies without cleaning up only leaves stale entries for that long.
+    """
+
+    def __init__(self, ttl: int = 60):
+        self.ttl = ttl
+
+    async def add(self, user_id: int, channel_name: str) -> List[str]:
+        """
+        Register ``channel_name`` for ``user_id``.
+
+        :return: the other live channels of the user
+        """
+        channels = await self._load(user_id)
+        others = [channel for channel in channels if channel != channel_name]
+        channels[channel_name] = time.time() + self.ttl
+        await self._store(user_id, channels)
+        return others
+
+    async def heartbeat(self, user_id: int, channel_name: str):
+        channels = await self._load(user_id)
+        channels[channel_name] = time.time() + self.ttl
+        await self._store(user_id, channels)
+
+    async def remove(self, user_id: int, channel_name: str):
+        channels = await self._load(user_id)
+        if channels.pop(channel_name, None) is not None:
+            await self._store(user_id, channels)
+
+    async def channels(self, user_id: int) -> List[str]:
+        return list(await self._load(user_id))
+
+    async def is_online(self, user_id: int) -> bool:
+        return bool(await self._load(user_id))
+
+    async def online(self, user_ids: Iterable[int]) -> Set[int]:
+        return {user_id for user_id in user_ids if await self.is_online(user_id)}
+
+    @abstractmethod
+    async def _load(self, user_id: int) -> Dict[str, float]:
+        """
+        :return: unexpired channel -> expiry time of the user
+        """
+
+    @abstractmethod
+    async def _store(self, user_id: int, channels: Dict[str, float]):
+        pass
+
+    @staticmethod
+    def _alive(channels: Optional[Dict[str, float]]) -> Dict[str, float]:
+        now = time.time()
+        return {channel: expires for channel, expires in (channels or {}).items() if expires > now}
+
+
+class InMemoryConnectionRegistry(BaseConnectionRegistry):
+    """
+    Process local registry, only correct with a single worker. Meant for tests and development.
+    """
+
+    def __init__(self, ttl: int = 60):
+        super().__init__(ttl)
+        self._channels: Dict[int, Dict[str, float]] = {}
+
+    async def _load(self, user_id: int) -> Dict[str, float]:
+        return self._alive(self._channels.get(user_id))
+
+    async def _store(self, user_id: int, channels: Dict[str, float]):
+        if channels:
+            self._channels[user_id] = channels
+        else:
+            self._channels.pop(user_id, None)
+
+
+class CacheConnectionRegistry(BaseConnectionRegistry):
+    """
+    Registry shared through a django cache (redis, memcached, ...) so every worker sees the same users.
+
+    Updates are read-modify-write, a registration lost to a concurrent update of the same user
+    comes back with the next heartbeat of its channel.
+    """
+
+    def __init__(self, ttl: int = 60, cache: str = 'default', prefix: str = 'ws:conn:'):
+        super().__init__(ttl)
+        self.cache = caches[cache]
+        self.prefix = prefix
+
+    async def online(self, user_ids: Iterable[int]) -> Set[int]:
+        user_ids = list(user_ids)
+        found = await self.cache.aget_many([self.prefix + str(user_id) for user_id in user_ids])
+        return {user_id for user_id in user_ids if self._alive(found.get(self.prefix + str(user_id)))}
+
+    async def _load(self, user_id: int) -> Dict[str, float]:
+        return self._alive(await self.cache.aget(self.prefix + str(user_id)))
+
+    async def _store(self, user_id: int, channels: Dict[str, float]):
+        if channels:
+            await self.cache.aset(self.prefix + str(user_id), channels, timeout=self.ttl)
+        else:
+            await self.cache.adelete(self.prefix + str(user_id))
+
+
+_registry: Optional[BaseConnectionRegistry] = None
+
+
+def get_registry() -> BaseConnectionRegistry:
+    global _registry
+    if _registry is None:
+        config = getattr(settings, 'WEBSOCKET_REGISTRY', {})
+        backend = import_string(config.get('BACKEND', 'websocket.registry.InMemoryConnectionRegistry'))
+        _registry = backend(**config.get('OPTIONS', {}))
+    return _registry
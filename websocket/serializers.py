@@ -1,6 +1,6 @@
 from rest_framework import serializers
 
-from api.serializers import ConversationGetSerializer
+from api.serializers import ConversationGetSerializer, SearchSerializer, SyncSerializer
 
 
 class BaseEventSerializer(serializers.Serializer):
@@ -21,6 +21,10 @@ class SendMessageSerializer(serializers.Serializer):
     message = serializers.CharField(max_length=255, required=True)
 
 
+class GetOnlineSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), max_length=500, required=True)
+
+
 class Response:
     @staticmethod
     def response(_type: str, data: dict) -> dict:
@@ -30,12 +34,13 @@ class Response:
         }
 
     @staticmethod
-    def error_response(message: str, from_command: str, code: int = 400) -> dict:
+    def error_response(message: str, from_command: str, code: int = 400, **extra) -> dict:
         return Response.response(
             _type="error",
             data={
                 "from": from_command,
                 "message": message,
-                "code": code
+                "code": code,
+                **extra
             }
         )
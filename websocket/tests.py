@@ -1,3 +1,297 @@
-from django.test import TestCase
+import asyncio
+import time
+import zlib
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TransactionTestCase
+
+from SimpleChatApi.asgi import application
+from SimpleChatApi.ratelimit import InMemoryRateLimiter, parse_rate
+from api.management.commands._utils import ensure_tables
+from core.models import Conversation, ConversationUserMap
+from core.pagination import decode_sync_token
+from user.cache import token_cache
+from user.models import Member, MemberToken, User
+from websocket.framing import MAX_FRAME, framings, negotiate
+from websocket.outbox import DISCONNECT, Outbox
+from websocket.registry import CacheConnectionRegistry, InMemoryConnectionRegistry, get_registry
+
+
+class ConsumerTest(TransactionTestCase):
+    """
+    The consumer runs its database calls in other threads, the data must be committed
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        # the IPB tables have no migrations
+        ensure_tables()
+        super().setUpClass()
+
+    def setUp(self):
+        token_cache.clear()
+        patcher = mock.patch('SimpleChatApi.ratelimit._limiter', InMemoryRateLimiter(settings.RATE_LIMIT['RATES']))
+        self.limiter = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.members = [Member.objects.create(name=f'member{i}') for i in range(2)]
+        users = [User.objects.create(member_id=member.pk, name=member.name, email=f'{member.name}@example.com')
+                 for member in self.members]
+        self.token = MemberToken.objects.create(user=users[0]).token
+        self.conversation = Conversation.objects.create(con_name='group', con_users='', con_isGroup=1)
+        for member in self.members:
+            ConversationUserMap.objects.create(map_user_id=member.pk, map_con_id=self.conversation.pk)
+        self.post = self.conversation.post('hello', self.members[1].pk)
+
+    def commands(self, *commands: dict) -> list:
+        """
+        :return: the answer of every command
+        """
+        async def run():
+            communicator = WebsocketCommunicator(application, '/ws/chat/', headers=[(b'x-api-key', self.token.encode())])
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            answers = []
+            for command in commands:
+                await communicator.send_json_to(command)
+                answers.append(await communicator.receive_json_from(timeout=5))
+            await communicator.disconnect()
+            return answers
+
+        return async_to_sync(run)()
+
+    def test_fan_out(self):
+        other_token = MemberToken.objects.create(user=User.objects.get(member_id=self.members[1].pk)).token
+
+        async def frames(communicator) -> list:
+            received = []
+            while not await communicator.receive_nothing(0.3):
+                received.append(await communicator.receive_json_from())
+            return received
+
+        async def run():
+            sender = WebsocketCommunicator(application, '/ws/chat/', headers=[(b'x-api-key', self.token.encode())])
+            other = WebsocketCommunicator(application, '/ws/chat/', headers=[(b'x-api-key', other_token.encode())])
+            for communicator in (sender, other):
+                self.assertTrue((await communicator.connect())[0])
+            # the sender is on the conversation, the other member is not
+            await sender.send_json_to({'type': 'set-chat-id', 'data': {'chatID': self.conversation.pk}})
+            await frames(sender)
+            await sender.send_json_to({'type': 'send-message', 'data': {'message': 'hi'}})
+            received = await frames(sender), await frames(other)
+            for communicator in (sender, other):
+                await communicator.disconnect()
+            return received
+
+        sent, notified = async_to_sync(run)()
+        post = Conversation.objects.get(pk=self.conversation.pk).last_post
+        # the full post on the conversation group, a notification on the group of the member
+        self.assertEqual([frame['data']['message']['id'] for frame in sent if frame['type'] == 'message'],
+                         [post.chat_id])
+        self.assertNotIn('notify', [frame['type'] for frame in sent])
+        self.assertEqual([frame['data'] for frame in notified],
+                         [{'chatID': self.conversation.pk, 'lastMsgID': post.chat_id, 'lastMsgTime': post.chat_time}])
+
+    def test_session_replaced(self):
+        async def run():
+            first = WebsocketCommunicator(application, '/ws/chat/', headers=[(b'x-api-key', self.token.encode())])
+            self.assertTrue((await first.connect())[0])
+            # answered once connect is done, the first socket is registered
+            await first.send_json_to({'type': 'get-conv', 'data': {'chatID': self.conversation.pk}})
+            await first.receive_json_from(timeout=5)
+            second = WebsocketCommunicator(application, '/ws/chat/', headers=[(b'x-api-key', self.token.encode())])
+            self.assertTrue((await second.connect())[0])
+            closed = await first.receive_output(timeout=5)
+            await first.disconnect()
+            self.assertEqual(len(await get_registry().channels(self.members[0].pk)), 1)
+            await second.disconnect()
+            return closed
+
+        self.assertEqual(async_to_sync(run)(), {'type': 'websocket.close', 'code': 4001})
+        self.assertFalse(async_to_sync(get_registry().is_online)(self.members[0].pk))
+
+    def test_get_conv(self):
+        ok, missing = self.commands({'type': 'get-conv', 'data': {'chatID': self.conversation.pk}},
+                                    {'type': 'get-conv', 'data': {'chatID': self.conversation.pk + 1}})
+        self.assertEqual(ok['type'], 'get-conv')
+        self.assertEqual([message['id'] for message in ok['data']['messages']], [self.post.chat_id])
+        self.assertEqual(missing['type'], 'error')
+        self.assertEqual(missing['data']['code'], 404)
+
+    def test_set_chat_id(self):
+        outsider = Conversation.objects.create(con_name='other', con_users='', con_isGroup=1)
+        ok, missing, refused = self.commands({'type': 'set-chat-id', 'data': {'chatID': self.conversation.pk}},
+                                             {'type': 'set-chat-id', 'data': {'chatID': outsider.pk + 1}},
+                                             {'type': 'set-chat-id', 'data': {'chatID': outsider.pk}})
+        self.assertEqual(ok, {'type': 'set-chatID', 'data': {'success': True}})
+        self.assertEqual((missing['type'], missing['data']['code']), ('error', 404))
+        self.assertEqual((refused['type'], refused['data']['code']), ('error', 403))
+
+    def test_sync(self):
+        first, = self.commands({'type': 'sync', 'data': {}})
+        self.assertEqual(first['type'], 'sync')
+        self.assertEqual(decode_sync_token(first['data']['token'])[2], {self.conversation.pk: self.post.chat_id})
+        self.assertEqual([message['id'] for conversation in first['data']['conversations']
+                          for message in conversation['messages']], [self.post.chat_id])
+
+        new = self.conversation.post('again', self.members[1].pk)
+        second, = self.commands({'type': 'sync', 'data': {'token': first['data']['token']}})
+        self.assertEqual([message['id'] for conversation in second['data']['conversations']
+                          for message in conversation['messages']], [new.chat_id])
+
+    def test_send_error(self):
+        command = {'type': 'send-message', 'data': {'chatID': self.conversation.pk, 'message': 'hi'}}
+        with mock.patch.object(Conversation, 'post_many', side_effect=DatabaseError('gone')), \
+                self.assertLogs('websocket.consumers', 'ERROR'):
+            failed, = self.commands(command)
+        self.assertEqual(failed['type'], 'error')
+        self.assertEqual(failed['data']['code'], 500)
+
+    def test_rate_limit(self):
+        self.limiter.rates = {'get-conv': parse_rate('1/1h')}
+        command = {'type': 'get-conv', 'data': {'chatID': self.conversation.pk}}
+        first, limited = self.commands(command, command)
+        self.assertEqual(first['type'], 'get-conv')
+        self.assertEqual(limited['type'], 'error')
+        self.assertEqual(limited['data']['code'], 429)
+        self.assertGreater(limited['data']['retryAfter'], 0)
+
+        # the bucket is shared with the rest view
+        response = self.client.get(f'/api/conversation/{self.conversation.pk}/', HTTP_X_API_KEY=self.token)
+        self.assertEqual(response.status_code, 429)
+
+
+class OutboxTest(SimpleTestCase):
+    def test_flush_waits_for_the_drain_task(self):
+        sent = []
+
+        async def send(frame):
+            # a slow client, the drain task is still sending when flush is called
+            await asyncio.sleep(0.01)
+            sent.append(frame['i'])
+
+        async def run():
+            outbox = Outbox(send, max_size=10)
+            outbox.start()
+            for i in range(5):
+                outbox.push({'i': i})
+            await asyncio.sleep(0.015)
+            outbox.push({'i': 5})
+            await outbox.flush()
+            await outbox.stop()
+
+        async_to_sync(run)()
+        self.assertEqual(sent, list(range(6)))
+
+    def test_overflow(self):
+        closed = []
+
+        async def send(frame):
+            await asyncio.sleep(1)
+
+        async def on_overflow():
+            closed.append(True)
+
+        async def run():
+            outbox = Outbox(send, max_size=2, policy=DISCONNECT, on_overflow=on_overflow)
+            for i in range(3):
+                outbox.push({'i': i})
+            await outbox._overflow_task
+            self.assertEqual(len(outbox), 0)
+
+        async_to_sync(run)()
+        self.assertEqual(closed, [True])
+
+    def test_send_error_closes(self):
+        sent, closed = [], []
+
+        async def send(frame):
+            if frame['i'] == 1:
+                raise RuntimeError('encoding failed')
+            sent.append(frame['i'])
+
+        async def on_error():
+            closed.append(True)
+
+        async def run():
+            outbox = Outbox(send, max_size=10, on_error=on_error)
+            outbox.start()
+            for i in range(3):
+                outbox.push({'i': i})
+            with self.assertLogs('websocket.outbox', 'ERROR'):
+                while outbox._error_task is None:
+                    await asyncio.sleep(0.01)
+            await outbox._error_task
+            outbox.push({'i': 3})
+            self.assertEqual(len(outbox), 0)
+            await outbox.stop()
+
+        async_to_sync(run)()
+        self.assertEqual(sent, [0])
+        self.assertEqual(closed, [True])
+
+
+class RegistryTest(SimpleTestCase):
+    def registries(self):
+        caches['default'].clear()
+        return InMemoryConnectionRegistry(ttl=60), CacheConnectionRegistry(ttl=60)
+
+    def test_replace(self):
+        for registry in self.registries():
+            with self.subTest(registry=type(registry).__name__):
+                self.assertEqual(async_to_sync(registry.add)(1, 'first'), [])
+                self.assertEqual(async_to_sync(registry.add)(1, 'second'), ['first'])
+                async_to_sync(registry.remove)(1, 'first')
+                self.assertEqual(async_to_sync(registry.channels)(1), ['second'])
+                self.assertEqual(async_to_sync(registry.online)([1, 2]), {1})
+                async_to_sync(registry.remove)(1, 'second')
+                self.assertEqual(async_to_sync(registry.online)([1, 2]), set())
+
+    def test_expire(self):
+        for registry in self.registries():
+            with self.subTest(registry=type(registry).__name__):
+                now = time.time()
+                with mock.patch('websocket.registry.time.time', return_value=now):
+                    async_to_sync(registry.add)(1, 'stale')
+                    async_to_sync(registry.add)(1, 'live')
+                with mock.patch('websocket.registry.time.time', return_value=now + 30):
+                    async_to_sync(registry.heartbeat)(1, 'live')
+                # a worker died without removing its channel
+                with mock.patch('websocket.registry.time.time', return_value=now + 61):
+                    self.assertEqual(async_to_sync(registry.channels)(1), ['live'])
+                    self.assertEqual(async_to_sync(registry.add)(1, 'new'), ['live'])
+
+
+class FramingTest(SimpleTestCase):
+    message = {'type': 'message', 'data': {'id': 1, 'content': 'héllo ' * 50, 'sender': None}}
+
+    def test_round_trip(self):
+        for name, framing in framings.items():
+            text_data, bytes_data = framing.encode(self.message)
+            self.assertEqual(text_data is None, framing.binary, name)
+            self.assertEqual(framing.decode(text_data, bytes_data), self.message, name)
+
+    def test_deflate_is_smaller(self):
+        plain = framings['json'].encode(self.message)[0].encode()
+        self.assertLess(len(framings['json+deflate'].encode(self.message)[1]), len(plain) / 2)
+
+    def test_text_json_is_always_read(self):
+        for framing in framings.values():
+            self.assertEqual(framing.decode('{"type": "sync"}'), {'type': 'sync'})
+
+    def test_negotiate(self):
+        framing, subprotocol = negotiate(['unknown', 'chat.json+deflate', 'chat.json'])
+        self.assertEqual((framing.name, subprotocol), ('json+deflate', 'chat.json+deflate'))
+        framing, subprotocol = negotiate([])
+        self.assertEqual((framing.name, subprotocol), ('json', None))
+
+    def test_decompression_bomb(self):
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        bomb = compressor.compress(b'[' + b' ' * (MAX_FRAME + 1) + b']') + compressor.flush()
+        with self.assertRaises(ValueError):
+            framings['json+deflate'].decode(bytes_data=bomb)